@@ -1,42 +1,75 @@
 import sqlite3
 import pandas as pd
 pd.set_option('display.max_columns', None)
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 
 def read_cookie_jar(p):
-    con = sqlite3.connect(p)
-    cur = con.cursor()
-    res = cur.execute("SELECT name, value, host_key FROM cookies")
-    return [t + (p, ) for t in res.fetchall()]
-
-
-#storages = Path("../../data/raw").glob("*/*/*/Cookies.sqlite")
-
-#cookies = []
-#for p in storages:
-#    cookies.extend(read_cookie_jar(p))
-
-#cookies = pd.DataFrame(cookies, columns=['name', 'value', 'host', 'path'])
-#cookies.to_csv('cookies.csv', index=False)
-cookies = pd.read_csv('cookies.csv')
-cookies['website'] = cookies['path'].apply(lambda x: Path(x).parent.parent.parent.name)
-cookies['is_fp'] = cookies.apply(lambda row: row['website'] in row['host'], axis=1)
-filtered = cookies[(cookies.duplicated(subset=['value'], keep=False)) & (
-    cookies['value'].str.len() >= 8) & (cookies['is_fp'])]
-
-filtered.to_csv('filtered_cookies.csv', index=False)
-
-counts = {'value': [], 'websites': [], 'hosts': [], 'count(value)': [], 'count(websites)': [], 'count(hosts)': []}
-for value in filtered['value'].unique():
-    hosts = filtered[filtered['value'] == value]['host'].unique()
-    websites = filtered[filtered['value'] == value]['website'].unique()
-    counts['value'].append(value)
-    counts['websites'].append(websites)
-    counts['hosts'].append(hosts)
-    counts['count(value)'].append(len(filtered[filtered['value'] == value]))
-    counts['count(websites)'].append(len(websites))
-    counts['count(hosts)'].append(len(hosts))
-
-counts = pd.DataFrame(counts).sort_values('count(hosts)', ascending=False)
-counts.to_csv('counts.csv', index=False)
+    """Columns name, value, host and path of a cookie jar, the jar is opened read-only"""
+    con = sqlite3.connect(f"file:{p}?mode=ro&immutable=1", uri=True)
+    try:
+        rows = con.execute("SELECT name, value, host_key FROM cookies").fetchall()
+    except sqlite3.DatabaseError:
+        rows = []
+    finally:
+        con.close()
+    return [row + (str(p), ) for row in rows]
+
+
+def read_cookies(raw, workers=None):
+    """All cookie jars below raw (<website>/<call>/<study>/Cookies.sqlite) in one table"""
+    storages = sorted(Path(raw).glob("*/*/*/Cookies.sqlite"))
+    cookies = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for rows in executor.map(read_cookie_jar, storages, chunksize=64):
+            cookies.extend(rows)
+
+    cookies = pd.DataFrame(cookies, columns=['name', 'value', 'host', 'path'])
+    add_website(cookies)
+    return cookies
+
+
+def add_website(cookies):
+    # the website is the folder three levels above the jar, so it is derived once per jar
+    websites = {p: Path(p).parent.parent.parent.name for p in cookies['path'].unique()}
+    cookies['website'] = cookies['path'].map(websites)
+    cookies['is_fp'] = [website in host for website, host in zip(cookies['website'], cookies['host'].astype(str))]
+
+
+def shared_values(cookies, min_length=8):
+    """First party cookies whose value also appears in another cookie"""
+    candidates = cookies[cookies['is_fp'] & (cookies['value'].str.len() >= min_length)]
+    return candidates[cookies['value'].duplicated(keep=False)[candidates.index]]
+
+
+def count_values(filtered):
+    """Websites and hosts sharing each value, with a single groupby over the values"""
+    grouped = filtered.groupby('value', sort=False)
+    counts = pd.DataFrame({
+        'websites': grouped['website'].unique(),
+        'hosts': grouped['host'].unique(),
+        'count(value)': grouped.size(),
+        'count(websites)': grouped['website'].nunique(),
+        'count(hosts)': grouped['host'].nunique(),
+    }).reset_index()
+    return counts.sort_values('count(hosts)', ascending=False, kind='stable')
+
+
+def main(raw=Path("../../data/raw"), out=Path(".")):
+    if raw is not None and raw.is_dir():
+        cookies = read_cookies(raw)
+        cookies.drop(columns=['website', 'is_fp']).to_csv(out / 'cookies.csv', index=False)
+    else:
+        cookies = pd.read_csv(out / 'cookies.csv')
+        add_website(cookies)
+
+    filtered = shared_values(cookies)
+    filtered.to_csv(out / 'filtered_cookies.csv', index=False)
+
+    counts = count_values(filtered)
+    counts.to_csv(out / 'counts.csv', index=False)
+
+
+if __name__ == "__main__":
+    main()
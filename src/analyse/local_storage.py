@@ -0,0 +1,248 @@
+import logging
+import sqlite3
+import struct
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+logs = logging.getLogger("Analyse")
+
+# LevelDB on disk format, see table_format.md and log_format.md of leveldb
+BLOCK_SIZE = 32768
+FULL, FIRST, MIDDLE, LAST = 1, 2, 3, 4
+TABLE_MAGIC = 0xdb4775248b80fb57
+DELETION, VALUE = 0, 1
+
+
+def varint(buf, pos) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def snappy_decompress(buf) -> bytes:
+    """Raw snappy block decompression"""
+    length, pos = varint(buf, 0)
+    out = bytearray()
+    while pos < len(buf):
+        tag = buf[pos]
+        pos += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                n = size - 59
+                size = int.from_bytes(buf[pos:pos + n], "little")
+                pos += n
+            size += 1
+            out += buf[pos:pos + size]
+            pos += size
+            continue
+
+        if kind == 1:
+            size = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | buf[pos]
+            pos += 1
+        elif kind == 2:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(buf[pos:pos + 2], "little")
+            pos += 2
+        else:
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(buf[pos:pos + 4], "little")
+            pos += 4
+
+        start = len(out) - offset
+        if offset >= size:
+            out += out[start:start + size]
+        else:
+            # overlapping copy repeats the last offset bytes
+            for i in range(size):
+                out.append(out[start + i])
+    if len(out) != length:
+        raise ValueError(f"Snappy block of {len(out)} bytes, expected {length}")
+    return bytes(out)
+
+
+def log_records(data: bytes) -> Iterator[bytes]:
+    """Reassembled records of a LevelDB log file"""
+    record = bytearray()
+    pos = 0
+    while pos + 7 <= len(data):
+        block_left = BLOCK_SIZE - pos % BLOCK_SIZE
+        if block_left < 7:
+            # trailer of a block is zero padded
+            pos += block_left
+            continue
+        length, kind = struct.unpack_from("<HB", data, pos + 4)
+        fragment = data[pos + 7:pos + 7 + length]
+        pos += 7 + length
+        if kind == 0 and length == 0:
+            # preallocated, never written space
+            break
+        if kind == FULL:
+            yield fragment
+        elif kind == FIRST:
+            record = bytearray(fragment)
+        elif kind == MIDDLE:
+            record += fragment
+        elif kind == LAST:
+            record += fragment
+            yield bytes(record)
+
+
+def batch_entries(batch: bytes) -> Iterator[Tuple[bytes, int, int, bytes]]:
+    """Key, sequence number, type and value of every put or delete of a write batch"""
+    seq, count = struct.unpack_from("<QI", batch, 0)
+    pos = 12
+    for i in range(count):
+        kind = batch[pos]
+        size, pos = varint(batch, pos + 1)
+        key = batch[pos:pos + size]
+        pos += size
+        value = b""
+        if kind == VALUE:
+            size, pos = varint(batch, pos)
+            value = batch[pos:pos + size]
+            pos += size
+        yield key, seq + i, kind, value
+
+
+def read_block(data: bytes, offset, size) -> bytes:
+    block = data[offset:offset + size]
+    compression = data[offset + size]
+    if compression == 1:
+        return snappy_decompress(block)
+    if compression != 0:
+        raise ValueError(f"Unsupported block compression {compression}")
+    return block
+
+
+def block_entries(block: bytes) -> Iterator[Tuple[bytes, bytes]]:
+    """Keys and values of a table block, keys are prefix compressed"""
+    n_restarts = struct.unpack_from("<I", block, len(block) - 4)[0]
+    end = len(block) - 4 - 4 * n_restarts
+    pos = 0
+    key = b""
+    while pos < end:
+        shared, pos = varint(block, pos)
+        non_shared, pos = varint(block, pos)
+        value_size, pos = varint(block, pos)
+        key = key[:shared] + block[pos:pos + non_shared]
+        pos += non_shared
+        yield key, block[pos:pos + value_size]
+        pos += value_size
+
+
+def table_entries(data: bytes) -> Iterator[Tuple[bytes, int, int, bytes]]:
+    """Key, sequence number, type and value of every entry of a LevelDB table (.ldb)"""
+    footer = data[-48:]
+    if struct.unpack_from("<Q", footer, 40)[0] != TABLE_MAGIC:
+        raise ValueError("Not a LevelDB table")
+    _, pos = varint(footer, 0)
+    _, pos = varint(footer, pos)
+    index_offset, pos = varint(footer, pos)
+    index_size, pos = varint(footer, pos)
+
+    for _, handle in block_entries(read_block(data, index_offset, index_size)):
+        offset, pos = varint(handle, 0)
+        size, _ = varint(handle, pos)
+        for internal_key, value in block_entries(read_block(data, offset, size)):
+            tag = struct.unpack_from("<Q", internal_key, len(internal_key) - 8)[0]
+            yield internal_key[:-8], tag >> 8, tag & 0xff, value
+
+
+def read_leveldb(path) -> dict:
+    """Live key-value pairs of a LevelDB folder, the newest write of a key wins"""
+    entries = []
+    for f in Path(path).iterdir():
+        if f.suffix == ".log":
+            for record in log_records(f.read_bytes()):
+                entries.extend(batch_entries(record))
+        elif f.suffix in (".ldb", ".sst"):
+            entries.extend(table_entries(f.read_bytes()))
+
+    db = {}
+    for key, _, kind, value in sorted(entries, key=lambda entry: entry[1]):
+        if kind == VALUE:
+            db[key] = value
+        else:
+            db.pop(key, None)
+    return db
+
+
+def decode_string(data: bytes) -> str:
+    """Chrome prefixes local storage strings with their encoding, 0 is UTF-16LE and 1 Latin-1"""
+    if not data:
+        return ""
+    if data[0] == 0:
+        return data[1:].decode("utf-16-le", errors="replace")
+    return data[1:].decode("latin-1")
+
+
+def storage_entries(db: dict) -> Iterator[Tuple[str, str, str]]:
+    """Origin, key and value of the local storage entries, keys are '_' origin NUL key"""
+    for key, value in db.items():
+        if not key.startswith(b"_") or b"\x00" not in key:
+            # VERSION, META: and METAACCESS: records
+            continue
+        origin, script_key = key[1:].split(b"\x00", 1)
+        yield origin.decode("utf-8", errors="replace"), decode_string(script_key), decode_string(value)
+
+
+def read_study(leveldb) -> List[Tuple]:
+    """Rows of the local storage of one study (<website>/<call>/<study>/Local Storage/leveldb)"""
+    leveldb = Path(leveldb)
+    study = leveldb.parent.parent
+    try:
+        db = read_leveldb(leveldb)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        logs.warning(f"Skip {leveldb} - {e}")
+        return []
+    return [(study.parent.parent.name, study.parent.name, study.name, origin, key, value)
+            for origin, key, value in storage_entries(db)]
+
+
+def read_local_storage(raw, workers=None):
+    """Local storage of every study below raw in one table"""
+    folders = sorted(Path(raw).glob("*/*/*/Local Storage/leveldb"))
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for study_rows in executor.map(read_study, folders, chunksize=16):
+            rows.extend(study_rows)
+    storage = pd.DataFrame(rows, columns=["website", "call", "study", "origin", "key", "value"])
+    storage["host"] = storage["origin"].str.split("://").str[-1].str.split(":").str[0]
+    storage["is_fp"] = [website in host for website, host in zip(storage["website"], storage["host"])]
+    return storage
+
+
+def write_table(storage, path):
+    """Store the table in SQLite, indexed by website and study and by value"""
+    Path(path).unlink(missing_ok=True)
+    con = sqlite3.connect(path)
+    storage.to_sql("local_storage", con, index=False)
+    with con:
+        con.execute("CREATE INDEX local_storage_study ON local_storage (website, study)")
+        con.execute("CREATE INDEX local_storage_value ON local_storage (value)")
+    con.close()
+
+
+def main(raw=Path("../../data/raw"), out=Path(".")):
+    from cookies import count_values, shared_values
+
+    storage = read_local_storage(raw)
+    write_table(storage, out / "local_storage.sqlite")
+
+    # identifiers shared across sites, in the same layout as the cookie counts
+    counts = count_values(shared_values(storage))
+    counts.to_csv(out / "local_storage_counts.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
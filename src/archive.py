@@ -0,0 +1,141 @@
+import sqlite3
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import IO, List
+from utils.utility import create_folder, list_dir, rm_folder
+
+# members which are already compressed are stored as they are
+STORED_SUFFIXES = {".png", ".jpg", ".webp", ".gz", ".zst", ".ldb"}
+
+
+class PackedStore:
+    """Packed storage of the crawled data, one zip archive per website call.
+
+    A site is addressed by '<netloc>/<sha3[:10]>' like the folders in data/raw.
+    The central index lists every member, so the corpus is listed without
+    walking the file system and members are read without unpacking.
+    """
+
+    def __init__(self, root) -> None:
+        self.root = Path(root)
+        create_folder(self.root)
+        self.con = sqlite3.connect(self.root / "index.sqlite", timeout=60)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS members (
+                site TEXT NOT NULL,
+                member TEXT NOT NULL,
+                study TEXT NOT NULL,
+                size INTEGER,
+                PRIMARY KEY (site, member))""")
+
+    def archive(self, site) -> Path:
+        netloc, call = site.split("/")
+        return self.root / netloc / f"{call}.zip"
+
+    def sidecar(self, site, filename) -> Path:
+        """File stored next to the archive, e.g. preprocessing results"""
+        netloc, call = site.split("/")
+        return self.root / netloc / f"{call}.{filename}"
+
+    def pack_site(self, site_dir, remove=False) -> str:
+        """Pack a website call folder of data/raw and add it to the index"""
+        site_dir = Path(site_dir)
+        site = f"{site_dir.parent.name}/{site_dir.name}"
+        archive = self.archive(site)
+        create_folder(archive.parent)
+
+        members = []
+        with zipfile.ZipFile(archive, "w", allowZip64=True) as zf:
+            for path in sorted(site_dir.rglob("*")):
+                if not path.is_file():
+                    continue
+                member = path.relative_to(site_dir).as_posix()
+                compression = zipfile.ZIP_STORED if path.suffix in STORED_SUFFIXES else zipfile.ZIP_DEFLATED
+                zf.write(path, member, compress_type=compression)
+                study = member.split("/")[0] if "/" in member else ""
+                members.append((site, member, study, path.stat().st_size))
+
+        with self.con:
+            self.con.execute("DELETE FROM members WHERE site = ?", (site,))
+            self.con.executemany(
+                "INSERT INTO members (site, member, study, size) VALUES (?, ?, ?, ?)", members)
+
+        if remove:
+            rm_folder(site_dir)
+        return site
+
+    def sites(self) -> List[str]:
+        return [row[0] for row in self.con.execute("SELECT DISTINCT site FROM members ORDER BY site")]
+
+    def studies(self, site) -> List[str]:
+        return [row[0] for row in self.con.execute(
+            "SELECT DISTINCT study FROM members WHERE site = ? AND study != '' ORDER BY study", (site,))]
+
+    def members(self, site, study=None) -> List[str]:
+        if study is None:
+            rows = self.con.execute(
+                "SELECT member FROM members WHERE site = ? ORDER BY member", (site,))
+        else:
+            rows = self.con.execute(
+                "SELECT member FROM members WHERE site = ? AND study = ? ORDER BY member", (site, study))
+        return [row[0] for row in rows]
+
+    def size(self, site, member) -> int:
+        """Uncompressed size of a member, None if it doesn't exist"""
+        row = self.con.execute(
+            "SELECT size FROM members WHERE site = ? AND member = ?", (site, member)).fetchone()
+        return row[0] if row else None
+
+    def exists(self, site, member) -> bool:
+        return self.con.execute("SELECT 1 FROM members WHERE site = ? AND member = ?", (site, member)).fetchone() is not None
+
+    def open(self, site, member) -> IO[bytes]:
+        """Open a single member of a site for reading"""
+        # the opened member keeps the archive file open until it is closed
+        with zipfile.ZipFile(self.archive(site)) as zf:
+            try:
+                return zf.open(member)
+            except KeyError:
+                raise FileNotFoundError(f"{member} not in {self.archive(site)}")
+
+    def read(self, site, member) -> bytes:
+        with self.open(site, member) as f:
+            return f.read()
+
+    def close(self):
+        self.con.close()
+
+
+@dataclass
+class PackedStudy:
+    """A study inside a packed site, counterpart of a study folder in data/raw"""
+    store: PackedStore
+    site: str
+    name: str
+
+    @property
+    def website(self):
+        return self.site.split("/")[0]
+
+    def member(self, filename):
+        return f"{self.name}/{filename}"
+
+
+def pack_raw(raw, root, remove=False):
+    """Pack every website call folder below raw into the store at root"""
+    store = PackedStore(root)
+    sites = [store.pack_site(call_dir, remove=remove)
+             for netloc_dir in list_dir(raw)
+             for call_dir in list_dir(netloc_dir)]
+    store.close()
+    return sites
+
+
+if __name__ == "__main__":
+    import config
+    conf = config.load_config()
+    data_path = Path(conf["output"].get("data_path", "data"))
+    sites = pack_raw(data_path / "raw", data_path / conf["output"].get("packed_path", "packed"))
+    print(f"Packed {len(sites)} sites into {data_path / conf['output'].get('packed_path', 'packed')}")
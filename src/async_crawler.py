@@ -0,0 +1,439 @@
+import asyncio
+import base64
+import time
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from typing import Dict, List
+from net_crawler import CrawlManager, conf, logs, open_ledger, pack_site, plan_studies, prepare_volume, record_exports
+from concurrency import ConcurrencyController
+from ledger import DONE
+from utils.utility import append_file
+
+# W3C identifier of web elements in WebDriver responses
+ELEMENT_KEY = "element-6066-11e4-a6e0-4f4c7a6e5c9d"
+SPACE_KEY = "\ue00d"
+
+
+class WebDriverError(Exception):
+
+    def __init__(self, error, message):
+        super().__init__(f"{error}: {message}")
+        self.error = error
+
+
+class WebDriverTimeout(WebDriverError):
+    pass
+
+
+class AsyncWebDriver:
+    """Minimal W3C WebDriver client, covering the commands used by the crawler"""
+
+    def __init__(self, http: aiohttp.ClientSession, url: str) -> None:
+        self.http = http
+        self.url = url
+        self.session_id = None
+
+    async def _request(self, method, path, payload=None):
+        async with self.http.request(method, f"{self.url}{path}", json=payload) as r:
+            data = await r.json(content_type=None)
+
+        value = data.get("value") if data else None
+        if isinstance(value, dict) and "error" in value:
+            if value["error"] == "timeout":
+                raise WebDriverTimeout(value["error"], value.get("message", ""))
+            raise WebDriverError(value["error"], value.get("message", ""))
+        if r.status >= 400:
+            raise WebDriverError("unknown error", f"HTTP {r.status}")
+        return value
+
+    async def _command(self, method, path, payload=None):
+        return await self._request(method, f"/session/{self.session_id}{path}", payload)
+
+    async def start(self, capabilities: Dict):
+        value = await self._request("POST", "/session", {"capabilities": {"alwaysMatch": capabilities}})
+        self.session_id = value["sessionId"]
+
+    async def quit(self):
+        if self.session_id:
+            await self._request("DELETE", f"/session/{self.session_id}")
+            self.session_id = None
+
+    async def set_page_load_timeout(self, timeout):
+        await self._command("POST", "/timeouts", {"pageLoad": int(timeout * 1000)})
+
+    async def get(self, url):
+        await self._command("POST", "/url", {"url": url})
+
+    async def current_url(self):
+        return await self._command("GET", "/url")
+
+    async def execute_script(self, script, *args):
+        return await self._command("POST", "/execute/sync", {"script": script, "args": list(args)})
+
+    async def find_elements(self, tag) -> List[str]:
+        elements = await self._command("POST", "/elements", {"using": "tag name", "value": tag})
+        return [element[ELEMENT_KEY] for element in elements]
+
+    async def text(self, element):
+        return await self._command("GET", f"/element/{element}/text")
+
+    async def attribute(self, element, name):
+        return await self._command("GET", f"/element/{element}/attribute/{name}")
+
+    async def click(self, element):
+        await self._command("POST", f"/element/{element}/click", {})
+
+    async def switch_to_frame(self, element=None):
+        frame = {ELEMENT_KEY: element} if element else None
+        await self._command("POST", "/frame", {"id": frame})
+
+    async def press(self, key):
+        actions = [{"type": "key", "id": "keyboard", "actions": [
+            {"type": "keyDown", "value": key}, {"type": "keyUp", "value": key}]}]
+        await self._command("POST", "/actions", {"actions": actions})
+
+    async def get_log(self, log_type) -> List[Dict]:
+        # chromedriver still serves the legacy log endpoint
+        return await self._command("POST", "/se/log", {"type": log_type})
+
+    async def screenshot(self) -> bytes:
+        return base64.b64decode(await self._command("GET", "/screenshot"))
+
+
+class AsyncCrawlManager:
+    """Drives one crawler container from the event loop.
+
+    Browser commands are sent with async HTTP, container and capture handling
+    reuses the docker calls of CrawlManager in worker threads.
+    """
+
+    def __init__(self, crawl_config: Dict, cookie_accept: Dict, http: aiohttp.ClientSession) -> None:
+        self.crawl_config = crawl_config
+        self.cookie_accept = cookie_accept
+        self.http = http
+
+        self.website = crawl_config['website']
+        self.timeout = conf["crawler"].getfloat("timeout", 10)
+        self.wait_page = conf["crawler"].getfloat("wait_page", 10)
+
+        self.manager = None
+        self.driver = None
+        self.timeouts = 0
+
+    async def start(self):
+        self.manager = await asyncio.to_thread(CrawlManager, self.crawl_config, self.cookie_accept)
+        self.telemetry = self.manager.telemetry
+
+    async def checkready(self):
+        with self.telemetry.phase("checkready"):
+            await self._checkready()
+
+    async def _checkready(self):
+        url = f"http://localhost:{self.manager.port}/wd/hub/status"
+        for iteration in range(int(self.timeout)):
+            await asyncio.sleep(1)
+            try:
+                logs.debug(
+                    f"Try starting crawler in iteration {iteration} for {self.website}")
+                async with self.http.get(url) as r:
+                    if (await r.json(content_type=None))['value']['ready']:
+                        return
+            except Exception:
+                pass
+
+        raise TimeoutError(
+            f"Timeout ({self.timeout}), couldn't start crawler for {self.website}")
+
+    async def _get_webdriver(self):
+        options = self.manager._chrome_options()
+        driver = AsyncWebDriver(self.http, f"http://127.0.0.1:{self.manager.port}")
+        await driver.start(options.to_capabilities())
+        await driver.execute_script(
+            "Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+        await driver.set_page_load_timeout(self.timeout)
+        return driver
+
+    async def _init_study(self, name):
+        self.manager.study = name
+        with self.telemetry.phase("webdriver_start", name):
+            self.driver = await self._get_webdriver()
+        return await asyncio.to_thread(self.manager._start_capture, name)
+
+    async def _stop_study(self):
+        with self.telemetry.phase("study_stop", self.manager.study):
+            await asyncio.to_thread(self.manager._stop_tcpdump)
+            if self.driver:
+                if conf["crawler"].get("network_log", ""):
+                    try:
+                        self.manager._save_network_log(await self.driver.get_log("performance"))
+                    except Exception as e:
+                        logs.error(f"Couldn't save the network log of {self.website} - {e}")
+                await self.driver.quit()
+            await asyncio.to_thread(self.manager._rm_cache)
+
+    async def close(self):
+        if self.manager:
+            await asyncio.to_thread(self.manager.close)
+
+    async def _visit_page(self):
+        logs.debug(f"Visit {self.website}")
+        with self.telemetry.phase("page_load", self.manager.study):
+            await self.driver.get(self.website)
+        if conf["crawler"].getboolean("scroll", True):
+            with self.telemetry.phase("scroll", self.manager.study):
+                await self._scroll()
+
+    async def _scroll(self):
+        for _ in range(2):
+            await self.driver.press(SPACE_KEY)
+            await asyncio.sleep(.4)
+        await self.driver.execute_script(
+            "window.scrollTo(0, document.body.scrollHeight);")
+        await asyncio.sleep(.4)
+        await self.driver.execute_script("window.scrollTo(0, 0);")
+
+    async def run_study(self, name=None):
+        logs.info(f"Run study {name} for {self.website}")
+        volume = await self._init_study(name)
+
+        timeout = time.time() + self.wait_page
+        try:
+            await self._visit_page()
+            with self.telemetry.phase("page_wait", name):
+                await asyncio.sleep(max(0, timeout - time.time()))
+        except WebDriverTimeout as e:
+            logs.critical(f"Timeout while {name} {self.website} - {e}")
+            self.timeouts += 1
+        except Exception as e:
+            logs.error(f"Error while {name} {self.website} - {e}")
+            await self._stop_study()
+            logs.info(f"End study {name} for {self.website}")
+            return e
+
+        if conf["crawler"].getboolean("screenshots", False):
+            with self.telemetry.phase("screenshot", name):
+                screenshot = await self.driver.screenshot()
+            self.manager._save_screenshot(screenshot, name, volume)
+        await self._stop_study()
+        self.manager._compress_capture(name, volume)
+        await asyncio.to_thread(self.manager._collect_artifacts, name, volume)
+        logs.info(f"End study {name} for {self.website}")
+
+    async def accept_cookie(self, name=None):
+        logs.info(f"Run study {name} for {self.website}")
+        volume = await self._init_study(name)
+
+        timeout = time.time() + self.timeout
+        try:
+            clicked_banner = await asyncio.wait_for(self._accept_cookie(timeout), self.timeout)
+        except (asyncio.TimeoutError, TimeoutError, WebDriverTimeout):
+            logs.critical(
+                f"Timeout ({self.timeout} s) for cookie-accept on {self.website}")
+            self.timeouts += 1
+            clicked_banner = False
+        except Exception as error:
+            logs.error(
+                f"Error while accept cookie on {self.website} - {error}")
+            clicked_banner = False
+
+        if clicked_banner:
+            append_file(self.cookie_accept["log"],
+                        f'{self.website},True,"{clicked_banner}"')
+            # Time to settle for cookies
+            with self.telemetry.phase("click_settle", name):
+                await asyncio.sleep(max(0, min(self.wait_page, timeout - time.time())))
+        else:
+            logs.debug(f"No matching cookie-banner at {self.website}")
+            append_file(self.cookie_accept["log"], f"{self.website},False,")
+
+        await self._stop_study()
+        self.manager._compress_capture(name, volume)
+        logs.info(f"End study {name} for {self.website}")
+        return clicked_banner
+
+    async def _accept_cookie(self, timeout):
+        await self._visit_page()
+
+        with self.telemetry.phase("banner_search", self.manager.study):
+            clicked_banner = await self._click_banner(timeout)
+            if not clicked_banner:
+                clicked_banner = await self._click_frame(timeout)
+
+        return clicked_banner
+
+    async def _find_banner(self, timeout):
+        contents = [elem for tag in ["button", "a"]
+                    for elem in await self.driver.find_elements(tag)]
+        accept_words = self.cookie_accept['words']
+
+        for candidate in contents:
+            if time.time() > timeout:
+                raise TimeoutError
+            try:
+                banner_text = (await self.driver.text(candidate)).lower().strip(" ✓›!\n")
+                banner_text = ' '.join(banner_text.splitlines())
+                if self.manager._is_Accept_Word(banner_text, accept_words):
+                    logs.debug(
+                        f"Found id: {await self.driver.attribute(candidate, 'id')}, text: {banner_text}")
+                    return candidate, banner_text
+            except Exception:
+                logs.error(
+                    f"Exception in processing element: {candidate} at {self.website}")
+
+        return None, None
+
+    async def _click_banner(self, timeout):
+        candidate, banner_text = await self._find_banner(timeout)
+        if not candidate:
+            return False
+
+        try:  # in some pages element is not clickable
+            await self.driver.click(candidate)
+        except Exception:
+            try:
+                await self.driver.execute_script("arguments[0].click();", {ELEMENT_KEY: candidate})
+            except Exception as e:
+                logs.error(
+                    f"Exception in cookie-banner click at {self.website}\n{e}")
+                return False
+
+        logs.debug(
+            f"Clicked cookie-banner at {await self.driver.current_url()} with text {banner_text}")
+        return banner_text
+
+    async def _click_frame(self, timeout):
+        for frame in await self.driver.find_elements("iframe"):
+            if time.time() > timeout:
+                raise TimeoutError
+            try:
+                logs.debug(f"Switching to frame: {frame}")
+                await self.driver.switch_to_frame(frame)
+                clicked_banner = await self._click_banner(timeout)
+                await self.driver.switch_to_frame()
+                if clicked_banner:
+                    return clicked_banner
+            except Exception as e:
+                await self.driver.switch_to_frame()
+                logs.error(f"Error in frame at {self.website} - {e}")
+
+        return False
+
+
+async def run_step(ledger, website, study, step):
+    """Run a study and record its state in the ledger, the sqlite calls run in worker threads"""
+    if ledger:
+        await asyncio.to_thread(ledger.start_study, website, study)
+    try:
+        result = await step(study)
+    except Exception as e:
+        if ledger:
+            await asyncio.to_thread(ledger.record, website, study, e)
+        raise
+
+    if ledger:
+        await asyncio.to_thread(ledger.record, website, study, result)
+    return result
+
+
+async def run_crawl(crawl_config, cookie_accept, http):
+    website = crawl_config["website"]
+    outcome = {"website": website, "error": None}
+    start = time.time()
+    ledger = await asyncio.to_thread(open_ledger)
+    studies = ["before accept", "accepting policy", "after accept"]
+    done = {}
+    if crawl_config.get("resume"):
+        done = await asyncio.to_thread(ledger.completed_studies, website) if ledger else {}
+        studies = plan_studies(done)
+        await asyncio.to_thread(prepare_volume, crawl_config, studies, ledger)
+    if ledger:
+        await asyncio.to_thread(ledger.start_site, website, crawl_config["volume"])
+
+    error = None
+    crawl = AsyncCrawlManager(crawl_config, cookie_accept, http)
+    try:
+        await crawl.start()
+        await crawl.checkready()
+        if "before accept" in studies:
+            await run_step(ledger, website, "before accept", crawl.run_study)
+        if "accepting policy" in studies:
+            clicked_banner = await run_step(ledger, website, "accepting policy", crawl.accept_cookie)
+            if clicked_banner:
+                await run_step(ledger, website, "after accept", crawl.run_study)
+        else:
+            clicked_banner = done["accepting policy"]
+        outcome["clicked_banner"] = clicked_banner
+    except Exception as e:
+        logs.error(f"Error for {website} - {e}")
+        outcome["error"] = f"{type(e).__name__}: {e}"
+        error = e
+    finally:
+        await crawl.close()
+        if crawl.manager:
+            await asyncio.to_thread(record_exports, ledger, outcome, crawl.manager.export_errors)
+        complete = outcome["error"] is None
+        if ledger:
+            complete = await asyncio.to_thread(ledger.finish_site, website, error) == DONE
+            await asyncio.to_thread(ledger.close)
+        # incomplete websites stay unpacked, so a resumed crawl can continue them
+        if complete and crawl.manager and conf["output"].getboolean("packed", False):
+            with crawl.telemetry.phase("pack"):
+                await asyncio.to_thread(pack_site, crawl_config["volume"])
+        outcome["timeouts"] = crawl.timeouts
+        if crawl.manager:
+            outcome["dropped"] = crawl.manager.dropped
+            outcome["phases"] = crawl.telemetry.phases
+        outcome["duration"] = round(time.time() - start, 3)
+    return outcome
+
+
+async def crawl(crawl_config, cookie_accept, on_outcome=None):
+    """Crawl the websites with one worker per container slot, as many at once as the concurrency controller allows"""
+    controller = ConcurrencyController.from_config(conf["docker"])
+    configs = iter(crawl_config)
+    state = {"running": 0, "exhausted": False}
+
+    # docker calls run in worker threads, some of them block for seconds
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=4 * controller.maximum))
+
+    def update():
+        controller.update(state["running"] if not state["exhausted"] else 0)
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as http:
+        with tqdm(total=len(crawl_config)) as progress:
+            async def worker(slot):
+                while True:
+                    # slots above the current limit wait until the controller raises it
+                    while slot >= controller.limit and not state["exhausted"]:
+                        update()
+                        await asyncio.sleep(1)
+                    c = next(configs, None)
+                    if c is None:
+                        state["exhausted"] = True
+                        return
+
+                    state["running"] += 1
+                    try:
+                        outcome = await run_crawl(c, cookie_accept, http)
+                    except Exception as e:
+                        # as in run_pool, a failing crawl is an outcome and the other workers go on
+                        logs.error(f"Error for {c['website']} - {e}")
+                        outcome = {"website": c["website"], "error": f"{type(e).__name__}: {e}"}
+                    finally:
+                        state["running"] -= 1
+                    controller.record(outcome)
+                    if on_outcome:
+                        on_outcome(outcome)
+                    progress.update()
+                    update()
+
+            workers = [asyncio.create_task(worker(slot)) for slot in range(controller.maximum)]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                # e.g. on_outcome raised, the other workers don't outlive the session
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
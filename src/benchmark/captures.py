@@ -0,0 +1,109 @@
+import random
+from typing import Dict, List
+
+LOCAL_IP = "172.17.0.2"
+CONTENT_TYPES = ["text/html", "application/javascript", "text/css", "image/png", "image/gif", "application/json"]
+
+
+class CaptureBuilder:
+    """Builds packets in the layout of tshark -T json as read by preprocess"""
+
+    def __init__(self, rng: random.Random) -> None:
+        self.rng = rng
+        self.packets: List[Dict] = []
+        self.time = 0.
+
+    def packet(self, stream, remote_ip, outgoing, protocols, length=0, **layers) -> int:
+        self.time += self.rng.expovariate(200)
+        nr = len(self.packets) + 1
+        src, dst = (LOCAL_IP, remote_ip) if outgoing else (remote_ip, LOCAL_IP)
+        packet_layers = {
+            "frame": {"frame.number": str(nr), "frame.protocols": f"eth:ethertype:ip:tcp:{protocols}",
+                      "frame.time_relative": f"{self.time:.6f}"},
+            "ip": {"ip.src": src, "ip.dst": dst, "ip.addr": [src, dst]},
+            "tcp": {"tcp.stream": str(stream), "tcp.len": str(length)},
+        }
+        packet_layers.update(layers)
+        self.packets.append({"_source": {"layers": packet_layers}})
+        return nr
+
+    def segments(self, stream, remote_ip, n) -> Dict:
+        """Continuation segments of a reassembled PDU, referenced by the packet which completes it"""
+        nrs = [self.packet(stream, remote_ip, False, "tls", 1448) for _ in range(n)]
+        return {"tcp.segments": {"tcp.segment": [str(nr) for nr in nrs]}}
+
+
+def http2_stream(stream_id, frame_type, headers=None, eh="1", end_stream="0", **extra) -> Dict:
+    stream = {"http2.streamid": str(stream_id), "http2.type": str(frame_type),
+              "http2.flags_tree": {"http2.flags.eh": eh, "http2.flags.end_stream": end_stream}}
+    if headers:
+        stream["http2.header"] = [{"http2.header.name": k, "http2.header.value": v} for k, v in headers.items()]
+    stream.update(extra)
+    return stream
+
+
+def synthetic_capture(n_packets, website="www.example.com", n_hosts=50, http2_share=.7,
+                      push_rate=.05, segment_rate=.3, seed=0) -> List[Dict]:
+    """Packets of a synthetic study with HTTP/1.1 and HTTP/2 requests, server push and reassembled segments"""
+    rng = random.Random(seed)
+    builder = CaptureBuilder(rng)
+    hosts = [website] + [f"cdn-{i:03d}.example.net" if i % 3 else f"tracker-{i:03d}.net" for i in range(1, n_hosts)]
+    ips = {host: f"93.184.{i // 250}.{i % 250 + 1}" for i, host in enumerate(hosts)}
+    connections = {}
+
+    while len(builder.packets) < n_packets:
+        host = website if not builder.packets else rng.choice(hosts)
+        is_http2 = rng.random() < http2_share
+        key = (host, is_http2)
+        if key not in connections:
+            # tcp stream and the next free http2 stream id of the connection
+            connections[key] = [len(connections), 1]
+        tcp_id, stream_id = connections[key]
+        ip = ips[host]
+        path = f"/{rng.getrandbits(32):08x}"
+        content = rng.choice(CONTENT_TYPES)
+
+        # handshake and acks without http
+        for _ in range(rng.randint(1, 4)):
+            builder.packet(tcp_id, ip, rng.random() < .5, "tls")
+
+        if is_http2:
+            connections[key][1] += 2
+            request = {":method": "GET", ":scheme": "https", ":authority": host, ":path": path}
+            builder.packet(tcp_id, ip, True, "tls:http2", 120,
+                           http2={"http2.stream": http2_stream(stream_id, 1, request)})
+
+            segments = builder.segments(tcp_id, ip, rng.randint(1, 5)) if rng.random() < segment_rate else {}
+            response = {":status": "200", "content-type": content}
+            streams = [http2_stream(stream_id, 1, response)]
+            pushed = None
+            if rng.random() < push_rate:
+                pushed = connections[key][1] + 1
+                promise = {":method": "GET", ":scheme": "https", ":authority": host, ":path": path + ".push"}
+                streams.append(http2_stream(stream_id, 5, promise, **{"http2.push_promise.promised_stream_id": str(pushed)}))
+            builder.packet(tcp_id, ip, False, "tls:http2", 400, http2={"http2.stream": streams}, **segments)
+
+            for i in range(rng.randint(1, 6)):
+                builder.packet(tcp_id, ip, False, "tls:http2", 1448,
+                               http2={"http2.stream": http2_stream(stream_id, 0, end_stream="0" if i else "1")})
+            if pushed:
+                builder.packet(tcp_id, ip, False, "tls:http2", 1448, http2=[
+                    {"http2.stream": http2_stream(pushed, 1, {":status": "200", "content-type": content})},
+                    {"http2.stream": http2_stream(pushed, 0, end_stream="1")}])
+        else:
+            request_nr = builder.packet(tcp_id, ip, True, "http", 200, http={
+                f"GET {path} HTTP/1.1\r\n": {"http.request.method": "GET", "http.request.uri": path},
+                "http.host": host})
+            segments = builder.segments(tcp_id, ip, rng.randint(1, 5)) if rng.random() < segment_rate else {}
+            builder.packet(tcp_id, ip, False, "http:media", 1448, http={
+                "HTTP/1.1 200 OK\r\n": {"http.response.code": "200"},
+                "http.content_type": content,
+                "http.request_in": str(request_nr),
+                "http.response_for.uri": f"http://{host}{path}"}, **segments)
+
+    return builder.packets[:n_packets]
+
+
+def filter_rules(n_hosts=50) -> List[str]:
+    """Adblock rules blocking the synthetic trackers"""
+    return [f"||tracker-{i:03d}.net^" for i in range(1, n_hosts) if not i % 3] + ["/ads/*$script"]
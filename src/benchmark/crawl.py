@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+import docker
+from benchmark.results import compare, percentiles, previous_result, save_result
+from benchmark.sites import generate_corpus
+from net_crawler import conf, create_site_config, logs, run_pool, setup_docker
+from utils.utility import init_logger, load_linesperated_textfile, rm_folder, write_file
+
+NETWORK = "crawl-benchmark"
+
+
+def start_server(client, corpus: Path, image, network=NETWORK, timeout=30):
+    """Serve the corpus from a container on the benchmark network, returns the container and its ip"""
+    if not client.networks.list(names=[network]):
+        client.networks.create(network, driver="bridge")
+
+    server = client.containers.run(image, ["python", "/corpus/site_server.py", "/corpus/manifest.json"],
+                                   detach=True, auto_remove=True, network=network,
+                                   volumes=[f"{corpus.resolve()}/:/corpus/:ro"])
+    for _ in range(timeout):
+        if b"Serving" in server.logs():
+            break
+        time.sleep(1)
+    else:
+        server.stop()
+        raise TimeoutError(f"Timeout ({timeout}), couldn't start the site server")
+
+    server.reload()
+    return server, server.attrs["NetworkSettings"]["Networks"][network]["IPAddress"]
+
+
+def check_images(client, images):
+    """The benchmark runs offline, so every image has to exist locally"""
+    missing = []
+    for image in images:
+        try:
+            client.images.get(image)
+        except docker.errors.ImageNotFound:
+            missing.append(image)
+    if missing:
+        raise RuntimeError(f"Missing docker images {missing}, pull or build them before running offline")
+
+
+def configure(server_ip, network=NETWORK, orchestrator="process", n_container=None):
+    """Point the crawler at the site server, state of previous runs is neither resumed nor packed"""
+    conf["docker"]["network"] = network
+    conf["crawler"]["host_resolver_rules"] = f"MAP * {server_ip}"
+    conf["crawler"]["orchestrator"] = orchestrator
+    conf["crawler"]["resume"] = "false"
+    conf["output"]["ledger"] = ""
+    conf["output"]["packed"] = "false"
+    if n_container:
+        conf["docker"]["n_container"] = str(n_container)
+        conf["docker"]["adaptive"] = "false"
+
+
+def crawl(websites: List[str], out: Path, orchestrator="process") -> List[Dict]:
+    """Run the websites through the regular crawl path and return their outcomes"""
+    cookie_accept = {"words": set(load_linesperated_textfile(conf["crawler"].get("accept_words", "lists/accept_words.txt"))),
+                     "log": out / "cookie-accept.csv"}
+    write_file(cookie_accept["log"], "url,is_accept,banner_text")
+    study_config = {"raw": out / "raw", "websites": websites, "cookie_accept": cookie_accept}
+    crawl_configs = [create_site_config(study_config, website, override=True) for website in websites]
+
+    outcomes = []
+    if orchestrator == "async":
+        import async_crawler
+        asyncio.run(async_crawler.crawl(crawl_configs, cookie_accept, on_outcome=outcomes.append))
+    else:
+        run_pool(crawl_configs, cookie_accept, total=len(crawl_configs), on_outcome=outcomes.append)
+    return outcomes
+
+
+def report(outcomes: List[Dict], manifest: Dict, duration: float) -> Dict:
+    """Throughput, phase latency percentiles and banner click success of a run"""
+    phases = defaultdict(list)
+    for outcome in outcomes:
+        for phase in outcome.get("phases", []):
+            phases[phase["phase"]].append(phase["duration"])
+
+    banners = defaultdict(lambda: {"sites": 0, "clicked": 0})
+    for outcome in outcomes:
+        placement = manifest["sites"][outcome["website"].split("://")[1].strip("/")]["banner"] or "none"
+        banners[placement]["sites"] += 1
+        banners[placement]["clicked"] += 1 if outcome.get("clicked_banner") else 0
+    for placement, entry in banners.items():
+        entry["rate"] = round(entry["clicked"] / entry["sites"], 4) if entry["sites"] else None
+
+    return {
+        "sites": len(outcomes),
+        "duration": round(duration, 3),
+        "sites_per_hour": round(len(outcomes) / duration * 3600, 1) if duration else None,
+        "errors": sum(1 for o in outcomes if o.get("error")),
+        "timeouts": sum(o.get("timeouts", 0) for o in outcomes),
+        "dropped": sum(o.get("dropped", 0) for o in outcomes),
+        "site_seconds": percentiles([o["duration"] for o in outcomes if "duration" in o]),
+        "phases": {name: percentiles(values) for name, values in sorted(phases.items())},
+        # clicks on sites without a banner are false positives
+        "banners": dict(banners),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Crawl a corpus of synthetic local sites through run_crawl, run from src with python -m benchmark.crawl")
+    parser.add_argument("--sites", type=int, default=50)
+    parser.add_argument("--fanout", type=int, default=10, help="third parties requested per site")
+    parser.add_argument("--banner-rate", type=float, default=.6)
+    parser.add_argument("--iframe-rate", type=float, default=.3, help="share of the banners placed in an iframe")
+    parser.add_argument("--slow-rate", type=float, default=.2, help="share of sites with slow resources")
+    parser.add_argument("--slow-ms", type=int, default=3000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--container", type=int, default=None, help="fixed number of containers, default from config")
+    parser.add_argument("--orchestrator", choices=["process", "async"], default=conf["crawler"].get("orchestrator", "process"))
+    parser.add_argument("--server-image", default="python:3.11-slim")
+    args = parser.parse_args()
+    init_logger("Crawler", conf, verbose=True)
+
+    out = Path(conf["output"].get("data_path", "data")) / "benchmark" / "crawl"
+    rm_folder(out)
+    manifest = generate_corpus(out / "corpus", n_sites=args.sites, fanout=args.fanout, banner_rate=args.banner_rate,
+                               iframe_rate=args.iframe_rate, slow_rate=args.slow_rate, slow_ms=args.slow_ms, seed=args.seed)
+
+    client = setup_docker()
+    check_images(client, [conf["docker"].get("crawler_image", "chrome-crawler"),
+                          conf["docker"].get("tcpdump_image", "kaazing/tcpdump"), args.server_image])
+    server, server_ip = start_server(client, out / "corpus", args.server_image)
+    try:
+        configure(server_ip, orchestrator=args.orchestrator, n_container=args.container)
+        logs.info(f"Benchmark {len(manifest['sites'])} sites served by {server_ip}")
+        start = time.time()
+        outcomes = crawl([f"http://{site}/" for site in manifest["sites"]], out, args.orchestrator)
+        duration = time.time() - start
+    finally:
+        server.stop()
+
+    result = report(outcomes, manifest, duration)
+    result["parameters"] = dict(vars(args), n_container=conf["docker"].get("n_container"),
+                                adaptive=conf["docker"].get("adaptive"))
+    path = save_result("crawl", result)
+
+    print(f"{result['sites']} sites in {result['duration']:.0f} s, {result['sites_per_hour']} sites/h, "
+          f"{result['errors']} errors, {result['timeouts']} timeouts")
+    for placement, entry in sorted(result["banners"].items()):
+        print(f"banner {placement}: clicked {entry['clicked']}/{entry['sites']}")
+    previous = previous_result("crawl", before=path)
+    if previous:
+        keys = ["sites_per_hour", "site_seconds.p50", "site_seconds.p90"] + \
+            [f"phases.{name}.p50" for name in result["phases"]]
+        print(f"Change to the previous run: {compare(result, previous, keys)}")
+    print(f"Result at {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import logging
+import tempfile
+import time
+from typing import Callable, Dict
+import config
+from benchmark.results import compare, previous_result, save_result
+from utils.utility import init_logger, stop_logger
+
+conf = config.load_config()
+
+
+def per_call(log: Callable, calls: int, repeat=3) -> Dict:
+    """Best time of repeat loops of calls, in nanoseconds per call on the calling thread"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(calls):
+            log("Resource %s of %s", i, "www.example.com")
+        times.append(time.perf_counter() - start)
+    return {"ns": round(min(times) / calls * 1e9, 1), "runs": [round(t, 6) for t in times]}
+
+
+def file_logger(name, path) -> logging.Logger:
+    """Logger writing to its file on the calling thread, as before the queue listener"""
+    logs = logging.getLogger(name)
+    logs.setLevel(logging.INFO)
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('[%(name)s / %(levelname)s] %(asctime)s: %(message)s', '%d.%m.%Y %H:%M:%S'))
+    logs.addHandler(handler)
+    return logs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cost of a log call on the calling thread at level INFO, run from src with python -m benchmark.log_overhead")
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=.2,
+                        help="relative slowdown to the previous run which is reported as regression")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conf["logging"]["level"] = "INFO"
+        conf["logging"]["directory"] = tmp
+        queued = init_logger("LogBenchmark", conf, verbose=True)
+        direct = file_logger("LogBenchmarkFile", f"{tmp}/direct.log")
+
+        calls = {
+            # below the level, the call returns after the level check
+            "debug_filtered": queued.debug,
+            # record enqueued for the listener thread, which formats and writes it
+            "info_queued": queued.info,
+            # same call site over its burst, dropped by the rate limit
+            "warning_limited": queued.warning,
+            "info_file": direct.info,
+        }
+        result = {"parameters": vars(args), "calls": {}}
+        for name, log in calls.items():
+            result["calls"][name] = per_call(log, args.calls, args.repeat)
+            print(f"{name:<16} {result['calls'][name]['ns']:>10.1f} ns/call")
+
+        # the listener writes the backlog of the queued calls, waiting for it shows whether it keeps up
+        start = time.perf_counter()
+        stop_logger("LogBenchmark")
+        result["drain_seconds"] = round(time.perf_counter() - start, 6)
+        for logs in (queued, direct):
+            for handler in logs.handlers:
+                handler.close()
+
+    path = save_result("logging", result)
+    previous = previous_result("logging", before=path)
+    if previous:
+        changes = compare(result, previous, [f"calls.{name}.ns" for name in result["calls"]])
+        regressions = {k: v for k, v in changes.items() if v > args.tolerance}
+        print(f"Regressions over {args.tolerance:.0%} to the previous run: {regressions or 'none'}")
+    print(f"Drained the queue in {result['drain_seconds']:.3f} s, result at {path}")
+
+
+if __name__ == "__main__":
+    main()
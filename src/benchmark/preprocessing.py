@@ -0,0 +1,126 @@
+import argparse
+import gc
+import json
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict
+import adblock
+import preprocess
+from benchmark.captures import filter_rules, synthetic_capture
+from benchmark.results import compare, previous_result, save_result
+from preprocess import (add_tcp, collect_data, collect_settings, conf, create_resources, final, get_resources,
+                        label_resources, preprocess_study)
+
+WEBSITE = "www.example.com"
+STUDY = "before accept"
+
+
+def measure(setup: Callable, stage: Callable, repeat=3, trace=True) -> Dict:
+    """Best wall time of repeat runs and the allocation peak of one traced run.
+
+    setup builds fresh arguments for every run and is not measured.
+    """
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        start = time.perf_counter()
+        stage(*args)
+        times.append(time.perf_counter() - start)
+
+    result = {"seconds": round(min(times), 6), "runs": [round(t, 6) for t in times]}
+    if trace:
+        args = setup()
+        gc.collect()
+        tracemalloc.start()
+        stage(*args)
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def run_scale(n_packets, engine, repeat=3, trace=True, seed=0) -> Dict:
+    start = time.perf_counter()
+    data = synthetic_capture(n_packets, WEBSITE, seed=seed)
+    result = {"packets": len(data), "generate_seconds": round(time.perf_counter() - start, 3), "stages": {}}
+    stages = result["stages"]
+    collect, cast = collect_settings()
+
+    def resources():
+        return create_resources(data, WEBSITE, STUDY)
+
+    stages["get_resources"] = measure(lambda: (data, WEBSITE, STUDY), get_resources, repeat, trace)
+    stages["add_tcp"] = measure(lambda: (data, get_resources(data, WEBSITE, STUDY)[0]), add_tcp, repeat, trace)
+    stages["create_resources"] = measure(lambda: (data, WEBSITE, STUDY), create_resources, repeat, trace)
+    stages["label_resources"] = measure(lambda: (resources(), engine), label_resources, repeat, trace)
+    stages["collect_data"] = measure(lambda: (resources(), data, collect, cast), collect_data, repeat, trace)
+
+    labelled = resources()
+    label_resources(labelled, engine)
+    collect_data(labelled, data, collect, cast)
+    rows = [r.__dict__ for r in labelled]
+    result["resources"] = len(rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        stages["final"] = measure(lambda: (rows, Path(tmp) / "resources.csv"), final, repeat, trace)
+
+        # end to end from a capture.json in a study folder, as after tshark
+        study = Path(tmp) / WEBSITE / "0000000000" / STUDY
+        study.mkdir(parents=True)
+        capture = study / conf["preprocess"].get("capture", "capture.json")
+        text = json.dumps(data)
+        data = None
+
+        def write_capture():
+            capture.write_text(text)
+            return study, engine
+        stages["preprocess_study"] = measure(write_capture, preprocess_study, repeat, trace)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the preprocessing stages on synthetic captures, run from src with python -m benchmark.preprocessing")
+    parser.add_argument("--scales", default="10000,100000,1000000",
+                        help="comma separated packet counts, up to 10000000 given enough memory")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-trace", action="store_true", help="skip the tracemalloc run of every stage")
+    parser.add_argument("--tolerance", type=float, default=.2,
+                        help="relative slowdown to the previous run which is reported as regression")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # the capture is already there, tshark isn't run and nothing is profiled
+    conf["preprocess"]["mode"] = "full"
+    conf["preprocess"]["override"] = "false"
+    conf["preprocess"]["keep_capture"] = "false"
+    conf["preprocess"]["profile"] = "0"
+    preprocess.logs.disabled = True
+
+    filterset = adblock.FilterSet()
+    filterset.add_filters(filter_rules())
+    engine = adblock.Engine(filterset)
+
+    result = {"parameters": vars(args), "scales": {}}
+    for n_packets in [int(n) for n in args.scales.split(",")]:
+        print(f"{n_packets} packets")
+        scale = run_scale(n_packets, engine, args.repeat, not args.no_trace, args.seed)
+        result["scales"][str(n_packets)] = scale
+        for name, stage in scale["stages"].items():
+            peak = f", peak {stage['peak_bytes'] / 1e6:.1f} MB" if "peak_bytes" in stage else ""
+            print(f"  {name:<18} {stage['seconds']:>10.3f} s{peak}")
+
+    path = save_result("preprocess", result)
+    previous = previous_result("preprocess", before=path)
+    if previous:
+        keys = [f"scales.{n}.stages.{name}.{metric}" for n, scale in result["scales"].items()
+                for name in scale["stages"] for metric in ("seconds", "peak_bytes")]
+        changes = compare(result, previous, keys)
+        regressions = {k: v for k, v in changes.items() if v > args.tolerance}
+        print(f"Regressions over {args.tolerance:.0%} to the previous run: {regressions or 'none'}")
+    print(f"Result at {path}")
+
+
+if __name__ == "__main__":
+    main()
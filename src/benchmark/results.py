@@ -0,0 +1,68 @@
+import os
+import platform
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+import config
+from utils.utility import create_folder, load_json, write_json
+
+conf = config.load_config()
+
+
+def percentiles(values: List[float], qs=(50, 90, 99)) -> Dict:
+    """Nearest rank percentiles, mean and max of a list of values"""
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {f"p{q}": round(values[min(len(values) - 1, max(0, -(-q * len(values) // 100) - 1))], 6)
+              for q in qs}
+    result["mean"] = round(sum(values) / len(values), 6)
+    result["max"] = round(values[-1], 6)
+    result["count"] = len(values)
+    return result
+
+
+def environment() -> Dict:
+    """Revision and host of a run, so results are only compared on the same footing"""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                  text=True, cwd=config.PROJECT).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {"revision": revision, "host": platform.node(), "cpus": os.cpu_count(),
+            "python": platform.python_version()}
+
+
+def results_dir() -> Path:
+    return Path(conf["output"].get("data_path", "data")) / "benchmark"
+
+
+def save_result(name, result: Dict) -> Path:
+    path = results_dir() / f"{name}-{datetime.now().strftime('%Y-%m-%d-%H%M%S')}.json"
+    create_folder(path.parent)
+    write_json(dict(result, environment=environment()), path)
+    return path
+
+
+def previous_result(name, before: Path = None) -> Dict:
+    """Latest stored result of a benchmark, excluding the one at before"""
+    paths = [p for p in sorted(results_dir().glob(f"{name}-*.json")) if p != before]
+    return load_json(paths[-1]) if paths else None
+
+
+def compare(current: Dict, previous: Dict, keys: List[str]) -> Dict:
+    """Relative change of the numeric values at dotted keys, e.g. 'phases.page_load.p50'"""
+    def lookup(result, key):
+        for part in key.split("."):
+            if not isinstance(result, dict) or part not in result:
+                return None
+            result = result[part]
+        return result
+
+    changes = {}
+    for key in keys:
+        new, old = lookup(current, key), lookup(previous, key)
+        if isinstance(new, (int, float)) and isinstance(old, (int, float)) and old:
+            changes[key] = round((new - old) / old, 4)
+    return changes
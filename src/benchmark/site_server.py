@@ -0,0 +1,78 @@
+import json
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Serves the synthetic sites of a benchmark corpus by their Host header.
+# Runs inside a plain python container, so only the standard library is used.
+
+PIXEL = bytes.fromhex("47494638396101000100800000ffffff00000021f90401000000002c00000000010001000002024401003b")
+
+BANNER = """<div id="cookie-banner" style="position:fixed;bottom:0;width:100%;background:#eee">
+<p>We use cookies to improve your experience.</p>
+<button onclick="document.cookie='consent=1; path=/';this.parentNode.remove()">{text}</button>
+</div>"""
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{host}</title>{head}</head>
+<body><h1>{host}</h1>{body}</body></html>"""
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    manifest = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, content_type, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        host = (self.headers.get("Host") or "").split(":")[0]
+        path = self.path.split("?")[0]
+        site = self.manifest["sites"].get(host)
+
+        if path.startswith("/slow/"):
+            delay = int(path.split("/")[2].split(".")[0])
+            time.sleep(delay / 1000)
+            return self._send(200, "application/javascript", b"void 0;")
+        if path == "/pixel.gif":
+            return self._send(200, "image/gif", PIXEL)
+        if path == "/script.js":
+            return self._send(200, "application/javascript",
+                              b"document.cookie='uid='+Math.random().toString(36).slice(2)+'; path=/';")
+        if site and path == "/":
+            return self._send(200, "text/html; charset=utf-8", self.index(host, site).encode())
+        if site and path == "/banner.html":
+            body = BANNER.format(text=site["banner_text"])
+            return self._send(200, "text/html; charset=utf-8", PAGE.format(host=host, head="", body=body).encode())
+        self._send(404, "text/plain", b"not found")
+
+    def index(self, host, site):
+        head = "".join(f'<script src="http://{tp}/script.js?site={host}"></script>' for tp in site["scripts"])
+        body = [f"<p>{'Lorem ipsum dolor sit amet. ' * 40}</p>" for _ in range(site["paragraphs"])]
+        body.extend(f'<img src="http://{tp}/pixel.gif?site={host}&i={i}" width="1" height="1">'
+                    for i, tp in enumerate(site["pixels"]))
+        body.extend(f'<script src="/slow/{delay}.js" async></script>' for delay in site["slow"])
+        if site["banner"] == "main":
+            body.append(BANNER.format(text=site["banner_text"]))
+        elif site["banner"] == "iframe":
+            body.append('<iframe src="/banner.html" title="cookie consent" width="600" height="200"></iframe>')
+        return PAGE.format(host=host, head=head, body="\n".join(body))
+
+
+def main(manifest_path, port=80):
+    with open(manifest_path) as f:
+        SiteHandler.manifest = json.load(f)
+    server = ThreadingHTTPServer(("", port), SiteHandler)
+    print(f"Serving {len(SiteHandler.manifest['sites'])} sites on port {port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 80)
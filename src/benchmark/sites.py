@@ -0,0 +1,43 @@
+import random
+import shutil
+from pathlib import Path
+from typing import Dict
+from utils.utility import create_folder, write_json
+
+SERVER = Path(__file__).parent / "site_server.py"
+
+
+def generate_corpus(path, n_sites=50, fanout=10, n_third_parties=20, banner_rate=.6, iframe_rate=.3,
+                    slow_rate=.2, slow_ms=3000, banner_text="accept", seed=0) -> Dict:
+    """Write the manifest of a synthetic corpus and the server rendering it.
+
+    Every site requests up to fanout third parties as scripts and pixels, shows
+    a cookie banner in the main document or an iframe with the given rates and
+    loads some resources which are answered after slow_ms milliseconds.
+    """
+    rng = random.Random(seed)
+    third_parties = [f"tracker-{i:03d}.net" for i in range(n_third_parties)]
+
+    sites = {}
+    for i in range(n_sites):
+        requested = rng.sample(third_parties, min(fanout, len(third_parties)))
+        n_scripts = len(requested) // 3
+        banner = None
+        if rng.random() < banner_rate:
+            banner = "iframe" if rng.random() < iframe_rate else "main"
+        sites[f"site-{i:04d}.com"] = {
+            "scripts": requested[:n_scripts],
+            "pixels": requested[n_scripts:],
+            "banner": banner,
+            "banner_text": banner_text,
+            "slow": [rng.randint(slow_ms // 2, slow_ms) for _ in range(rng.randint(1, 3))] if rng.random() < slow_rate else [],
+            "paragraphs": rng.randint(5, 30),
+        }
+
+    manifest = {"seed": seed, "fanout": fanout, "banner_rate": banner_rate, "iframe_rate": iframe_rate,
+                "slow_rate": slow_rate, "slow_ms": slow_ms, "third_parties": third_parties, "sites": sites}
+    path = Path(path)
+    create_folder(path)
+    write_json(manifest, path / "manifest.json")
+    shutil.copy(SERVER, path / SERVER.name)
+    return manifest
@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+from typing import Dict
+
+logs = logging.getLogger("Crawler")
+
+
+def cpu_times():
+    """Busy and total jiffies of all cpus"""
+    with open("/proc/stat") as f:
+        values = [int(v) for v in f.readline().split()[1:]]
+    idle = values[3] + values[4]  # idle + iowait
+    return sum(values) - idle, sum(values)
+
+
+def memory_usage():
+    """Fraction of used memory of the host"""
+    meminfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0])
+    return 1 - meminfo["MemAvailable"] / meminfo["MemTotal"]
+
+
+class HostMonitor:
+    """Samples cpu and memory usage of the host between two calls"""
+
+    def __init__(self) -> None:
+        self.last = self._cpu_times()
+
+    def _cpu_times(self):
+        try:
+            return cpu_times()
+        except OSError:
+            return None
+
+    def cpu(self):
+        current = self._cpu_times()
+        if current is None or self.last is None:
+            # no procfs, fall back to the load average
+            return os.getloadavg()[0] / os.cpu_count()
+
+        busy, total = current[0] - self.last[0], current[1] - self.last[1]
+        self.last = current
+        return busy / total if total else 0.
+
+    def memory(self):
+        try:
+            return memory_usage()
+        except (OSError, KeyError):
+            return 0.
+
+
+class ConcurrencyController:
+    """Adapts the number of concurrent crawls to the load of the host.
+
+    Additive increase while the host has spare resources and every slot is
+    busy, multiplicative decrease on overload, i.e. cpu or memory above their
+    target, too many page load timeouts or packets dropped by tcpdump.
+    """
+
+    def __init__(self, minimum: int, maximum: int, start: int = None, cpu_target: float = .85,
+                 memory_target: float = .85, timeout_rate: float = .2, interval: float = 60, adaptive: bool = True) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(self.maximum, max(self.minimum, start or self.minimum))
+        self.cpu_target = cpu_target
+        self.memory_target = memory_target
+        self.timeout_rate = timeout_rate
+        self.interval = interval
+        self.adaptive = adaptive
+
+        self.monitor = HostMonitor()
+        self.start = time.time()
+        self.last_update = self.start
+        self.finished = 0
+        self.window = {"sites": 0, "timeouts": 0, "dropped": 0}
+
+    @classmethod
+    def from_config(cls, section):
+        n_container = section.getint("n_container", 5)
+        if not section.getboolean("adaptive", False):
+            return cls(n_container, n_container, adaptive=False)
+
+        return cls(section.getint("min_container", 1),
+                   section.getint("max_container", n_container),
+                   start=n_container,
+                   cpu_target=section.getfloat("cpu_target", .85),
+                   memory_target=section.getfloat("memory_target", .85),
+                   timeout_rate=section.getfloat("timeout_rate", .2),
+                   interval=section.getfloat("adapt_interval", 60))
+
+    def record(self, outcome: Dict):
+        """Account the outcome of a finished website crawl"""
+        self.finished += 1
+        self.window["sites"] += 1
+        self.window["timeouts"] += 1 if outcome.get("timeouts", 0) else 0
+        self.window["dropped"] += outcome.get("dropped", 0)
+
+    def update(self, running: int) -> int:
+        """Adjust the limit once per interval, returns the current limit"""
+        now = time.time()
+        if not self.adaptive or now - self.last_update < self.interval:
+            return self.limit
+
+        cpu, memory = self.monitor.cpu(), self.monitor.memory()
+        sites = self.window["sites"]
+        timeout_rate = self.window["timeouts"] / sites if sites else 0.
+        dropped = self.window["dropped"]
+
+        previous = self.limit
+        if cpu > self.cpu_target or memory > self.memory_target or timeout_rate > self.timeout_rate or dropped > 0:
+            self.limit = max(self.minimum, min(self.limit - 1, int(self.limit * .75)))
+        elif running >= self.limit and cpu < .8 * self.cpu_target and memory < .9 * self.memory_target:
+            self.limit = min(self.maximum, self.limit + 1)
+
+        hours = (now - self.start) / 3600
+        window_hours = (now - self.last_update) / 3600
+        logs.info(f"Concurrency {previous} -> {self.limit} (cpu={cpu:.2f}, memory={memory:.2f}, "
+                  f"timeout_rate={timeout_rate:.2f}, dropped={dropped}), "
+                  f"throughput {sites / window_hours:.0f} sites/h (total {self.finished / hours:.0f} sites/h)")
+
+        self.last_update = now
+        self.window = {"sites": 0, "timeouts": 0, "dropped": 0}
+        return self.limit
@@ -1,3 +1,4 @@
+import ast
 import configparser
 import os
 from pathlib import Path
@@ -6,19 +7,51 @@ SRC = Path(__file__).parent
 PROJECT = SRC.parent
 CONFIG_PATH = PROJECT / 'config.ini'
 
+# relative paths of the configuration are resolved against the project
+CWD = Path.cwd()
 os.chdir(PROJECT)
 
+# parsed once per process, every module shares the same configuration
+_configs = {}
 
-def load_config(path=CONFIG_PATH):
-    path = Path(path)
-    if not path.is_file():
-        print(f"No config file found at {path}")
-        exit()
+# names allowed as values of the cast option
+CASTS = {"int": int, "float": float, "str": str, "bool": bool}
+
+
+def load_config(path=None):
+    path = Path(path or CONFIG_PATH)
+    if path not in _configs:
+        if not path.is_file():
+            print(f"No config file found at {path}")
+            exit()
+
+        config = configparser.ConfigParser()
+        config.read(path)
+        _configs[path] = config
+    return _configs[path]
 
-    CONFIG_PATH = path
-    config = configparser.ConfigParser()
-    config.read(path)
-    return config
 
 def todict(config):
-    return {section: dict(config[section]) for section in config.sections()}
\ No newline at end of file
+    return {section: dict(config[section]) for section in config.sections()}
+
+
+def install(values, path=None):
+    """Apply the configuration of the parent process in a worker, including changes made at runtime"""
+    load_config(path).read_dict(values)
+
+
+def literal(value, default=None):
+    """Python literal of an option, e.g. a list of filter lists or a dict of fields to collect"""
+    if not value:
+        return default
+    return ast.literal_eval(value)
+
+
+def casts(value):
+    """Dict of field name to type, e.g. {'sizes': int}, without evaluating arbitrary code"""
+    if not value:
+        return {}
+    node = ast.parse(value, mode="eval").body
+    if not isinstance(node, ast.Dict):
+        raise ValueError(f"Expected a dict of casts, got {value}")
+    return {ast.literal_eval(k): CASTS[v.id] for k, v in zip(node.keys, node.values)}
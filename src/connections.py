@@ -0,0 +1,197 @@
+from typing import Dict, List, Tuple
+from tld import get_fld
+from resource import resource
+from utils.utility import sha3
+
+# fields needed to attribute connections to hostnames
+FIELDS = [
+    "frame.number",
+    "frame.time_epoch",
+    "ip.src",
+    "ip.dst",
+    "tcp.stream",
+    "tcp.srcport",
+    "tcp.dstport",
+    "tls.handshake.extensions_server_name",
+    "dns.flags.response",
+    "dns.qry.name",
+    "dns.a",
+    "dns.aaaa",
+]
+
+
+def tshark_fields(collect: Dict) -> List[str]:
+    """Fields to extract, including the ones configured to be collected"""
+    return FIELDS + [field for field in collect.values() if field not in FIELDS]
+
+
+def tshark_args(fields: List[str]) -> List[str]:
+    args = ["-T", "fields", "-E", "separator=/t", "-E", "aggregator=,", "-E", "occurrence=a"]
+    for field in fields:
+        args.extend(["-e", field])
+    return args
+
+
+def parse_rows(lines, fields) -> List[Dict]:
+    """One dict per frame, missing fields are None"""
+    rows = []
+    for line in lines:
+        values = line.rstrip("\n").split("\t")
+        rows.append({field: value or None for field, value in zip(fields, values)})
+    return rows
+
+
+def is_local(ip) -> bool:
+    return ip is not None and ip.startswith("172.17")
+
+
+def is_response(row) -> bool:
+    # tshark prints booleans as 1/0 or True/False depending on its version
+    return row["dns.flags.response"] in ("1", "True")
+
+
+def resolve_dns(rows) -> Dict[str, str]:
+    """Map every answered ip to the queried hostname"""
+    hostnames = {}
+    for row in rows:
+        if not row["dns.qry.name"] or not is_response(row):
+            continue
+        hostname = row["dns.qry.name"].split(",")[0]
+        for field in ("dns.a", "dns.aaaa"):
+            for ip in (row[field] or "").split(","):
+                if ip:
+                    hostnames[ip] = hostname
+    return hostnames
+
+
+def group_connections(rows) -> Dict[str, Dict]:
+    """Remote endpoint, frames and SNI of every TCP stream"""
+    connections = {}
+    for row in rows:
+        tcp_id = row["tcp.stream"]
+        if tcp_id is None:
+            continue
+
+        frame_nr = int(row["frame.number"])
+        connection = connections.get(tcp_id)
+        if connection is None:
+            outgoing = is_local(row["ip.src"])
+            connection = {
+                "ip": row["ip.dst"] if outgoing else row["ip.src"],
+                "port": row["tcp.dstport"] if outgoing else row["tcp.srcport"],
+                "start": frame_nr,
+                "packets": [],
+                "sni": None,
+            }
+            connections[tcp_id] = connection
+
+        connection["packets"].append(frame_nr)
+        sni = row["tls.handshake.extensions_server_name"]
+        if sni and not connection["sni"]:
+            connection["sni"] = sni
+    return connections
+
+
+def create_connections(rows, website_call, study_name) -> List[resource]:
+    """One resource per TCP connection, named by its SNI or the DNS answer of its remote ip"""
+    hostnames = resolve_dns(rows)
+    resources = []
+    for tcp_id, connection in group_connections(rows).items():
+        ip_addr = connection["ip"]
+        hostname = connection["sni"] or hostnames.get(ip_addr) or ip_addr
+        scheme = "http" if connection["port"] == "80" else "https"
+        communication_id = sha3(str((website_call, study_name, ip_addr)))
+        connection_id = sha3(str((website_call, study_name, ip_addr, tcp_id)))
+
+        r = resource(connection_id, communication_id, connection_id, f"{scheme}://{hostname}/", ip_addr,
+                     "tls" if scheme == "https" else "tcp", None, website_call, connection["start"])
+        r.packets = connection["packets"]
+        resources.append(r)
+
+    return resources
+
+
+def match_connection(candidates, times, time) -> Tuple[str, Dict]:
+    """Connection of an endpoint carrying a request sent at time.
+
+    The connection open at that time, else the first one opened afterwards
+    (the request triggered it), else the last one before.
+    """
+    opened = [(tcp_id, c) for tcp_id, c in candidates if times[c["start"] - 1] <= time]
+    for tcp_id, c in reversed(opened):
+        if times[c["packets"][-1] - 1] >= time:
+            return tcp_id, c
+    later = [(tcp_id, c) for tcp_id, c in candidates if times[c["start"] - 1] > time]
+    if later:
+        return later[0]
+    return opened[-1]
+
+
+def join_requests(requests, rows, website_call, study_name) -> Tuple[List[resource], int]:
+    """One resource per request of the browser's network log, with the frames of its connection.
+
+    Requests are matched to a TCP stream by remote ip and port, and get the
+    frames between their start and the next request on the same stream.
+    Multiplexed HTTP/2 requests therefore share their frames only approximately.
+    Returns the resources and the number of requests without a connection,
+    e.g. cached or QUIC requests.
+    """
+    endpoints = {}
+    for tcp_id, connection in group_connections(rows).items():
+        endpoints.setdefault((connection["ip"], connection["port"]), []).append((tcp_id, connection))
+
+    times = [float(row["frame.time_epoch"] or 0) for row in rows]
+    joined = {}
+    unmatched = 0
+    for request in requests:
+        key = (request.get("remote_ip"), str(request.get("remote_port")))
+        if request.get("from_cache") or key not in endpoints or request.get("time") is None:
+            unmatched += 1
+            continue
+        tcp_id, connection = match_connection(endpoints[key], times, request["time"])
+        joined.setdefault(tcp_id, (connection, []))[1].append(request)
+
+    resources = []
+    for tcp_id, (connection, stream_requests) in joined.items():
+        stream_requests.sort(key=lambda r: r["time"])
+        ends = [r["time"] for r in stream_requests[1:]] + [float("inf")]
+        ip_addr = connection["ip"]
+        communication_id = sha3(str((website_call, study_name, ip_addr)))
+        connection_id = sha3(str((website_call, study_name, ip_addr, tcp_id)))
+
+        for request, end in zip(stream_requests, ends):
+            packets = [nr for nr in connection["packets"] if request["time"] <= times[nr - 1] < end]
+            # a request sent before its connection was opened gets the frames from the start
+            packets = packets or [nr for nr in connection["packets"] if times[nr - 1] < end]
+            if not packets:
+                packets = connection["packets"]
+
+            resource_id = sha3(str((website_call, study_name, ip_addr, tcp_id, request["request_id"], request["url"])))
+            protocol = "http2" if request.get("protocol") == "h2" else "http"
+            r = resource(resource_id, communication_id, connection_id, request["url"], ip_addr,
+                         protocol, request["method"], website_call, packets[0])
+            r.packets = packets
+            r.content = request.get("mime_type")
+            resources.append(r)
+
+    return resources, unmatched
+
+
+def find_first_party(resources, website_call):
+    """Hostname of the first connection within the domain of the called website"""
+    domain = get_fld(website_call, fix_protocol=True)
+    for r in sorted(resources, key=lambda r: r.start):
+        if r.hostname == domain:
+            return r.url.split("/")[2], r.ip
+    return website_call, None
+
+
+def collect_fields(resources, rows, to_collect, cast={}):
+    """Counterpart of collect_data for rows of tshark fields"""
+    for k, v in to_collect.items():
+        fn = cast.get(k)
+        for r in resources:
+            collected = [rows[idx - 1][v] for idx in r.packets]
+            if fn:
+                collected = [fn(attr) for attr in collected]
+            r.__setattr__(k, collected)
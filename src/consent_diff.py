@@ -0,0 +1,102 @@
+import csv
+from typing import Dict, Iterable, List
+from urllib.parse import urlsplit
+
+BEFORE = "before accept"
+AFTER = "after accept"
+
+FIELDS = ["website_call", "hosts_before", "hosts_after", "new_hosts", "dropped_hosts", "new_tracker_hosts",
+          "urls_before", "urls_after", "new_urls", "new_tracker_urls", "new_connections",
+          "requests_before", "requests_after", "bytes_before", "bytes_after", "bytes_delta",
+          "tracker_bytes_before", "tracker_bytes_after", "tracker_bytes_delta",
+          "new_host_names", "new_tracker_host_names"]
+# hostnames of the list fields are joined by the delimiter in the table
+LIST_FIELDS = ["new_host_names", "new_tracker_host_names"]
+DELIMITER = ";"
+
+
+def normalize_url(url: str) -> str:
+    """Host and path of a url, query and fragment differ between calls of the same resource"""
+    parts = urlsplit(url)
+    return f"{parts.netloc.lower()}{parts.path or '/'}"
+
+
+class StudyIndex:
+    """Hostnames, connections and normalized urls of the resources of one study"""
+
+    def __init__(self, resources: Iterable[Dict]) -> None:
+        self.hosts = {}
+        self.urls = {}
+        self.connections = set()
+        for r in resources:
+            size = sum(r.get("sizes") or ())
+            host = self.hosts.setdefault(r["hostname"], {"requests": 0, "bytes": 0, "trackers": 0, "tracker_bytes": 0})
+            host["requests"] += 1
+            host["bytes"] += size
+            if r.get("is_tracker"):
+                host["trackers"] += 1
+                host["tracker_bytes"] += size
+            url = normalize_url(r["url"])
+            self.urls[url] = self.urls.get(url, False) or bool(r.get("is_tracker"))
+            # connection ids contain the study, endpoints are comparable between studies
+            self.connections.add((r["hostname"], r.get("ip")))
+
+    def total(self, key) -> int:
+        return sum(host[key] for host in self.hosts.values())
+
+    def tracker_hosts(self):
+        return {name for name, host in self.hosts.items() if host["trackers"]}
+
+
+def diff_studies(website_call, before: StudyIndex, after: StudyIndex) -> Dict:
+    new_hosts = sorted(after.hosts.keys() - before.hosts.keys())
+    new_tracker_hosts = sorted(after.tracker_hosts() - before.tracker_hosts())
+    new_urls = after.urls.keys() - before.urls.keys()
+    row = {"website_call": website_call,
+           "hosts_before": len(before.hosts), "hosts_after": len(after.hosts),
+           "new_hosts": len(new_hosts), "dropped_hosts": len(before.hosts.keys() - after.hosts.keys()),
+           "new_tracker_hosts": len(new_tracker_hosts),
+           "urls_before": len(before.urls), "urls_after": len(after.urls), "new_urls": len(new_urls),
+           "new_tracker_urls": sum(after.urls[url] for url in new_urls),
+           "new_connections": len(after.connections - before.connections),
+           "new_host_names": new_hosts, "new_tracker_host_names": new_tracker_hosts}
+    for key in ("requests", "bytes", "tracker_bytes"):
+        row[f"{key}_before"] = before.total(key)
+        row[f"{key}_after"] = after.total(key)
+    row["bytes_delta"] = row["bytes_after"] - row["bytes_before"]
+    row["tracker_bytes_delta"] = row["tracker_bytes_after"] - row["tracker_bytes_before"]
+    return row
+
+
+def diff_site(resources: List[Dict]) -> List[Dict]:
+    """Delta of every website call of a site which has both studies, one pass over its resources"""
+    studies = {}
+    for r in resources:
+        studies.setdefault(r["website_call"], {}).setdefault(r["study_name"], []).append(r)
+    return [diff_studies(website_call, StudyIndex(calls[BEFORE]), StudyIndex(calls[AFTER]))
+            for website_call, calls in studies.items() if BEFORE in calls and AFTER in calls]
+
+
+class DeltaWriter:
+    """Delta table which grows row by row as sites finish, closed on exit of its with block"""
+
+    def __init__(self, path) -> None:
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+        self.writer.writeheader()
+        self.rows = 0
+
+    def write(self, rows: List[Dict]):
+        self.writer.writerows(dict(row, **{field: DELIMITER.join(row[field]) for field in LIST_FIELDS})
+                              for row in rows)
+        self.file.flush()
+        self.rows += len(rows)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
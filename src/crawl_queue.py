@@ -0,0 +1,154 @@
+import json
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List
+from utils.utility import create_folder
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class CrawlQueue(ABC):
+    """Work queue shared by several crawler nodes.
+
+    Websites are handed out with time-limited leases. A lease which is neither
+    completed nor failed before it expires is handed out again, failures are
+    retried with exponential backoff until max_attempts is reached.
+    Backends implement this interface and register in BACKENDS.
+    """
+
+    def __init__(self, max_attempts: int = 3, backoff: float = 60) -> None:
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    @abstractmethod
+    def add(self, websites: List[str]) -> int:
+        """Add websites which are not queued yet, returns the number of new entries"""
+
+    @abstractmethod
+    def lease(self, owner: str, n: int, duration: float) -> List[str]:
+        """Lease up to n websites for duration seconds"""
+
+    @abstractmethod
+    def complete(self, website: str, owner: str, result: Dict = None) -> bool:
+        """Mark a leased website as done, returns False if the lease was lost"""
+
+    @abstractmethod
+    def fail(self, website: str, owner: str, error: str) -> bool:
+        """Release a leased website for a retry, returns False if the lease was lost"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, int]:
+        """Number of websites per state"""
+
+    def is_finished(self) -> bool:
+        stats = self.stats()
+        return stats.get(PENDING, 0) == 0 and stats.get(LEASED, 0) == 0
+
+    def retry_delay(self, attempts: int) -> float:
+        return self.backoff * 2 ** max(0, attempts - 1)
+
+
+class SQLiteQueue(CrawlQueue):
+    """Queue backend in a SQLite database, e.g. on a volume shared by the crawler nodes"""
+
+    def __init__(self, path, max_attempts: int = 3, backoff: float = 60) -> None:
+        super().__init__(max_attempts, backoff)
+        self.path = Path(path)
+        create_folder(self.path.parent)
+        self.con = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None)
+        self.con.execute("""CREATE TABLE IF NOT EXISTS queue (
+            website TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            owner TEXT,
+            lease_until REAL,
+            available_at REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            result TEXT)""")
+        self.con.execute(
+            "CREATE INDEX IF NOT EXISTS queue_state ON queue (state, available_at)")
+
+    def add(self, websites):
+        with self._transaction() as cur:
+            before = self.con.total_changes
+            cur.executemany("INSERT OR IGNORE INTO queue (website, state) VALUES (?, ?)",
+                            ((website, PENDING) for website in websites))
+            return self.con.total_changes - before
+
+    def lease(self, owner, n, duration):
+        now = time.time()
+        with self._transaction() as cur:
+            # expired leases count as failed attempts
+            cur.execute("UPDATE queue SET state = ?, error = 'lease expired' WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                        (FAILED, LEASED, now, self.max_attempts))
+            websites = [row[0] for row in cur.execute(
+                """SELECT website FROM queue
+                WHERE (state = ? AND available_at <= ?) OR (state = ? AND lease_until < ?)
+                ORDER BY available_at LIMIT ?""", (PENDING, now, LEASED, now, n))]
+            cur.executemany("UPDATE queue SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1 WHERE website = ?",
+                            ((LEASED, owner, now + duration, website) for website in websites))
+        return websites
+
+    def complete(self, website, owner, result=None):
+        with self._transaction() as cur:
+            cur.execute("UPDATE queue SET state = ?, lease_until = NULL, error = NULL, result = ? WHERE website = ? AND state = ? AND owner = ?",
+                        (DONE, json.dumps(result, default=str), website, LEASED, owner))
+            return cur.rowcount == 1
+
+    def fail(self, website, owner, error):
+        with self._transaction() as cur:
+            row = cur.execute("SELECT attempts FROM queue WHERE website = ? AND state = ? AND owner = ?",
+                              (website, LEASED, owner)).fetchone()
+            if not row:
+                return False
+
+            attempts = row[0]
+            state = FAILED if attempts >= self.max_attempts else PENDING
+            cur.execute("UPDATE queue SET state = ?, lease_until = NULL, available_at = ?, error = ? WHERE website = ?",
+                        (state, time.time() + self.retry_delay(attempts), error, website))
+            return True
+
+    def stats(self):
+        return dict(self.con.execute("SELECT state, COUNT(*) FROM queue GROUP BY state"))
+
+    def _transaction(self):
+        return _Transaction(self.con)
+
+
+class _Transaction:
+    """Write transaction which locks the database on begin, so leases are never handed out twice"""
+
+    def __init__(self, con) -> None:
+        self.con = con
+
+    def __enter__(self):
+        self.cur = self.con.cursor()
+        self.cur.execute("BEGIN IMMEDIATE")
+        return self.cur
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cur.execute("ROLLBACK" if exc_type else "COMMIT")
+        self.cur.close()
+
+
+BACKENDS = {"sqlite": SQLiteQueue}
+
+
+def open_queue(section) -> CrawlQueue:
+    """Create the queue configured in the [queue] section, None if no backend is set"""
+    backend = section.get("backend", "")
+    if not backend:
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown queue backend '{backend}', choose from {list(BACKENDS)}")
+
+    return BACKENDS[backend](section.get("path", "data/queue.sqlite"),
+                             max_attempts=section.getint("max_attempts", 3),
+                             backoff=section.getfloat("backoff", 60))
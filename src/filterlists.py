@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+from urllib.parse import urlparse
+from utils.utility import create_folder, load_json, write_json
+
+logs = logging.getLogger("Preprocessor")
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class FilterListStore:
+    """Dated, content-hashed snapshots of the filter lists and the adblock engines built from them.
+
+    state.json holds the current snapshot of every origin with its ETag and
+    Last-Modified, so updates are conditional requests and unchanged lists
+    are neither stored nor parsed again. A list saved by save_filterlist of
+    earlier versions (<root>/<file name of the url>) becomes the first
+    snapshot of its origin and is removed.
+    """
+
+    def __init__(self, root="lists/block") -> None:
+        self.root = Path(root)
+        create_folder(self.root / "snapshots")
+        create_folder(self.root / "engines")
+        self.state_path = self.root / "state.json"
+        self.state = load_json(self.state_path) or {}
+
+    @staticmethod
+    def name(origin) -> str:
+        return Path(urlparse(origin).path).stem or "filterlist"
+
+    def legacy_path(self, origin) -> Path:
+        """Where save_filterlist stored a downloaded list"""
+        return self.root / Path(urlparse(origin).path).name
+
+    def _seed(self, origin) -> bool:
+        """Snapshot a list saved by earlier versions, so a checkout keeps the rules it used"""
+        legacy = self.legacy_path(origin)
+        if not origin.startswith("http") or not legacy.is_file():
+            return False
+        self._snapshot(origin, legacy.read_bytes(), seeded_from=legacy.as_posix())
+        legacy.unlink()
+        logs.info(f"Moved {legacy} of {origin} into the snapshots")
+        return True
+
+    def _save_state(self):
+        write_json(self.state, self.state_path)
+
+    def _snapshot(self, origin, content: bytes, **headers) -> Dict:
+        digest = sha256(content)
+        current = self.state.get(origin, {})
+        if current.get("sha256") != digest:
+            path = self.root / "snapshots" / self.name(origin) / \
+                f"{datetime.now().strftime('%Y-%m-%d')}-{digest[:12]}.txt"
+            create_folder(path.parent)
+            path.write_bytes(content)
+            current = {"snapshot": path.as_posix(), "sha256": digest}
+            logs.info(f"New snapshot of {origin} at {path}")
+        self.state[origin] = dict(current, fetched=datetime.now().isoformat(timespec="seconds"), **headers)
+        return self.state[origin]
+
+    def fetch(self, origin, timeout=60) -> Dict:
+        """Conditionally fetch an origin, a url or a local file, keeps the current snapshot on failure"""
+        import requests
+        current = self.state.get(origin, {})
+        if not origin.startswith("http"):
+            return self._snapshot(origin, Path(origin).read_bytes())
+
+        headers = {}
+        if current.get("etag"):
+            headers["If-None-Match"] = current["etag"]
+        if current.get("last_modified"):
+            headers["If-Modified-Since"] = current["last_modified"]
+        try:
+            response = requests.get(origin, headers=headers, timeout=timeout)
+            if response.status_code == 304 and current:
+                logs.debug(f"{origin} not modified")
+                current["fetched"] = datetime.now().isoformat(timespec="seconds")
+                return current
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if not current:
+                raise
+            logs.critical(f"Couldn't update {origin}, keep {current['snapshot']} - {e}")
+            return current
+
+        return self._snapshot(origin, response.content, etag=response.headers.get("ETag"),
+                              last_modified=response.headers.get("Last-Modified"))
+
+    def snapshots(self, origins: List[str], update=False) -> Dict:
+        """Snapshot of every origin, the network is only used to update or for missing lists"""
+        for origin in origins:
+            if origin not in self.state and self._seed(origin) and not update:
+                continue
+            if update or origin not in self.state or not Path(self.state[origin]["snapshot"]).is_file():
+                self.fetch(origin)
+        self._save_state()
+        return {origin: self.state[origin] for origin in origins}
+
+    def manifest(self, origins: List[str], update=False) -> Dict:
+        """Snapshots used for a run and the version of the engine built from them"""
+        snapshots = self.snapshots(origins, update)
+        version = sha256("".join(s["sha256"] for s in snapshots.values()).encode())[:16]
+        return {"version": version, "lists": snapshots}
+
+    def engine_path(self, manifest: Dict) -> Path:
+        return self.root / "engines" / f"{manifest['version']}.dat"
+
+    def build_engine(self, manifest: Dict) -> Path:
+        """Parse the snapshots into an engine and serialize it, unless it was built before"""
+        path = self.engine_path(manifest)
+        if not path.is_file():
+            import adblock
+            raw_rules = []
+            for snapshot in manifest["lists"].values():
+                with open(snapshot["snapshot"], errors="replace") as f:
+                    raw_rules.extend(f.read().splitlines())
+            filterset = adblock.FilterSet()
+            filterset.add_filters(raw_rules)
+            adblock.Engine(filterset).serialize_to_file(str(path))
+            logs.info(f"Built adblock engine {manifest['version']} from {len(raw_rules)} rules")
+        return path
+
+
+def load_engine(path):
+    import adblock
+    engine = adblock.Engine(adblock.FilterSet())
+    engine.deserialize_from_file(str(path))
+    return engine
+
+
+if __name__ == "__main__":
+    import config
+    conf = config.load_config()
+    origins = config.literal(conf["preprocess"].get("filterlist"), [])
+    store = FilterListStore(conf["preprocess"].get("filterlist_path", "lists/block"))
+    manifest = store.manifest(origins if isinstance(origins, list) else [origins], update=True)
+    store.build_engine(manifest)
+    print(json.dumps(manifest, indent=4))
@@ -0,0 +1,133 @@
+import logging
+from connections import is_local
+from typing import Dict, Iterable, List
+
+logs = logging.getLogger("Preprocessor")
+
+# dense arrays of the cube, one row per (study_name, website_call, hostname) and one column per time bin
+CHANNELS = ("in_bytes", "out_bytes", "in_packets", "out_packets", "tracker_bytes", "tracker_packets")
+# per row columns of the index
+INDEX = ("study_name", "website_call", "hostname", "first_party", "is_tp")
+TOTALS = ("resources", "trackers", "start", "end")
+
+
+def build_cube(resources: Iterable[Dict], bin_seconds=1., bins=120) -> Dict:
+    """Bytes and packets per time bin, direction and tracker label of every hostname of every study.
+
+    Packets after the last bin are counted in the last bin. A packet shared by
+    several resources of a hostname is counted once per resource, as when the
+    resources are exploded into packets.
+    """
+    import numpy as np
+    rows = {}
+    index = {column: [] for column in INDEX + TOTALS}
+    group_ids, times, sizes, outgoing, tracker = [], [], [], [], []
+    for r in resources:
+        key = (r["study_name"], r["website_call"], r["hostname"])
+        if key not in rows:
+            rows[key] = len(rows)
+            for column, value in zip(INDEX, key + (r["first_party"], r["is_tp"])):
+                index[column].append(value)
+            index["resources"].append(0)
+            index["trackers"].append(0)
+            index["start"].append(float("inf"))
+            index["end"].append(float("-inf"))
+        row = rows[key]
+        index["resources"][row] += 1
+        index["trackers"][row] += bool(r["is_tracker"])
+        if not r["rel_time"]:
+            continue
+        index["start"][row] = min(index["start"][row], min(r["rel_time"]))
+        index["end"][row] = max(index["end"][row], max(r["rel_time"]))
+
+        group_ids.extend([row] * len(r["rel_time"]))
+        times.extend(r["rel_time"])
+        sizes.extend(r["sizes"])
+        outgoing.extend(is_local(ip) for ip in r["ip_src"])
+        tracker.extend([bool(r["is_tracker"])] * len(r["rel_time"]))
+
+    # rows of a study and website are contiguous, so they are answered by a slice
+    order = sorted(range(len(rows)), key=lambda row: (index["study_name"][row], index["website_call"][row],
+                                                      index["hostname"][row]))
+    position = np.empty(len(rows), dtype=np.int64)
+    position[order] = np.arange(len(rows))
+
+    group_ids = position[np.asarray(group_ids, dtype=np.int64)]
+    columns = np.minimum((np.asarray(times, dtype=np.float64) // bin_seconds).astype(np.int64), bins - 1)
+    flat = group_ids * bins + columns
+    sizes = np.asarray(sizes, dtype=np.int64)
+    outgoing = np.asarray(outgoing, dtype=bool)
+    tracker = np.asarray(tracker, dtype=bool)
+
+    def binned(mask, weights=None):
+        counts = np.bincount(flat[mask], None if weights is None else weights[mask], minlength=len(rows) * bins)
+        return counts.astype(np.uint32).reshape(len(rows), bins)
+
+    cube = {"bin_seconds": np.float64(bin_seconds),
+            "in_bytes": binned(~outgoing, sizes), "out_bytes": binned(outgoing, sizes),
+            "in_packets": binned(~outgoing), "out_packets": binned(outgoing),
+            "tracker_bytes": binned(tracker, sizes), "tracker_packets": binned(tracker)}
+    for column in INDEX:
+        cube[column] = np.asarray([index[column][row] for row in order])
+    for column in TOTALS:
+        cube[column] = np.asarray([index[column][row] for row in order],
+                                  dtype=np.float64 if column in ("start", "end") else np.int64)
+    return cube
+
+
+def write_cube(resources: List[Dict], path, bin_seconds=1., bins=120):
+    import numpy as np
+    if not resources or not all(c in resources[0] for c in ("rel_time", "sizes", "ip_src")):
+        logs.warning(f"No flow cube at {path}, collect rel_time, sizes and ip_src of the packets")
+        return None
+    cube = build_cube(resources, bin_seconds, bins)
+    np.savez_compressed(path, **cube)
+    logs.info(f"Flow cube of {len(cube['hostname'])} hostnames and {bins} bins of {bin_seconds} s at {path}")
+    return path
+
+
+class FlowCube:
+    """Traffic flows and communication summaries of the preprocessed resources without the packets"""
+
+    def __init__(self, path) -> None:
+        import numpy as np
+        with np.load(path) as data:
+            self.arrays = {name: data[name] for name in data.files}
+        self.bin_seconds = float(self.arrays["bin_seconds"])
+        self.slices = {}
+        studies, websites = self.arrays["study_name"], self.arrays["website_call"]
+        for row, key in enumerate(zip(studies.tolist(), websites.tolist())):
+            start, _ = self.slices.get(key, (row, row))
+            self.slices[key] = (start, row + 1)
+
+    def rows(self, study_name, website_call) -> slice:
+        return slice(*self.slices.get((study_name, website_call), (0, 0)))
+
+    def times(self):
+        import numpy as np
+        return np.arange(self.arrays["in_bytes"].shape[1]) * self.bin_seconds
+
+    def flow(self, study_name, website_call, hostname=None) -> Dict:
+        """Channels of the hostnames of a website, all hostnames as rows or one row"""
+        rows = self.rows(study_name, website_call)
+        flow = {name: self.arrays[name][rows] for name in CHANNELS + INDEX + TOTALS}
+        if hostname is not None:
+            match = (flow["hostname"] == hostname).nonzero()[0]
+            if not len(match):
+                raise KeyError(f"{hostname} not found for {website_call} {study_name}")
+            flow = {name: values[match[0]] for name, values in flow.items()}
+        flow["directed_bytes"] = flow["in_bytes"].astype("int64") - flow["out_bytes"]
+        return flow
+
+    def communications(self, study_name, website_call) -> Dict:
+        """First party and third parties of a website with their bytes, start and tracker share"""
+        flow = self.flow(study_name, website_call)
+        parties = []
+        for row, hostname in enumerate(flow["hostname"].tolist()):
+            parties.append({"hostname": hostname, "is_tp": bool(flow["is_tp"][row]),
+                            "bytes": int(flow["in_bytes"][row].sum() + flow["out_bytes"][row].sum()),
+                            "start": float(flow["start"][row]), "end": float(flow["end"][row]),
+                            "resources": int(flow["resources"][row]),
+                            "tracker_share": float(flow["trackers"][row] / flow["resources"][row])})
+        first_party = [p for p in parties if not p["is_tp"]]
+        return {"first_party": first_party, "third_parties": [p for p in parties if p["is_tp"]]}
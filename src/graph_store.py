@@ -0,0 +1,174 @@
+import logging
+from typing import Dict, Iterable, List
+
+logs = logging.getLogger("Preprocessor")
+
+WEBSITE, HOSTNAME, IP = 0, 1, 2
+KINDS = {"website": WEBSITE, "hostname": HOSTNAME, "ip": IP}
+# the studies of an edge are the bits of an uint64
+MAX_STUDIES = 64
+
+
+class GraphBuilder:
+    """Edges of website calls to the hostnames and ips they contacted, fed site by site"""
+
+    def __init__(self) -> None:
+        self.nodes = {}
+        self.studies = {}
+        self.edges = {}
+
+    def node(self, name, kind) -> int:
+        key = (kind, name)
+        if key not in self.nodes:
+            self.nodes[key] = len(self.nodes)
+        return self.nodes[key]
+
+    def add_resources(self, resources: Iterable[Dict]):
+        for r in resources:
+            website = self.node(r["website_call"], WEBSITE)
+            study = self.studies.get(r["study_name"])
+            if study is None:
+                if len(self.studies) == MAX_STUDIES:
+                    raise ValueError(f"More than {MAX_STUDIES} study names, {r['study_name']} has no bit in the graph")
+                study = self.studies[r["study_name"]] = len(self.studies)
+            size = sum(r.get("sizes") or ())
+            for name, kind in ((r["hostname"], HOSTNAME), (r.get("ip"), IP)):
+                if not name:
+                    continue
+                edge = self.edges.get((website, self.node(name, kind)))
+                if edge is None:
+                    edge = self.edges[(website, self.node(name, kind))] = [0, 0, 0, 0]
+                edge[0] += size
+                edge[1] += 1
+                edge[2] += bool(r.get("is_tracker"))
+                edge[3] |= 1 << study
+
+    def arrays(self) -> Dict:
+        """Symmetric CSR adjacency, the neighbours of every node sorted by id with the attributes of their edge"""
+        import numpy as np
+        names = [None] * len(self.nodes)
+        kinds = np.empty(len(self.nodes), dtype=np.uint8)
+        for (kind, name), node in self.nodes.items():
+            names[node] = name
+            kinds[node] = kind
+
+        pairs = np.array(list(self.edges.keys()), dtype=np.int64).reshape(-1, 2)
+        values = np.array([edge[:3] for edge in self.edges.values()], dtype=np.int64).reshape(-1, 3)
+        studies = np.array([edge[3] for edge in self.edges.values()], dtype=np.uint64)
+        source = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        target = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        values = np.concatenate([values, values])
+        studies = np.concatenate([studies, studies])
+        order = np.lexsort((target, source))
+        indptr = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(source, minlength=len(names)), out=indptr[1:])
+        return {"names": np.array(names, dtype=str), "kinds": kinds, "indptr": indptr,
+                "indices": target[order].astype(np.int32), "bytes": values[order, 0],
+                "requests": values[order, 1].astype(np.int32), "trackers": values[order, 2].astype(np.int32),
+                "studies": studies[order],
+                "study_names": np.array(sorted(self.studies, key=self.studies.get), dtype=str)}
+
+    def write(self, path):
+        import numpy as np
+        np.savez(path, **self.arrays())
+        logs.info(f"Graph of {len(self.nodes)} nodes and {len(self.edges)} edges at {path}")
+        return path
+
+
+class GraphStore:
+    """Queries on the bipartite graph of website calls and the hostnames and ips they contacted"""
+
+    def __init__(self, path) -> None:
+        import numpy as np
+        with np.load(path) as data:
+            for name in data.files:
+                setattr(self, name, data[name])
+        self.ids = {(int(kind), name): node for node, (kind, name)
+                    in enumerate(zip(self.kinds.tolist(), self.names.tolist()))}
+        self.websites = int((self.kinds == WEBSITE).sum())
+
+    def id(self, name, kind="hostname") -> int:
+        try:
+            return self.ids[(KINDS[kind], name)]
+        except KeyError:
+            raise KeyError(f"No {kind} {name} in the graph") from None
+
+    def neighbours(self, node: int):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def gather(self, nodes):
+        """Positions of the edges of all given nodes in the adjacency arrays"""
+        import numpy as np
+        starts, ends = self.indptr[nodes], self.indptr[np.asarray(nodes) + 1]
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def degree(self, name, kind="hostname") -> int:
+        node = self.id(name, kind)
+        return int(self.indptr[node + 1] - self.indptr[node])
+
+    def prevalence(self, name, kind="hostname") -> float:
+        """Share of the website calls which contacted a hostname or ip"""
+        return self.degree(name, kind) / self.websites if self.websites else 0.
+
+    def co_occurrence(self, a, b, kind="hostname") -> int:
+        """Website calls which contacted both hostnames or ips"""
+        import numpy as np
+        return len(np.intersect1d(self.neighbours(self.id(a, kind)), self.neighbours(self.id(b, kind)),
+                                  assume_unique=True))
+
+    def co_occurring(self, name, kind="hostname", n=10) -> List:
+        """Hostnames or ips most often contacted by the same website calls"""
+        import numpy as np
+        node = self.id(name, kind)
+        websites = self.neighbours(node)
+        if not len(websites):
+            return []
+        reached = self.indices[self.gather(websites)]
+        counts = np.bincount(reached, minlength=len(self.names))
+        counts[node] = 0
+        counts[self.kinds != KINDS[kind]] = 0
+        top = np.argsort(counts, kind="stable")[::-1][:n]
+        return [(str(self.names[i]), int(counts[i])) for i in top if counts[i]]
+
+    def k_hop(self, name, kind="website", k=1):
+        """Ids of the nodes within k hops of a node, itself included"""
+        import numpy as np
+        seen = np.zeros(len(self.names), dtype=bool)
+        frontier = np.array([self.id(name, kind)])
+        seen[frontier] = True
+        for _ in range(k):
+            if not len(frontier):
+                break
+            reached = self.indices[self.gather(frontier)]
+            frontier = np.unique(reached[~seen[reached]])
+            seen[frontier] = True
+        return seen.nonzero()[0]
+
+    def to_networkx(self, nodes):
+        """Subgraph of the given node ids with the attributes of nodes and edges, e.g. of k_hop.
+
+        Nodes are the ids, as a website and its first party hostname share the
+        name, the name is the label attribute. Needs networkx, which only this
+        export uses.
+        """
+        import networkx as nx
+        graph = nx.Graph()
+        selected = set(int(node) for node in nodes)
+        kinds = {kind: name for name, kind in KINDS.items()}
+        for node in selected:
+            graph.add_node(node, label=str(self.names[node]), kind=kinds[int(self.kinds[node])])
+        # every edge has a website end, the edges of the hostnames and ips are the same
+        for node in selected:
+            if self.kinds[node] != WEBSITE:
+                continue
+            for position in range(self.indptr[node], self.indptr[node + 1]):
+                other = int(self.indices[position])
+                if other in selected:
+                    graph.add_edge(node, other, bytes=int(self.bytes[position]),
+                                   requests=int(self.requests[position]), trackers=int(self.trackers[position]),
+                                   is_tracker=bool(self.trackers[position]),
+                                   studies=[s for i, s in enumerate(self.study_names.tolist())
+                                            if int(self.studies[position]) >> i & 1])
+        return graph
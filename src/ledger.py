@@ -0,0 +1,108 @@
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Set
+from utils.utility import create_folder
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class CrawlLedger:
+    """Persistent state of every website and study of a crawl.
+
+    A study is marked running before it starts and done or failed after it
+    ended, so a crash leaves it running and it is recognized as incomplete
+    on the next start. Websites without an entry are still pending.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        create_folder(self.path.parent)
+        # the async crawler calls the ledger from worker threads, one call at a time
+        self.con = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            self.con.execute("""CREATE TABLE IF NOT EXISTS sites (
+                website TEXT PRIMARY KEY,
+                volume TEXT,
+                state TEXT NOT NULL,
+                error_class TEXT,
+                error TEXT,
+                updated REAL)""")
+            self.con.execute("""CREATE TABLE IF NOT EXISTS studies (
+                website TEXT NOT NULL,
+                study TEXT NOT NULL,
+                state TEXT NOT NULL,
+                result TEXT,
+                error_class TEXT,
+                error TEXT,
+                updated REAL,
+                PRIMARY KEY (website, study))""")
+
+    def done(self) -> Set[str]:
+        """Websites which are completely crawled"""
+        return {row[0] for row in self.con.execute("SELECT website FROM sites WHERE state = ?", (DONE,))}
+
+    def studies(self, website) -> Dict[str, Dict]:
+        rows = self.con.execute(
+            "SELECT study, state, result, error_class FROM studies WHERE website = ?", (website,))
+        return {study: {"state": state, "result": result, "error_class": error_class}
+                for study, state, result, error_class in rows}
+
+    def completed_studies(self, website) -> Dict[str, str]:
+        """Result of every done study of a website"""
+        return {study: info["result"] for study, info in self.studies(website).items() if info["state"] == DONE}
+
+    def start_site(self, website, volume):
+        with self.con:
+            self.con.execute("""INSERT INTO sites (website, volume, state, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT (website) DO UPDATE SET state = excluded.state, updated = excluded.updated""",
+                             (website, str(volume), RUNNING, time.time()))
+
+    def finish_site(self, website, error: Exception = None) -> str:
+        """Mark a website done if all of its studies are done, failed otherwise. Returns the new state"""
+        incomplete = any(info["state"] != DONE
+                         for info in self.studies(website).values())
+        if error is not None:
+            state, error_class, message = FAILED, type(error).__name__, str(error)
+        elif incomplete:
+            state, error_class, message = FAILED, "IncompleteStudy", None
+        else:
+            state, error_class, message = DONE, None, None
+
+        with self.con:
+            self.con.execute("UPDATE sites SET state = ?, error_class = ?, error = ?, updated = ? WHERE website = ?",
+                             (state, error_class, message, time.time(), website))
+        return state
+
+    def start_study(self, website, study):
+        with self.con:
+            self.con.execute("""INSERT INTO studies (website, study, state, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT (website, study) DO UPDATE SET state = excluded.state, result = NULL,
+                error_class = NULL, error = NULL, updated = excluded.updated""",
+                             (website, study, RUNNING, time.time()))
+
+    def reset_studies(self, website, studies):
+        with self.con:
+            self.con.executemany("DELETE FROM studies WHERE website = ? AND study = ?",
+                                 ((website, study) for study in studies))
+
+    def finish_study(self, website, study, result=None, error: Exception = None):
+        state = FAILED if error is not None else DONE
+        error_class = type(error).__name__ if error is not None else None
+        with self.con:
+            self.con.execute("UPDATE studies SET state = ?, result = ?, error_class = ?, error = ?, updated = ? WHERE website = ? AND study = ?",
+                             (state, None if result is None else str(result), error_class,
+                              None if error is None else str(error), time.time(), website, study))
+
+    def record(self, website, study, result=None):
+        """Finish a study with the result of its step, an exception returned or raised by the step fails it"""
+        if isinstance(result, Exception):
+            self.finish_study(website, study, error=result)
+        else:
+            self.finish_study(website, study, result=result or "")
+
+    def close(self):
+        self.con.close()
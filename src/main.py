@@ -1,6 +1,39 @@
-import net_crawler
-import preprocess
+import argparse
+import config
+from pathlib import Path
 
-if __name__ == '__main__':
+
+def crawl():
+    import net_crawler
     net_crawler.main()
-    preprocess.main()
\ No newline at end of file
+
+
+def preprocess():
+    import preprocess
+    preprocess.main()
+
+
+def pipeline():
+    crawl()
+    preprocess()
+
+
+COMMANDS = {"crawl": crawl, "preprocess": preprocess, "all": pipeline}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl websites and label their traffic")
+    parser.add_argument("command", nargs="?", choices=COMMANDS, default="all",
+                        help="crawl, preprocess the crawled data or both (default)")
+    parser.add_argument("--config", default=None, help=f"configuration file, default {config.CONFIG_PATH}")
+    args = parser.parse_args()
+
+    # modules are imported by their command only, the configuration is loaded before
+    if args.config:
+        config.CONFIG_PATH = config.CWD / Path(args.config)
+    config.load_config()
+    COMMANDS[args.command]()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,64 @@
+import re
 import time
 import os
+import logging
+import socket
+import tarfile
 import docker
 import config
 import requests
 from pathlib import Path
 from docker.models.containers import Container
-from itertools import repeat
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError, wait
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchFrameException, StaleElementReferenceException, TimeoutException
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.remote.webelement import WebElement
-from utils.utility import sha3, create_folder, rm_folder, write_file, append_file, init_logger, load_linesperated_textfile, str_sim
+from concurrency import ConcurrencyController
+from archive import PackedStore
+from crawl_queue import open_queue
+from telemetry import MetricsWriter, PhaseTimer
+from ledger import DONE, CrawlLedger
+from network_log import write_network_log
+from utils.compression import SUFFIXES, compress_file
+from utils.screenshots import ScreenshotStore
+from utils.utility import sha3, create_folder, rm_folder, write_file, append_file, init_logger, load_linesperated_textfile, log_queues, str_sim, use_log_queues
 from datetime import datetime
 from urllib.parse import urlparse
 from typing import Dict, Tuple
 
 conf = config.load_config()
-logs = init_logger("Crawler", conf, verbose=True)
+# handlers are set up by the entry point, importing the module has no side effects
+logs = logging.getLogger("Crawler")
+
+# Browser storage exported after each study (container path -> study volume path)
+ARTIFACTS = {"Cookies": "Cookies.sqlite", "Local Storage": "Local Storage"}
+
+
+class ChunkReader:
+    """File-like wrapper around the chunk generator returned by docker's get_archive"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer.extend(chunk)
+
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.bytes_read += len(data)
+        return data
 
 
 class CrawlManager:
@@ -33,12 +71,30 @@ class CrawlManager:
         self.timeout = conf["crawler"].getfloat("timeout", 10)
         self.wait_page = conf["crawler"].getfloat("wait_page", 10)
 
+        self.telemetry = PhaseTimer()
+        self.study = None
+
         self.docker_client = docker.from_env()
-        self.crawler, self.port = self._start_crawler()
+        with self.telemetry.phase("container_start"):
+            self.crawler, self.port = self._start_crawler()
         self.tcpdump = None
         self.driver = None
-
-    def _get_webdriver(self):
+        self.volume = None
+
+        # load indicators for the concurrency controller
+        self.timeouts = 0
+        self.dropped = 0
+
+        # artifacts are streamed out of the container while the next study runs
+        self.exporter = ThreadPoolExecutor(max_workers=1)
+        self.exports = []
+        self.export_errors = {}
+        self.screenshots = ScreenshotStore(conf["crawler"].getint("screenshot_width", 960),
+                                           conf["crawler"].get("screenshot_format", "webp"),
+                                           conf["crawler"].getint("screenshot_quality", 80),
+                                           conf["crawler"].getint("screenshot_distance", 6))
+
+    def _chrome_options(self):
         USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/104.0.5112.79 Safari/537.36"
 
         options = webdriver.ChromeOptions()
@@ -59,7 +115,17 @@ class CrawlManager:
         options.add_argument("--headless")
         options.add_argument("--no-sandbox")
         options.add_argument("--dns-prefetch-disable")
+        host_rules = conf["crawler"].get("host_resolver_rules", "")
+        if host_rules:
+            options.add_argument(f"--host-resolver-rules={host_rules}")
 
+        if conf["crawler"].get("network_log", ""):
+            # DevTools network events of the browser, read back after each study
+            options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        return options
+
+    def _get_webdriver(self):
+        options = self._chrome_options()
         driver = webdriver.Remote(
             f"http://127.0.0.1:{self.port}", options=options)
         driver.execute_script(
@@ -69,6 +135,10 @@ class CrawlManager:
         return driver
 
     def checkready(self):
+        with self.telemetry.phase("checkready"):
+            self._checkready()
+
+    def _checkready(self):
         iteration = 0
         while True:
             if iteration >= self.timeout:
@@ -90,8 +160,11 @@ class CrawlManager:
         ssl = conf["crawler"].get("ssl", "sslkeylogfile.txt")
         volume = self.crawl_config["volume"]
 
+        # optional user defined network, e.g. the one of the benchmark sites
+        network = conf["docker"].get("network", "") or None
+
         crawler = self.docker_client.containers.run(image, detach=True, auto_remove=True, ports={
-            "4444/tcp": None}, environment=[f"SSLKEYLOGFILE=ssl/{ssl}"], volumes=[f"{volume}/:/ssl/"])
+            "4444/tcp": None}, environment=[f"SSLKEYLOGFILE=ssl/{ssl}"], volumes=[f"{volume}/:/ssl/"], network=network)
 
         for offloading in ["tso", "gso", "gro", "lro", "rx", "tx"]:
             crawler.exec_run(
@@ -121,24 +194,47 @@ class CrawlManager:
             self.tcpdump.reload()
             if self.tcpdump.status == 'running':
                 self.tcpdump.stop()
+                self.dropped += self._dropped_packets()
                 self.tcpdump.remove()
                 self.tcpdump = None
 
+    def _dropped_packets(self):
+        """Packets dropped by the kernel according to the statistics tcpdump prints on exit"""
+        output = self.tcpdump.logs(stdout=False, stderr=True).decode(errors="replace")
+        match = re.search(r"(\d+) packets? dropped by kernel", output)
+        return int(match.group(1)) if match else 0
+
     def _rm_cache(self):
         self.crawler.exec_run("rm -rf /chrome-data/Default/Cache/Cache_Data")
         self.crawler.exec_run(
             "rm -rf /chrome-data/Default/Code\ Cache")
         self.crawler.exec_run("rm -rf /chrome-data/Default/GPUCache")
 
+    def _wait_exports(self):
+        """Wait for the background exports, the first error of every study is kept in export_errors"""
+        for name, future in self.exports:
+            try:
+                future.result()
+            except Exception as e:
+                logs.error(
+                    f"Error while exporting artifacts of {name} for {self.website} - {e}")
+                self.export_errors.setdefault(name, e)
+        self.exports = []
+
     def close(self):
-        self.crawler.stop()
-        self._stop_tcpdump()
+        self._wait_exports()
+        self.exporter.shutdown()
+        with self.telemetry.phase("teardown"):
+            self.crawler.stop()
+            self._stop_tcpdump()
 
     def _visit_page(self):
         logs.debug(f"Visit {self.website}")
-        self.driver.get(self.website)
+        with self.telemetry.phase("page_load", self.study):
+            self.driver.get(self.website)
         if conf["crawler"].getboolean("scroll", True):
-            self._scroll()
+            with self.telemetry.phase("scroll", self.study):
+                self._scroll()
 
     def _scroll(self):
         actions = ActionChains(self.driver)
@@ -150,34 +246,53 @@ class CrawlManager:
         time.sleep(.4)
         self.driver.execute_script("window.scrollTo(0, 0);")
 
+    def _save_network_log(self, entries):
+        path = self.volume / conf["crawler"]["network_log"]
+        with self.telemetry.phase("network_log", self.study):
+            n_requests = write_network_log(entries, path)
+        logs.debug(f"Saved {n_requests} requests of {self.website} at {path}")
+
     def _init_study(self, name):
-        self.driver = self._get_webdriver()
+        self.study = name
+        with self.telemetry.phase("webdriver_start", name):
+            self.driver = self._get_webdriver()
+        return self._start_capture(name)
 
+    def _start_capture(self, name):
         volume = self.crawl_config["volume"]
         if name:
             volume = volume / name
             create_folder(volume)
-        self.tcpdump = self._start_tcpdump(volume=volume)
+        self.volume = volume
 
-        for i in range(int(self.timeout)):
-            self.tcpdump.reload()
-            if self.tcpdump.status == 'running':
-                break
+        with self.telemetry.phase("tcpdump_start", name):
+            self.tcpdump = self._start_tcpdump(volume=volume)
 
-            time.sleep(1)
-            if i == self.timeout:
-                raise TimeoutError(
-                    f"Timeout ({self.timeout}), couldn't start tcpdump for {self.website}")
+            for i in range(int(self.timeout)):
+                self.tcpdump.reload()
+                if self.tcpdump.status == 'running':
+                    break
+
+                time.sleep(1)
+                if i == self.timeout:
+                    raise TimeoutError(
+                        f"Timeout ({self.timeout}), couldn't start tcpdump for {self.website}")
 
         logs.debug(
             f"Successfully initialized study={name} for {self.website}")
         return volume
 
     def _stop_study(self):
-        self._stop_tcpdump()
-        if self.driver:
-            self.driver.quit()
-        self._rm_cache()
+        with self.telemetry.phase("study_stop", self.study):
+            self._stop_tcpdump()
+            if self.driver:
+                if conf["crawler"].get("network_log", ""):
+                    try:
+                        self._save_network_log(self.driver.get_log("performance"))
+                    except Exception as e:
+                        logs.error(f"Couldn't save the network log of {self.website} - {e}")
+                self.driver.quit()
+            self._rm_cache()
 
     def run_study(self, name=None):
         logs.info(f"Run study {name} for {self.website}")
@@ -187,30 +302,115 @@ class CrawlManager:
         try:
             self._visit_page()
             wait = max(0, timeout - time.time())
-            time.sleep(wait)
+            with self.telemetry.phase("page_wait", name):
+                time.sleep(wait)
         except TimeoutException as e:
             logs.critical(f"Timeout while {name} {self.website} - {e}")
+            self.timeouts += 1
         except Exception as e:
             logs.error(f"Error while {name} {self.website} - {e}")
             self._stop_study()
             logs.info(f"End study {name} for {self.website}")
-            return
+            return e
 
         if conf["crawler"].getboolean("screenshots", False):
-            screenshot = str(volume / "screenshot.png")
-            self.driver.save_screenshot(screenshot)
+            with self.telemetry.phase("screenshot", name):
+                screenshot = self.driver.get_screenshot_as_png()
+            self._save_screenshot(screenshot, name, volume)
         self._stop_study()
-        if conf["crawler"].getboolean("cookie", False):
-            os.system(
-                f"docker cp {self.crawler.id}:/chrome-data/Default/Cookies {(volume / 'Cookies.sqlite').resolve()}")
-            os.system(
-                f"docker cp {self.crawler.id}:/chrome-data/Default/Local\ Storage {str(volume)}")
-
+        self._compress_capture(name, volume)
+        self._collect_artifacts(name, volume)
         logs.info(f"End study {name} for {self.website}")
 
+    def _save_screenshot(self, screenshot, name, volume):
+        """Downscale, hash and store the raw screenshot in the background"""
+        future = self.exporter.submit(self._store_screenshot, screenshot, name, volume)
+        self.exports.append((name, future))
+
+    def _store_screenshot(self, screenshot, name, volume):
+        with self.telemetry.phase("screenshot_store", name):
+            info = self.screenshots.save(screenshot, volume, name)
+        if "same_as" in info:
+            logs.debug(f"Screenshot of {name} for {self.website} looks like {info['same_as']}, not stored")
+
+    def _compress_capture(self, name, volume):
+        """Compress the finished capture in the background"""
+        method = conf["crawler"].get("compress_pcap", "none")
+        if method not in SUFFIXES:
+            return
+        pcap = volume / conf["crawler"].get("pcap", "tcpdump.pcap")
+        future = self.exporter.submit(self._compress, pcap, method, name)
+        self.exports.append((name, future))
+
+    def _compress(self, pcap, method, name=None):
+        if not pcap.is_file():
+            logs.error(f"No capture of {name} for {self.website} at {pcap}")
+            return
+        with self.telemetry.phase("compress", name):
+            start = time.time()
+            size = pcap.stat().st_size
+            compressed = compress_file(pcap, method, threads=conf["crawler"].getint("compress_threads", 0))
+            logs.debug(
+                f"Compressed {pcap} with {method}: {size} -> {compressed.stat().st_size} bytes ({time.time() - start:.3f} seconds)")
+
+    def _collect_artifacts(self, name, volume):
+        if conf["crawler"].getboolean("cookie", False):
+            with self.telemetry.phase("artifact_snapshot", name):
+                staging = self._snapshot_artifacts(name)
+            future = self.exporter.submit(
+                self._export_artifacts, staging, volume, name)
+            self.exports.append((name, future))
+
+    def _snapshot_artifacts(self, name):
+        """Copy the browser storage into a staging folder, so the next study can't modify it during export"""
+        staging = f"/tmp/artifacts/{sha3(str(name))[:10]}"
+        sources = " ".join(
+            f'"/chrome-data/Default/{artifact}"' for artifact in ARTIFACTS)
+        exit_code, output = self.crawler.exec_run(
+            ["sh", "-c", f'rm -rf "{staging}" && mkdir -p "{staging}" && cp -r {sources} "{staging}/"'])
+        if exit_code != 0:
+            logs.error(
+                f"Incomplete artifact snapshot of {name} for {self.website} - {output.decode(errors='replace').strip()}")
+        return staging
+
+    def _export_artifacts(self, staging, volume, name=None):
+        """Stream the staged artifacts as one tar archive and extract them into the study volume"""
+        with self.telemetry.phase("artifact_copy", name):
+            self._stream_artifacts(staging, volume)
+
+    def _stream_artifacts(self, staging, volume):
+        start = time.time()
+        sizes = {artifact: 0 for artifact in ARTIFACTS.values()}
+        durations = {artifact: 0. for artifact in ARTIFACTS.values()}
+
+        chunks, _ = self.crawler.get_archive(staging)
+        stream = ChunkReader(chunks)
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                # members are prefixed with the name of the staging folder
+                parts = Path(member.name).parts[1:]
+                if not parts or parts[0] not in ARTIFACTS or ".." in parts:
+                    continue
+                artifact = ARTIFACTS[parts[0]]
+                member.name = str(Path(artifact, *parts[1:]))
+
+                extract_start = time.time()
+                tar.extract(member, volume)
+                durations[artifact] += time.time() - extract_start
+                if member.isfile():
+                    sizes[artifact] += member.size
+
+        self.crawler.exec_run(["rm", "-rf", staging])
+
+        for artifact, size in sizes.items():
+            logs.debug(
+                f"Exported {artifact} ({size} bytes, {durations[artifact]:.3f} seconds) to {volume}")
+        logs.info(
+            f"Exported artifacts for {self.website} to {volume} ({stream.bytes_read} bytes streamed, {time.time() - start:.3f} seconds)")
+
     def accept_cookie(self, name=None):
         logs.info(f"Run study {name} for {self.website}")
-        self._init_study(name)
+        volume = self._init_study(name)
 
         timeout = time.time() + self.timeout
         try:
@@ -218,6 +418,7 @@ class CrawlManager:
         except (TimeoutException, TimeoutError):
             logs.critical(
                 f"Timeout ({self.timeout} s) for cookie-accept on {self.website}")
+            self.timeouts += 1
             clicked_banner = False
 
         except Exception as error:
@@ -230,22 +431,25 @@ class CrawlManager:
                         f'{self.website},True,"{clicked_banner}"')
             # Time to settle for cookies
             wait = max(0, min(self.wait_page, timeout - time.time()))
-            time.sleep(wait)
+            with self.telemetry.phase("click_settle", name):
+                time.sleep(wait)
 
         else:
             logs.debug(f"No matching cookie-banner at {self.website}")
             append_file(self.cookie_accept["log"], f"{self.website},False,")
 
         self._stop_study()
+        self._compress_capture(name, volume)
         logs.info(f"End study {name} for {self.website}")
         return clicked_banner
 
     def _accept_cookie(self, timeout):
         self._visit_page()
 
-        clicked_banner = self._click_banner(timeout)
-        if not clicked_banner:
-            clicked_banner = self._click_frame(timeout)
+        with self.telemetry.phase("banner_search", self.study):
+            clicked_banner = self._click_banner(timeout)
+            if not clicked_banner:
+                clicked_banner = self._click_frame(timeout)
 
         return clicked_banner
 
@@ -381,31 +585,129 @@ def create_study_config(limit_study=None):
     return study_config
 
 
+def create_site_config(study_config, website, override=None):
+    """Prepare the output folder of a website, None if it should be skipped"""
+    if override is None:
+        override = conf["crawler"].getboolean("override", False)
+
+    vol_path = (study_config["raw"]
+                / urlparse(website).netloc
+                / sha3(website)[:10])
+    if not vol_path.exists():
+        logs.debug(f"Output path {vol_path} created")
+        create_folder(vol_path)
+    elif override:
+        # Study already exists and should be overridden
+        logs.info(
+            f"Study at {vol_path} already exists and will be overridden")
+        rm_folder(vol_path)
+        create_folder(vol_path)
+    else:
+        # Study already exists and should not be overridden
+        logs.info(f"Study at {vol_path} already exists and will be skiped")
+        return None
+
+    crawl = {"website": website, "volume": vol_path.resolve()}
+    if conf["crawler"].getboolean("origin_req", True):
+        write_file(crawl["volume"] / "request.txt", crawl["website"])
+    return crawl
+
+
 def create_crawl_config(study_config):
+    ledger = open_ledger()
+    if ledger and conf["crawler"].getboolean("resume", False):
+        if conf["crawler"].getboolean("override", False):
+            logs.warning("Resume and override are both set, completed websites are kept")
+        # the ledger knows completed websites, so no output folder has to be checked
+        done = ledger.done()
+        ledger.close()
+        logs.info(f"Resume crawl, skip {len(done)} completed websites")
+        return [resume_site_config(study_config, website)
+                for website in study_config["websites"] if website not in done]
+
     crawl_config = []
     for website in study_config["websites"]:
-        vol_path = (study_config["raw"]
-                    / urlparse(website).netloc
-                    / sha3(website)[:10])
-        if not vol_path.exists():
-            logs.debug(f"Output path {vol_path} created")
-            create_folder(vol_path)
-        elif conf["crawler"].getboolean("override", False):
-            # Study already exists and should be overridden
-            logs.info(
-                f"Study at {vol_path} already exists and will be overridden")
-            rm_folder(vol_path)
-            create_folder(vol_path)
-        else:
-            # Study already exists and should not be overridden
-            logs.info(f"Study at {vol_path} already exists and will be skiped")
-            continue
-
-        crawl_config.append({"website": website, "volume": vol_path.resolve()})
+        crawl = create_site_config(study_config, website)
+        if crawl:
+            crawl_config.append(crawl)
 
     return crawl_config
 
 
+def resume_site_config(study_config, website):
+    """Config of a website whose output folder is prepared when the crawl starts"""
+    vol_path = (study_config["raw"]
+                / urlparse(website).netloc
+                / sha3(website)[:10])
+    return {"website": website, "volume": vol_path.absolute(), "resume": True}
+
+
+def open_ledger():
+    ledger = conf["output"].get("ledger", "")
+    if not ledger:
+        return None
+    return CrawlLedger(Path(conf["output"].get("data_path", "data")) / ledger)
+
+
+def plan_studies(done):
+    """Studies to (re)run given the results of completed studies.
+
+    The study after accepting depends on the cookies set by accepting in the
+    same browser profile, so both are repeated if one of them is incomplete.
+    """
+    studies = [] if "before accept" in done else ["before accept"]
+    accepted = done.get("accepting policy")
+    if accepted is None or (accepted and "after accept" not in done):
+        studies.extend(["accepting policy", "after accept"])
+    return studies
+
+
+def prepare_volume(crawl_config, studies, ledger):
+    """Create the output folder and remove leftovers of studies which are repeated"""
+    volume = crawl_config["volume"]
+    create_folder(volume)
+    for study in studies:
+        rm_folder(volume / study)
+    if ledger:
+        ledger.reset_studies(crawl_config["website"], studies)
+    if conf["crawler"].getboolean("origin_req", True):
+        write_file(volume / "request.txt", crawl_config["website"])
+
+
+def pack_site(volume):
+    """Move a crawled website call into the packed store"""
+    data_path = Path(conf["output"].get("data_path", "data"))
+    store = PackedStore(data_path / conf["output"].get("packed_path", "packed"))
+    site = store.pack_site(volume, remove=True)
+    store.close()
+    logs.debug(f"Packed {volume} as {site}")
+
+
+def record_exports(ledger, outcome, export_errors):
+    """Fail the studies whose screenshot or artifacts couldn't be exported, so the website isn't done"""
+    for study, e in export_errors.items():
+        if ledger:
+            ledger.record(outcome["website"], study, e)
+        if outcome["error"] is None:
+            outcome["error"] = f"{type(e).__name__}: export of {study} failed - {e}"
+
+
+def run_step(ledger, website, study, step):
+    """Run a study and record its state in the ledger"""
+    if ledger:
+        ledger.start_study(website, study)
+    try:
+        result = step(study)
+    except Exception as e:
+        if ledger:
+            ledger.record(website, study, e)
+        raise
+
+    if ledger:
+        ledger.record(website, study, result)
+    return result
+
+
 def setup_config():
     logs.info(f"Configuration used {config.todict(conf)}")
     limit_study = conf["crawler"].getint("limit_study", 0)
@@ -416,11 +718,11 @@ def setup_config():
 
     logs.info(
         f"Start study at {config.PROJECT} with input {conf['crawler']['web_pages']} and output {study_config['raw']}")
-    crawl_config = create_crawl_config(study_config)
 
-    if conf["crawler"].getboolean("origin_req", True):
-        for crawl in crawl_config:
-            write_file(crawl["volume"] / "request.txt", crawl["website"])
+    # with a queue the websites are fetched in batches during the crawl
+    crawl_config = None
+    if not conf.has_section("queue") or not conf["queue"].get("backend", ""):
+        crawl_config = create_crawl_config(study_config)
 
     if study_config["cookie_accept"]:
         write_file(study_config["cookie_accept"]
@@ -430,28 +732,174 @@ def setup_config():
 
 
 def run_crawl(crawl_config, cookie_accept):
-    crawl = CrawlManager(crawl_config, cookie_accept)
+    website = crawl_config["website"]
+    outcome = {"website": website, "error": None}
+    start = time.time()
+    ledger = open_ledger()
+
+    studies = ["before accept", "accepting policy", "after accept"]
+    done = {}
+    if crawl_config.get("resume"):
+        done = ledger.completed_studies(website) if ledger else {}
+        studies = plan_studies(done)
+        prepare_volume(crawl_config, studies, ledger)
+    if ledger:
+        ledger.start_site(website, crawl_config["volume"])
+
+    error = None
+    crawl = None
     try:
+        crawl = CrawlManager(crawl_config, cookie_accept)
         crawl.checkready()
-        crawl.run_study("before accept")
-        clicked_banner = crawl.accept_cookie("accepting policy")
-        if clicked_banner:
-            crawl.run_study("after accept")
+        if "before accept" in studies:
+            run_step(ledger, website, "before accept", crawl.run_study)
+        if "accepting policy" in studies:
+            clicked_banner = run_step(
+                ledger, website, "accepting policy", crawl.accept_cookie)
+            if clicked_banner:
+                run_step(ledger, website, "after accept", crawl.run_study)
+        else:
+            clicked_banner = done["accepting policy"]
+        outcome["clicked_banner"] = clicked_banner
     except Exception as e:
         logs.error(f"Error for {crawl_config['website']} - {e}")
+        outcome["error"] = f"{type(e).__name__}: {e}"
+        error = e
     finally:
-        crawl.close()
+        if crawl:
+            crawl.close()
+            record_exports(ledger, outcome, crawl.export_errors)
+        complete = outcome["error"] is None
+        if ledger:
+            complete = ledger.finish_site(website, error) == DONE
+            ledger.close()
+        # incomplete websites stay unpacked, so a resumed crawl can continue them
+        if complete and crawl and conf["output"].getboolean("packed", False):
+            with crawl.telemetry.phase("pack"):
+                pack_site(crawl_config["volume"])
+        if crawl:
+            outcome["timeouts"] = crawl.timeouts
+            outcome["dropped"] = crawl.dropped
+            outcome["phases"] = crawl.telemetry.phases
+        outcome["duration"] = round(time.time() - start, 3)
+    return outcome
+
+
+def init_worker(values, queues):
+    config.install(values)
+    use_log_queues(queues, conf)
+
+
+def run_pool(crawl_configs, cookie_accept, total=None, on_outcome=None):
+    """Crawl websites in worker processes, as many at once as the concurrency controller allows.
+
+    crawl_configs may yield None if no website is available right now.
+    """
+    controller = ConcurrencyController.from_config(conf["docker"])
+    crawl_configs = iter(crawl_configs)
+    exhausted = False
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=controller.maximum, initializer=init_worker,
+                             initargs=(config.todict(conf), log_queues())) as executor, tqdm(total=total) as progress:
+        while True:
+            while not exhausted and len(running) < controller.limit:
+                crawl = next(crawl_configs, StopIteration)
+                if crawl is StopIteration:
+                    exhausted = True
+                elif crawl is None:
+                    break
+                else:
+                    running[executor.submit(
+                        run_crawl, crawl, cookie_accept)] = crawl
+
+            if not running:
+                if exhausted:
+                    break
+                time.sleep(conf["queue"].getfloat("poll", 30))
+                continue
+
+            busy = len(running) if not exhausted else 0
+            finished, _ = wait(running, timeout=controller.interval,
+                               return_when=FIRST_COMPLETED)
+            for future in finished:
+                crawl = running.pop(future)
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    logs.error(f"Error for {crawl['website']} - {e}")
+                    outcome = {"website": crawl["website"],
+                               "error": f"{type(e).__name__}: {e}"}
+
+                controller.record(outcome)
+                if on_outcome:
+                    on_outcome(outcome)
+                progress.update()
+
+            controller.update(busy)
+
+
+def leased_configs(study_config, queue, owner):
+    """Lease websites from the shared queue, yields None while all remaining websites are leased by others"""
+    batch = conf["queue"].getint("batch", 2 * conf["docker"].getint("n_container", 5))
+    lease = conf["queue"].getfloat("lease", 900)
+
+    while True:
+        websites = queue.lease(owner, batch, lease)
+        if not websites:
+            if queue.is_finished():
+                return
+            # remaining websites are leased by this or other nodes or wait for a retry
+            yield None
+            continue
+
+        logs.info(f"Leased {len(websites)} websites as {owner}")
+        for website in websites:
+            if conf["crawler"].getboolean("resume", False):
+                yield resume_site_config(study_config, website)
+            else:
+                yield create_site_config(study_config, website, override=True)
+
+
+def run_queue(study_config, queue, metrics):
+    """Crawl websites leased from the shared queue until it is drained"""
+    owner = f"{socket.gethostname()}-{os.getpid()}"
+    added = queue.add(study_config["websites"])
+    logs.info(f"Added {added} websites to the queue {queue.stats()}")
+
+    def on_outcome(outcome):
+        metrics.record(outcome)
+        website = outcome["website"]
+        if outcome["error"]:
+            queue.fail(website, owner, outcome["error"])
+        elif not queue.complete(website, owner, outcome):
+            logs.warning(f"Lease for {website} expired before completion")
+
+    run_pool(leased_configs(study_config, queue, owner),
+             study_config["cookie_accept"], on_outcome=on_outcome)
+    logs.info(f"Queue {queue.stats()}")
 
 
 def main():
+    init_logger("Crawler", conf, verbose=True)
     study_config, crawl_config = setup_config()
     start = datetime.now()
     setup_docker()
 
-    n_container = int(conf["docker"].get("n_container", "5"))
-    with ProcessPoolExecutor(max_workers=n_container) as executor:
-        list(tqdm(executor.map(run_crawl, crawl_config, repeat(
-            study_config["cookie_accept"])), total=len(crawl_config)))
+    metrics = MetricsWriter.from_config(conf, "crawl")
+    queue = open_queue(conf["queue"]) if conf.has_section("queue") else None
+    if queue:
+        run_queue(study_config, queue, metrics)
+    elif conf["crawler"].get("orchestrator", "process") == "async":
+        import asyncio
+        import async_crawler
+        asyncio.run(async_crawler.crawl(
+            crawl_config, study_config["cookie_accept"], on_outcome=metrics.record))
+    else:
+        run_pool(crawl_config, study_config["cookie_accept"],
+                 total=len(crawl_config), on_outcome=metrics.record)
+    metrics.close()
+    logs.info(f"Crawl metrics at {metrics.jsonl_path} and {metrics.prom_path}")
 
     logs.info(f"Done ({(datetime.now() - start).total_seconds():.1f} seconds)")
     print(f"See results at '{study_config['raw'].resolve()}'")
@@ -0,0 +1,56 @@
+import json
+from typing import Dict, IO, List
+
+
+def network_requests(entries: List[Dict]) -> List[Dict]:
+    """Compact request records from the DevTools events of Chrome's performance log"""
+    requests = []
+    # latest record of every request id, redirects reuse the id for the next hop
+    latest = {}
+    for entry in entries:
+        message = json.loads(entry["message"])["message"]
+        method, params = message.get("method", ""), message.get("params", {})
+        request_id = params.get("requestId")
+        if method == "Network.requestWillBeSent":
+            if "redirectResponse" in params and request_id in latest:
+                _add_response(latest[request_id], params["redirectResponse"])
+            request = params["request"]
+            latest[request_id] = {
+                "request_id": request_id,
+                "url": request["url"],
+                "method": request["method"],
+                "type": params.get("type"),
+                "time": params.get("wallTime"),
+            }
+            requests.append(latest[request_id])
+        elif method == "Network.responseReceived":
+            if request_id in latest:
+                _add_response(latest[request_id], params["response"])
+        elif method == "Network.loadingFailed":
+            request = latest.get(request_id)
+            if request is not None:
+                request["error"] = params.get("errorText")
+    return requests
+
+
+def _add_response(request: Dict, response: Dict):
+    request.update({
+        "status": response.get("status"),
+        "mime_type": response.get("mimeType"),
+        "protocol": response.get("protocol"),
+        "remote_ip": (response.get("remoteIPAddress") or "").strip("[]") or None,
+        "remote_port": response.get("remotePort"),
+        "from_cache": response.get("fromDiskCache", False) or response.get("fromServiceWorker", False),
+    })
+
+
+def write_network_log(entries: List[Dict], path) -> int:
+    requests = network_requests(entries)
+    with open(path, "w") as f:
+        for request in requests:
+            f.write(json.dumps(request) + "\n")
+    return len(requests)
+
+
+def read_network_log(f: IO[str]) -> List[Dict]:
+    return [json.loads(line) for line in f if line.strip()]
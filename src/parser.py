@@ -1,37 +1,58 @@
 import os
 import json
+import logging
 import pandas as pd
 from config import load_config
-from utils.utility import init_logger
+from archive import PackedStore
     
 config = load_config()
-logs = init_logger("Parser", config)
+logs = logging.getLogger("Parser")
 
 class DataParser:
 
     def __init__(self, path):
         self.path = path
-        self.domains = sorted(os.listdir(path))
-        self.call_paths = sorted(self._find_paths(path))
+        self.store = None
+        if os.path.isfile(os.path.join(path, 'index.sqlite')):
+            # packed storage, the corpus is listed from the index
+            self.store = PackedStore(path)
+            self.call_paths = self.store.sites()
+            self.domains = sorted({p.split('/')[0] for p in self.call_paths})
+        else:
+            self.domains = sorted(os.listdir(path))
+            self.call_paths = sorted(self._find_paths(path))
+
+    def _open(self, call_path, filename):
+        """Open a file of a website call, None if it doesn't exist"""
+        if self.store is None:
+            p = os.path.join(call_path, filename)
+            return open(p, 'rb') if os.path.exists(p) else None
+
+        sidecar = self.store.sidecar(call_path, filename)
+        if sidecar.is_file():
+            return open(sidecar, 'rb')
+        if self.store.exists(call_path, filename):
+            return self.store.open(call_path, filename)
+        return None
 
     def map(self, fn, filename='resources.json', debug=False):
         results = []
         for p in self.call_paths:
-            p = os.path.join(p, filename)
-            if not os.path.exists(p):
+            ext = os.path.splitext(filename)[1]
+            if ext not in ('.txt', '.json'):
+                raise ValueError(
+                    "Only support txt and json files for map function")
+
+            f = self._open(p, filename)
+            if f is None:
                 if debug:
-                    print(f"Not found: {p}")
+                    print(f"Not found: {os.path.join(p, filename)}")
                 continue
-            ext = os.path.splitext(filename)[1]
-            if ext == '.txt':
-                with open(p) as f:
-                    file = f.read()
-            elif ext == '.json':
-                with open(p) as f:
+            with f:
+                if ext == '.txt':
+                    file = f.read().decode()
+                else:
                     file = json.load(f)
-            else:
-                raise ValueExeption(
-                    "Only support txt and json files for map function")
 
             results.append(fn(file))
         return results
@@ -46,20 +67,18 @@ class DataParser:
                     print(f"Skip, no indices for: {name}")
                 continue
 
-            p = os.path.join(p, filename)
+            ext = os.path.splitext(filename)[1]
+            if ext != '.json':
+                raise ValueError(
+                    "Only support json files for map_index function")
 
-            if not os.path.exists(p):
+            f = self._open(p, filename)
+            if f is None:
                 if debug:
-                    print(f"Not found: {p}")
+                    print(f"Not found: {os.path.join(p, filename)}")
                 continue
-
-            ext = os.path.splitext(filename)[1]
-            if ext == '.json':
-                with open(p) as f:
-                    resources = json.load(f)
-            else:
-                raise ValueExeption(
-                    "Only support json files for map_index function")
+            with f:
+                resources = json.load(f)
 
             for idx, row in df[df['context'] == name].iterrows():
                 indices.append(idx)
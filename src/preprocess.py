@@ -1,28 +1,51 @@
+import io
 import os
-import requests
-import adblock
+import logging
+import json
+import time
+import cProfile
+import tempfile
+import threading
+import subprocess
 import config
-import pandas as pd
+import connections
 from pathlib import Path
-from tqdm import tqdm
 from utils.utility import (
     write_json,
     load_json,
     init_logger,
+    log_queues,
+    use_log_queues,
     list_dir,
-    list_files,
     is_tool,
     sha3,
-    write_file,
+    create_folder,
 )
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from resource import resource
-from typing import List, Tuple
+from archive import PackedStore, PackedStudy
+from network_log import read_network_log
+from sketches import PrevalenceSketch, write_rankings
+from consent_diff import DeltaWriter, diff_site
+from flow_cube import write_cube
+from graph_store import GraphBuilder
+from filterlists import FilterListStore, load_engine
+from utils.compression import SUFFIXES, compression_of, open_decompressed
+from telemetry import MetricsWriter, PhaseTimer, peak_rss, reset_peak_rss
+from functools import lru_cache
+from typing import IO, TYPE_CHECKING, Dict, List, Tuple
 from tld import get_fld
 from urllib.parse import urlparse
 
+if TYPE_CHECKING:
+    import adblock
+
 conf = config.load_config()
-logs = init_logger("Preprocessor", conf, verbose=True)
+# handlers are set up by the entry point, importing the module has no side effects
+logs = logging.getLogger("Preprocessor")
+store = None
+adblocker = None
+engine_path = None
 
 
 def check_requirements():
@@ -34,19 +57,141 @@ def check_requirements():
     return True
 
 
+def find_pcap(exists):
+    """Name of the stored capture, which may be compressed, None if there is none"""
+    pcap = conf["crawler"].get("pcap", "tcpdump.pcap")
+    for name in [pcap] + [pcap + suffix for suffix in SUFFIXES.values()]:
+        if exists(name):
+            return name
+    return None
+
+
+def json_args(keylog) -> List[str]:
+    return ["-T", "json", "-o", f"tls.keylog_file:{keylog}", "--no-duplicate-keys"]
+
+
+def tshark_stream(pcap: IO[bytes], args: List[str], out=subprocess.PIPE):
+    """Start tshark which reads the capture from stdin, the feeding thread counts the bytes"""
+    proc = subprocess.Popen(["tshark", "-r", "-"] + args, stdin=subprocess.PIPE, stdout=out)
+    fed = {"bytes": 0}
+
+    def feed():
+        try:
+            while True:
+                chunk = pcap.read(1 << 20)
+                if not chunk:
+                    break
+                proc.stdin.write(chunk)
+                fed["bytes"] += len(chunk)
+        except BrokenPipeError:
+            logs.error("tshark exited before the capture was read completely")
+        finally:
+            pcap.close()
+            proc.stdin.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    return proc, feeder, fed
+
+
 def pcap_to_json(dir_path):
     ssl = dir_path.parent / conf["crawler"]["ssl"]
-    pcap = dir_path / conf["crawler"].get("pcap", "tcpdump.pcap")
-    if not ssl.is_file() or not pcap.is_file():
+    name = find_pcap(lambda name: (dir_path / name).is_file())
+    pcap = dir_path / (name or conf["crawler"].get("pcap", "tcpdump.pcap"))
+    if not ssl.is_file() or not name:
         logs.error(f"FileNotFound at {ssl} or {pcap}")
-        return
+        return None
 
     capture = dir_path / conf["preprocess"].get("capture", "capture.json")
     logs.debug(f"Convert {pcap}: -> {capture}")
+    info = {"compression": compression_of(pcap), "stored_bytes": pcap.stat().st_size}
+
+    if info["compression"] is None:
+        info["raw_bytes"] = info["stored_bytes"]
+        os.system(
+            f'tshark -r "{pcap}" -T json -o "tls.keylog_file:{ssl}" --no-duplicate-keys > "{capture}"'
+        )
+        return info
+
+    # decompressed on the fly, without a temporary pcap
+    with open(capture, "wb") as out:
+        source = open_decompressed(open(pcap, "rb"), info["compression"])
+        proc, feeder, fed = tshark_stream(source, json_args(ssl), out=out)
+        proc.wait()
+        feeder.join()
+    info["raw_bytes"] = fed["bytes"]
+    return info
+
+
+def packed_capture(study: PackedStudy, info: Dict):
+    """Decrypt a packed capture with tshark, the pcap is streamed from the archive"""
+    store = study.store
+    ssl = conf["crawler"]["ssl"]
+    name = find_pcap(lambda name: store.exists(study.site, study.member(name)))
+    if not name or not store.exists(study.site, ssl):
+        logs.error(f"FileNotFound at {study.site}: {ssl} or {study.member(conf['crawler'].get('pcap', 'tcpdump.pcap'))}")
+        return None
+
+    pcap = study.member(name)
+    logs.debug(f"Convert {study.site}: {pcap}")
+    info["compression"] = compression_of(name)
+    info["stored_bytes"] = store.size(study.site, pcap)
+    with tempfile.NamedTemporaryFile(suffix=".txt") as keylog:
+        keylog.write(store.read(study.site, ssl))
+        keylog.flush()
+
+        source = open_decompressed(store.open(study.site, pcap), info["compression"])
+        proc, feeder, fed = tshark_stream(source, json_args(keylog.name))
+        data = json.load(io.TextIOWrapper(proc.stdout, errors="replace"))
+        feeder.join()
+        proc.wait()
+    info["raw_bytes"] = fed["bytes"]
+    return data
+
+
+def open_capture(study, info: Dict):
+    """Open the stored capture of a study folder or packed study decompressed, None if there is none"""
+    if isinstance(study, PackedStudy):
+        name = find_pcap(lambda name: study.store.exists(study.site, study.member(name)))
+        if name:
+            info["stored_bytes"] = study.store.size(study.site, study.member(name))
+            f = study.store.open(study.site, study.member(name))
+    else:
+        name = find_pcap(lambda name: (study / name).is_file())
+        if name:
+            info["stored_bytes"] = (study / name).stat().st_size
+            f = open(study / name, "rb")
+    if not name:
+        return None
+    info["compression"] = compression_of(name)
+    return open_decompressed(f, info["compression"])
+
+
+def connection_rows(study, info: Dict, fields: List[str]):
+    """Fields of every frame without TLS decryption, None if there is no capture"""
+    source = open_capture(study, info)
+    if source is None:
+        logs.error(f"No capture found for {study}")
+        return None
+
+    proc, feeder, fed = tshark_stream(source, connections.tshark_args(fields))
+    rows = connections.parse_rows(io.TextIOWrapper(proc.stdout, errors="replace"), fields)
+    feeder.join()
+    proc.wait()
+    info["raw_bytes"] = fed["bytes"]
+    return rows
+
+
+def packed_path():
+    return Path(conf["output"]["data_path"]) / conf["output"].get("packed_path", "packed")
 
-    os.system(
-        f'tshark -r "{pcap}" -T json -o "tls.keylog_file:{ssl}" --no-duplicate-keys > "{capture}"'
-    )
+
+def open_store():
+    """Packed store of this process, opened in the worker as sqlite connections must not cross a fork"""
+    global store
+    if store is None:
+        store = PackedStore(packed_path())
+    return store
 
 
 def has_layer(obj, key):
@@ -72,6 +217,8 @@ def get_resources(data, website_call, study_name) -> Tuple[List[resource], str]:
     resources = {}
     first_party = website_call
     is_final_fp = False
+    # frames of streams whose start wasn't captured, reported once per study
+    missing_start = 0
     for packet in data:
         frame = get_layer(packet, "frame")
         frame_nr = int(frame["frame.number"])
@@ -115,8 +262,7 @@ def get_resources(data, website_call, study_name) -> Tuple[List[resource], str]:
                         # HTTP2 Data
                         if not resource_id in resources:
                             # skip because missing starting point
-                            logs.warning(
-                                f"Skip because missing starting point context={website_call}, framenr={frame_nr}, httpstream={http2_id}")
+                            missing_start += 1
                             continue
                         resources[resource_id].add_packet(frame_nr)
 
@@ -152,8 +298,7 @@ def get_resources(data, website_call, study_name) -> Tuple[List[resource], str]:
                             # HTTP response
                             if not resource_id in resources:
                                 # skip because missing starting point
-                                logs.warning(
-                                    f"Skip because missing starting point context={website_call}, framenr={frame_nr}, httpstream={http2_id}")
+                                missing_start += 1
                                 continue
                             resources[resource_id].add_packet(frame_nr)
 
@@ -203,6 +348,9 @@ def get_resources(data, website_call, study_name) -> Tuple[List[resource], str]:
                 elif next(iter(http.values()))["http.response.code"].startswith("2"):
                     is_final_fp = True
 
+    if missing_start:
+        logs.warning(
+            f"Skipped {missing_start} HTTP2 frames because of a missing starting point context={website_call}, study={study_name}")
     return [v for _, v in resources.items()], first_party
 
 
@@ -228,8 +376,10 @@ def get_ip_first(resources, first_party):
     return None
 
 
-def create_resources(data, website, study_name) -> List[resource]:
-    resources, first_party = get_resources(data, website, study_name)
+def create_resources(data, website, study_name, timer: PhaseTimer = None) -> List[resource]:
+    timer = timer or PhaseTimer()
+    with timer.phase("get_resources", study_name):
+        resources, first_party = get_resources(data, website, study_name)
     ip_first = get_ip_first(resources, first_party)
     context = get_fld(first_party, fix_protocol=True)
 
@@ -237,6 +387,15 @@ def create_resources(data, website, study_name) -> List[resource]:
         logs.critical(
             f"Different context called website={website} context={context}")
 
+    set_context(resources, first_party, ip_first, study_name)
+
+    with timer.phase("add_tcp", study_name):
+        add_tcp(data, resources)
+    return resources
+
+
+def set_context(resources, first_party, ip_first, study_name):
+    context = get_fld(first_party, fix_protocol=True)
     for resource in resources:
         resource.first_party = first_party
         resource.context = context
@@ -244,9 +403,6 @@ def create_resources(data, website, study_name) -> List[resource]:
         resource.is_tp = resource.is_thirdparty()
         resource.study_name = study_name
 
-    add_tcp(data, resources)
-    return resources
-
 
 def set_tracker(data, resources):
     for resource in resources:
@@ -256,52 +412,37 @@ def set_tracker(data, resources):
             data[packet_nr - 1]["is_tracker"] = True
 
 
+def prepare_adblock(update=None) -> Dict:
+    """Filter list snapshots and the serialized engine of this run, prepared once before the workers start"""
+    origins = config.literal(conf["preprocess"].get("filterlist"), [])
+    if not isinstance(origins, list):
+        origins = [origins]
+    if update is None:
+        update = conf["preprocess"].getboolean("update_filterlist", False)
+
+    store = FilterListStore(conf["preprocess"].get("filterlist_path", "lists/block"))
+    manifest = store.manifest(origins, update=update)
+    manifest["engine"] = str(store.build_engine(manifest))
+    return manifest
+
+
+def init_worker(path, values, queues):
+    global engine_path, store
+    engine_path = path
+    store = None
+    config.install(values)
+    use_log_queues(queues, conf)
+
+
 def load_adblock():
-    raw_rules = []
-    save_filterlist = conf["preprocess"].getboolean("save_filterlist", True)
-    filterlists = list_files(Path("lists/block"))
-
-    if save_filterlist and len(filterlists) > 0:
-        logs.debug(f"Loading filterlist from {filterlists}")
-        for filterlist in filterlists:
-            logs.debug(f"Reading filterset {filterlist}")
-            with open(filterlist) as f:
-                text_rules = f.read()
-            raw_rules.extend(text_rules.splitlines())
-    else:
-        filterlist_origin = eval(conf["preprocess"].get("filterlist", "[]"))
-        logs.debug(f"Create new filterlist of {filterlist_origin}")
-        if not isinstance(filterlist_origin, list):
-            filterlist_origin = [filterlist_origin]
-
-        for origin in filterlist_origin:
-            if origin.startswith("http"):
-                try:
-                    text_rules = requests.get(origin).text
-                    if save_filterlist:
-                        list_path = (
-                            Path("lists/block") /
-                            urlparse(origin).path.split("/")[-1]
-                        )
-                        write_file(list_path, text_rules)
-                except Exception as e:
-                    logs.critical(e)
-            else:
-                try:
-                    with open(origin) as f:
-                        text_rules = f.read()
-                except Exception as e:
-                    logs.critical(e)
-
-            raw_rules.extend(text_rules.splitlines())
-
-    filterset = adblock.FilterSet()
-    filterset.add_filters(raw_rules)
-
-    return adblock.Engine(filterset)
-
-
-def label_resources(resources: List[resource], adblocker: adblock.Engine) -> None:
+    """Adblock engine of this process, deserialized once instead of parsing the lists per website"""
+    global adblocker
+    if adblocker is None:
+        adblocker = load_engine(engine_path or prepare_adblock()["engine"])
+    return adblocker
+
+
+def label_resources(resources: List[resource], adblocker: "adblock.Engine") -> None:
     """Set tracker attribute for resources according to adblock"""
     for resource in resources:
         hostname = urlparse(resource.url).netloc
@@ -318,6 +459,13 @@ def get_attr(packet, attr):
     return layer[attr] if layer else None
 
 
+@lru_cache(maxsize=None)
+def collect_settings() -> Tuple[Dict, Dict]:
+    """Fields to collect and their casts, parsed once per process"""
+    return (config.literal(conf["preprocess"].get("collect"), {}),
+            config.casts(conf["preprocess"].get("cast")))
+
+
 def collect_data(resources, capture, to_collect, cast={}):
     for k, v in to_collect.items():
         for resource in resources:
@@ -329,54 +477,262 @@ def collect_data(resources, capture, to_collect, cast={}):
             resource.__setattr__(k, collected)
 
 
+def study_location(study):
+    """Website and call hash of a study folder or packed study"""
+    if isinstance(study, PackedStudy):
+        return tuple(study.site.split("/"))
+    return study.parent.parent.name, study.parent.name
+
+
 def preprocess_study(study, adblocker):
-    capture = study / conf["preprocess"].get("capture", "capture.json")
-    if not capture.is_file() or conf["preprocess"].getboolean("override", False):
-        pcap_to_json(study)
+    timer = PhaseTimer()
+    website, call = study_location(study)
+    stats = {"study": f"{website}/{call}/{study.name}", "website": website,
+             "name": study.name, "error": None}
+    start = time.perf_counter()
+    reset_peak_rss()
+
+    profiler = None
+    if conf["preprocess"].getint("profile", 0) > 0:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        resources = _preprocess_study(study, adblocker, timer, stats)
+    except Exception as e:
+        stats["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            stats["profile"] = str(dump_profile(profiler, study))
+        stats["duration"] = round(time.perf_counter() - start, 6)
+        stats["peak_rss"] = peak_rss()
+        stats["phases"] = timer.phases
+
+    return resources, stats
+
+
+def dump_profile(profiler, study):
+    profiles = Path(conf["output"]["data_path"]) / "preprocessed" / "profiles"
+    create_folder(profiles)
+    website, call = study_location(study)
+    path = profiles / f"{website}-{call}-{study.name.replace(' ', '_')}.prof"
+    profiler.dump_stats(path)
+    return path
+
+
+def _preprocess_study(study, adblocker, timer, stats):
+    first_party, _ = study_location(study)
+    mode = conf["preprocess"].get("mode", "full")
+    if mode == "fast":
+        return _preprocess_connections(study, first_party, adblocker, timer, stats)
+    if mode == "browser":
+        return _preprocess_requests(study, first_party, adblocker, timer, stats)
+    if isinstance(study, PackedStudy):
+        # tshark output is parsed while it is streamed, no capture file is written
+        capture = None
+        info = {}
+        with timer.phase("tshark", study.name):
+            data = packed_capture(study, info)
+        stats["capture"] = info
+    else:
+        capture = study / conf["preprocess"].get("capture", "capture.json")
+        if not capture.is_file() or conf["preprocess"].getboolean("override", False):
+            with timer.phase("tshark", study.name):
+                stats["capture"] = pcap_to_json(study)
 
-    first_party = study.parent.parent.name
-    data = load_json(capture)
+        with timer.phase("json_load", study.name):
+            data = load_json(capture)
     if data is None:
-        logs.error(f"No capture found at {capture}")
+        logs.error(f"No capture found at {capture or study.site}")
         return []
+    stats["packets"] = len(data)
+
+    resources = create_resources(data, first_party, study.name, timer)
+    stats["resources"] = len(resources)
+    with timer.phase("label_resources", study.name):
+        label_resources(resources, adblocker)
+
+    with timer.phase("collect_data", study.name):
+        collect, cast = collect_settings()
+        collect_data(resources, data, collect, cast)
+
+    with timer.phase("write_output", study.name):
+        if capture is None:
+            pass
+        elif conf["preprocess"].getboolean("keep_capture", False):
+            set_tracker(data, resources)
+            write_json(data, capture)
+            logs.info(f"Keep capture at {capture}")
+        else:
+            capture.unlink()
 
-    resources = create_resources(data, first_party, study.name)
-    label_resources(resources, adblocker)
+    return resources
 
-    collect = eval(conf["preprocess"].get("collect", "{}"))
-    cast = eval(conf["preprocess"].get("cast", "{}"))
-    collect_data(resources, data, collect, cast)
 
-    if conf["preprocess"].getboolean("keep_capture", False):
-        set_tracker(data, resources)
-        write_json(data, capture)
-        logs.info(f"Keep capture at {capture}")
-    else:
-        capture.unlink()
+def _preprocess_connections(study, website, adblocker, timer, stats):
+    """Fast mode, label one resource per connection by its SNI or DNS name, no decryption"""
+    collect, cast = collect_settings()
+    fields = connections.tshark_fields(collect)
 
+    info = {}
+    with timer.phase("tshark", study.name):
+        rows = connection_rows(study, info, fields)
+    stats["capture"] = info
+    if rows is None:
+        return []
+    stats["packets"] = len(rows)
+
+    with timer.phase("get_resources", study.name):
+        resources = connections.create_connections(rows, website, study.name)
+        first_party, ip_first = connections.find_first_party(resources, website)
+        set_context(resources, first_party, ip_first, study.name)
+    stats["resources"] = len(resources)
+
+    with timer.phase("label_resources", study.name):
+        label_resources(resources, adblocker)
+
+    with timer.phase("collect_data", study.name):
+        connections.collect_fields(resources, rows, collect, cast)
     return resources
 
 
-def run(cur_dir):
-    logs.debug(f"Preprocess {cur_dir}")
+def read_requests(study):
+    """Requests of the browser's network log of a study, None if it wasn't recorded"""
+    name = conf["crawler"].get("network_log", "network.jsonl")
+    if isinstance(study, PackedStudy):
+        if not study.store.exists(study.site, study.member(name)):
+            return None
+        with io.TextIOWrapper(study.store.open(study.site, study.member(name))) as f:
+            return read_network_log(f)
+    if not (study / name).is_file():
+        return None
+    with open(study / name) as f:
+        return read_network_log(f)
+
+
+def _preprocess_requests(study, website, adblocker, timer, stats):
+    """Browser mode, label the requests of the network log and join them to the capture, no decryption"""
+    collect, cast = collect_settings()
+    fields = connections.tshark_fields(collect)
+
+    with timer.phase("json_load", study.name):
+        browser_requests = read_requests(study)
+    if browser_requests is None:
+        logs.error(f"No network log found for {study}")
+        return []
+
+    info = {}
+    with timer.phase("tshark", study.name):
+        rows = connection_rows(study, info, fields)
+    stats["capture"] = info
+    if rows is None:
+        return []
+    stats["packets"] = len(rows)
+
+    with timer.phase("get_resources", study.name):
+        resources, unmatched = connections.join_requests(browser_requests, rows, website, study.name)
+        document = next((r for r in browser_requests if r.get("type") == "Document"), None)
+        if document:
+            first_party, ip_first = urlparse(document["url"]).netloc, document.get("remote_ip")
+        else:
+            first_party, ip_first = connections.find_first_party(resources, website)
+        set_context(resources, first_party, ip_first, study.name)
+    stats["resources"] = len(resources)
+    stats["unmatched_requests"] = unmatched
+
+    with timer.phase("label_resources", study.name):
+        label_resources(resources, adblocker)
+
+    with timer.phase("collect_data", study.name):
+        connections.collect_fields(resources, rows, collect, cast)
+    return resources
+
+
+def prevalence_sketch():
+    return PrevalenceSketch(conf["preprocess"].getint("sketch_precision", 12),
+                            conf["preprocess"].getint("sketch_width", 65536),
+                            conf["preprocess"].getint("sketch_depth", 4),
+                            conf["preprocess"].getint("sketch_keys", 5000))
+
+
+def preprocess_studies(studies, resources_path):
     adblocker = load_adblock()
-    study_folders = [x for x in cur_dir.iterdir() if x.is_dir()]
     resources = []
-    for study in study_folders:
-        resources.extend(preprocess_study(study, adblocker))
+    stats = []
+    sketch = prevalence_sketch()
+    for study in studies:
+        study_resources, study_stats = preprocess_study(study, adblocker)
+        sketch.add_resources(study_resources)
+        resources.extend(study_resources)
+        stats.append(study_stats)
 
     resources = [resource.__dict__ for resource in resources]
+    deltas = diff_site(resources)
 
     if conf["preprocess"].getboolean("keep_resource", True):
-        resources_path = cur_dir / \
-            conf["preprocess"].get("resources", "resources.json")
         logs.debug(f"resources at {resources_path}")
         write_json(resources, resources_path)
+    return resources, stats, sketch, deltas
+
+
+def run(cur_dir):
+    logs.debug(f"Preprocess {cur_dir}")
+    study_folders = [x for x in cur_dir.iterdir() if x.is_dir()]
+    resources_path = cur_dir / \
+        conf["preprocess"].get("resources", "resources.json")
+    result = preprocess_studies(study_folders, resources_path)
     logs.info(f"Finished {cur_dir}")
-    return resources
+    return result
+
+
+def run_packed(site):
+    logs.debug(f"Preprocess packed {site}")
+    store = open_store()
+    studies = [PackedStudy(store, site, name) for name in store.studies(site)]
+    resources_path = store.sidecar(
+        site, conf["preprocess"].get("resources", "resources.json"))
+    result = preprocess_studies(studies, resources_path)
+    logs.info(f"Finished {site}")
+    return result
+
+
+def capture_report(stats):
+    """Disk usage and tshark decode throughput per compression method"""
+    report = {}
+    for study_stats in stats:
+        info = study_stats.get("capture")
+        if not info or "raw_bytes" not in info:
+            continue
+        method = info["compression"] or "none"
+        entry = report.setdefault(
+            method, {"studies": 0, "stored_bytes": 0, "raw_bytes": 0, "tshark_seconds": 0.})
+        entry["studies"] += 1
+        entry["stored_bytes"] += info["stored_bytes"]
+        entry["raw_bytes"] += info["raw_bytes"]
+        entry["tshark_seconds"] += sum(p["duration"]
+                                       for p in study_stats["phases"] if p["phase"] == "tshark")
+
+    for entry in report.values():
+        entry["ratio"] = round(entry["raw_bytes"] / entry["stored_bytes"], 3) if entry["stored_bytes"] else None
+        seconds = entry["tshark_seconds"]
+        entry["decode_mb_per_second"] = round(entry["raw_bytes"] / 1e6 / seconds, 3) if seconds else None
+    return report
+
+
+def keep_slowest_profiles(stats, n):
+    """Delete the profiles of all but the n slowest studies"""
+    profiled = sorted((s for s in stats if "profile" in s),
+                      key=lambda s: s["duration"], reverse=True)
+    for s in profiled[n:]:
+        Path(s["profile"]).unlink(missing_ok=True)
+        del s["profile"]
+    return [s["profile"] for s in profiled[:n]]
 
 
 def final(resources, out_path):
+    import pandas as pd
     logs.debug("Generate resources")
     resources = pd.DataFrame(resources)
 
@@ -425,22 +781,28 @@ def final(resources, out_path):
 
 
 def main():
+    from tqdm import tqdm
+    init_logger("Preprocessor", conf, verbose=True)
     if not check_requirements():
         exit()
 
     logs.info(f"Configuration used {config.todict(conf)}")
-    raw = Path(conf["output"]["data_path"]) / "raw"
-    logs.info(f"Reading from {raw}")
-    folders = [
-        Path(cur_dir)
-        for parent_dir in list_dir(raw)
-        for cur_dir in list_dir(parent_dir)
-    ]
-
-    resources = []
-    with ProcessPoolExecutor() as executor:
-        for resource in tqdm(executor.map(run, folders), total=len(folders)):
-            resources.extend(resource)
+    if conf["output"].getboolean("packed", False):
+        # the index lists the corpus, no directory walk
+        index = PackedStore(packed_path())
+        logs.info(f"Reading from {index.root}")
+        folders = index.sites()
+        index.close()
+        run_site = run_packed
+    else:
+        raw = Path(conf["output"]["data_path"]) / "raw"
+        logs.info(f"Reading from {raw}")
+        folders = [
+            Path(cur_dir)
+            for parent_dir in list_dir(raw)
+            for cur_dir in list_dir(parent_dir)
+        ]
+        run_site = run
 
     resources_path = (
         Path(conf["output"]["data_path"])
@@ -448,7 +810,58 @@ def main():
         / conf["preprocess"].get("resources", "resources.csv")
     )
     resources_path = resources_path.with_suffix(".csv")
-    final(resources, resources_path)
+    metrics = MetricsWriter(resources_path.with_name(f"{resources_path.stem}_stages.jsonl"),
+                            resources_path.with_name(f"{resources_path.stem}_stages.prom"),
+                            prefix="preprocess")
+
+    filterlists = prepare_adblock()
+    write_json(filterlists, resources_path.with_name(f"{resources_path.stem}_filterlists.json"))
+    logs.info(f"Filter lists {filterlists['version']}: {[s['snapshot'] for s in filterlists['lists'].values()]}")
+
+    # results of the sites by their position, the resources are written in the order of the folders
+    sites = [None] * len(folders)
+    # the sketches of the sites are merged as they finish, prevalence needs no pass over the resources
+    sketch = prevalence_sketch()
+    graph = GraphBuilder()
+    # the workers diff the studies of their site, the table grows as sites finish
+    with DeltaWriter(resources_path.with_name(f"{resources_path.stem}_consent_diff.csv")) as deltas, \
+            ProcessPoolExecutor(initializer=init_worker,
+                                initargs=(filterlists["engine"], config.todict(conf), log_queues())) as executor:
+        futures = {executor.submit(run_site, folder): i for i, folder in enumerate(folders)}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            resource, study_stats, site_sketch, site_deltas = future.result()
+            sites[futures[future]] = (resource, study_stats)
+            sketch.merge(site_sketch)
+            deltas.write(site_deltas)
+            graph.add_resources(resource)
+    resources = [r for resource, _ in sites for r in resource]
+    stats = [s for _, study_stats in sites for s in study_stats]
+    logs.info(f"Consent diff of {deltas.rows} websites at {deltas.file.name}")
+
+    graph.write(resources_path.with_name(f"{resources_path.stem}_graph.npz"))
+    sketch.save(resources_path.with_name(f"{resources_path.stem}_sketch.json"))
+    prevalence = resources_path.with_name(f"{resources_path.stem}_prevalence.csv")
+    write_rankings(sketch, prevalence)
+    logs.info(f"Prevalence of {round(sketch.first_parties.count())} first parties at {prevalence}, error {sketch.error()}")
+
+    profiles = keep_slowest_profiles(
+        stats, conf["preprocess"].getint("profile", 0))
+    for study_stats in stats:
+        metrics.record(study_stats)
+
+    timer = PhaseTimer()
+    with timer.phase("final"):
+        final(resources, resources_path)
+    with timer.phase("flow_cube"):
+        write_cube(resources, resources_path.with_name(f"{resources_path.stem}_flow.npz"),
+                   conf["preprocess"].getfloat("flow_bin", 1.), conf["preprocess"].getint("flow_bins", 120))
+    metrics.record({"study": None, "phases": timer.phases, "error": None})
+    metrics.close()
+
+    summary = resources_path.with_name(f"{resources_path.stem}_profile.json")
+    write_json(metrics.summary(profiles=profiles, captures=capture_report(stats),
+                               filterlists=filterlists["version"]), summary)
+    logs.info(f"Stage report at {summary}")
 
 
 if __name__ == "__main__":
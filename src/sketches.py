@@ -0,0 +1,335 @@
+import argparse
+import base64
+import csv
+import hashlib
+import json
+import math
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+
+def hash64(value: str) -> int:
+    """Stable 64 bit hash, the builtin hash is salted per process"""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "little")
+
+
+class HyperLogLog:
+    """Mergeable estimate of the number of distinct values.
+
+    The relative standard error is 1.04 / sqrt(2 ** precision), 1.6% for the
+    default precision of 12. Registers are kept sparse as long as the dict
+    is smaller than the dense array, m / 64 entries of about 64 bytes each,
+    so the long tail of keys seen on a few sites stays small.
+    """
+
+    def __init__(self, precision=12) -> None:
+        self.precision = precision
+        self.m = 1 << precision
+        self.sparse = {}
+        self.sparse_limit = self.m // 64
+        self.registers = None
+
+    def add_hash(self, h: int):
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) > self.sparse_limit:
+                self._densify()
+
+    def add(self, value: str):
+        self.add_hash(hash64(value))
+
+    def filled(self) -> int:
+        """Non-zero registers, grows with the cardinality until the registers saturate"""
+        if self.registers is None:
+            return len(self.sparse)
+        return self.m - self.registers.count(0)
+
+    def _densify(self):
+        self.registers = bytearray(self.m)
+        for index, rank in self.sparse.items():
+            self.registers[index] = rank
+        self.sparse = {}
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError(f"Can't merge precision {other.precision} into {self.precision}")
+        if other.registers is None:
+            for index, rank in other.sparse.items():
+                if self.registers is not None:
+                    self.registers[index] = max(self.registers[index], rank)
+                elif rank > self.sparse.get(index, 0):
+                    self.sparse[index] = rank
+            if self.registers is None and len(self.sparse) > self.sparse_limit:
+                self._densify()
+            return
+        if self.registers is None:
+            self._densify()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> float:
+        ranks = self.registers if self.registers is not None else self.sparse.values()
+        zeros = self.m - sum(1 for r in ranks if r) if self.registers is not None else self.m - len(self.sparse)
+        total = zeros + sum(2.0 ** -r for r in ranks if r)
+        estimate = 0.7213 / (1 + 1.079 / self.m) * self.m * self.m / total
+        if estimate <= 2.5 * self.m and zeros:
+            # linear counting is more accurate for small cardinalities
+            return self.m * math.log(self.m / zeros)
+        return estimate
+
+    def todict(self) -> Dict:
+        if self.registers is not None:
+            return {"registers": base64.b64encode(bytes(self.registers)).decode()}
+        return {"sparse": self.sparse}
+
+    @classmethod
+    def fromdict(cls, data: Dict, precision=12) -> "HyperLogLog":
+        sketch = cls(precision)
+        if "registers" in data:
+            sketch.registers = bytearray(base64.b64decode(data["registers"]))
+        else:
+            sketch.sparse = {int(index): rank for index, rank in data["sparse"].items()}
+            if len(sketch.sparse) > sketch.sparse_limit:
+                # saved with the earlier limit of m / 4
+                sketch._densify()
+        return sketch
+
+
+class CountMinSketch:
+    """Mergeable counts of keys which never underestimate.
+
+    An estimate exceeds the true count by at most e / width * total with a
+    probability of 1 - exp(-depth), for the defaults 0.004% of all counted
+    requests with 98% confidence. Counts are exact until more keys than the
+    width are seen.
+    """
+
+    def __init__(self, width=65536, depth=4) -> None:
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.exact = {}
+        self.table = None
+
+    def _indices(self, key: str):
+        h = hash64(key)
+        low, high = h & 0xffffffff, h >> 32
+        return [(row * self.width + (low + row * high) % self.width) for row in range(self.depth)]
+
+    def add(self, key: str, count=1):
+        self.total += count
+        if self.table is None:
+            self.exact[key] = self.exact.get(key, 0) + count
+            if len(self.exact) > self.width:
+                self._densify()
+            return
+        for index in self._indices(key):
+            self.table[index] += count
+
+    def _densify(self):
+        self.table = array("q", bytes(8 * self.width * self.depth))
+        exact, self.exact = self.exact, {}
+        for key, count in exact.items():
+            for index in self._indices(key):
+                self.table[index] += count
+
+    def merge(self, other: "CountMinSketch"):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError(f"Can't merge {other.width}x{other.depth} into {self.width}x{self.depth}")
+        if other.table is None:
+            for key, count in other.exact.items():
+                self.add(key, count)
+            return
+        if self.table is None:
+            self._densify()
+        self.total += other.total
+        for index, count in enumerate(other.table):
+            self.table[index] += count
+
+    def estimate(self, key: str) -> int:
+        if self.table is None:
+            return self.exact.get(key, 0)
+        return min(self.table[index] for index in self._indices(key))
+
+    def todict(self) -> Dict:
+        if self.table is not None:
+            return {"total": self.total, "table": base64.b64encode(self.table.tobytes()).decode()}
+        return {"total": self.total, "exact": self.exact}
+
+    @classmethod
+    def fromdict(cls, data: Dict, width=65536, depth=4) -> "CountMinSketch":
+        sketch = cls(width, depth)
+        sketch.total = data["total"]
+        if "table" in data:
+            sketch.table = array("q")
+            sketch.table.frombytes(base64.b64decode(data["table"]))
+        else:
+            sketch.exact = dict(data["exact"])
+        return sketch
+
+
+class PrevalenceSketch:
+    """Distinct first parties and requests per hostname and per ip of a partition of the corpus.
+
+    Every worker sketches the sites it preprocesses and the sketches are
+    merged, the prevalence of a key is its distinct first parties relative to
+    all first parties as ip_prevalence of the notebooks.
+
+    At most 2 * keys hostnames and ips of each kind keep a HyperLogLog, each
+    at most 2 ** precision bytes of registers or a sparse dict of the same
+    size, about 4 KiB at precision 12. With the count-min tables of
+    8 * width * depth bytes per kind the sketch stays below
+    2 * (2 * keys * 4.2 KiB + 8 * width * depth), 90 MB for the defaults,
+    however many keys the corpus has. Beyond 2 * keys the keys with the
+    fewest first parties are evicted down to keys. A key which comes back
+    after its eviction misses the first parties counted before, so only the
+    keys ranked above evicted_max_first_parties of error() are complete.
+    """
+
+    KINDS = ("hostname", "ip")
+
+    def __init__(self, precision=12, width=65536, depth=4, keys=5000) -> None:
+        self.precision = precision
+        self.width = width
+        self.depth = depth
+        self.keys = keys
+        self.first_parties = HyperLogLog(precision)
+        self.parties = {kind: {} for kind in self.KINDS}
+        self.requests = {kind: CountMinSketch(width, depth) for kind in self.KINDS}
+        self.evicted = {kind: 0 for kind in self.KINDS}
+        self.evicted_max = {kind: 0. for kind in self.KINDS}
+
+    def add_resources(self, resources: Iterable):
+        pairs = set()
+        for r in resources:
+            if not r.first_party:
+                continue
+            for kind, key in zip(self.KINDS, (r.hostname, r.ip)):
+                if key:
+                    pairs.add((kind, key, r.first_party))
+                    self.requests[kind].add(key)
+
+        hashes = {}
+        for kind, key, first_party in pairs:
+            if first_party not in hashes:
+                hashes[first_party] = hash64(first_party)
+                self.first_parties.add_hash(hashes[first_party])
+            sketch = self.parties[kind].get(key)
+            if sketch is None:
+                sketch = self.parties[kind][key] = HyperLogLog(self.precision)
+            sketch.add_hash(hashes[first_party])
+        self._evict()
+
+    def _evict(self):
+        """Keep the keys with the most first parties once a kind has more than 2 * keys"""
+        for kind in self.KINDS:
+            parties = self.parties[kind]
+            if len(parties) <= 2 * self.keys:
+                continue
+            # filled registers rank like the cardinality and are counted in C, count() is for the evicted only
+            ranked = sorted(parties, key=lambda key: parties[key].filled(), reverse=True)
+            for key in ranked[self.keys:]:
+                self.evicted_max[kind] = max(self.evicted_max[kind], parties.pop(key).count())
+            self.evicted[kind] += len(ranked) - self.keys
+
+    def merge(self, other: "PrevalenceSketch"):
+        self.first_parties.merge(other.first_parties)
+        for kind in self.KINDS:
+            parties = self.parties[kind]
+            for key, sketch in other.parties[kind].items():
+                if key in parties:
+                    parties[key].merge(sketch)
+                else:
+                    parties[key] = sketch
+            self.requests[kind].merge(other.requests[kind])
+            self.evicted[kind] += other.evicted[kind]
+            self.evicted_max[kind] = max(self.evicted_max[kind], other.evicted_max[kind])
+        self._evict()
+        return self
+
+    def rankings(self, limit=None) -> List[Dict]:
+        """Keys of every kind by their distinct first parties, the most prevalent first"""
+        total = self.first_parties.count()
+        rows = []
+        for kind in self.KINDS:
+            ranked = sorted(((key, sketch.count()) for key, sketch in self.parties[kind].items()),
+                            key=lambda x: x[1], reverse=True)
+            for key, first_parties in ranked[:limit]:
+                rows.append({"kind": kind, "key": key, "first_parties": round(first_parties, 1),
+                             "prevalence": round(first_parties / total, 6) if total else 0.,
+                             "requests": self.requests[kind].estimate(key)})
+        return rows
+
+    def error(self) -> Dict:
+        return {"first_parties_relative_std": round(1.04 / math.sqrt(1 << self.precision), 6),
+                "requests_max_overcount": {kind: math.ceil(math.e / self.width * self.requests[kind].total)
+                                           for kind in self.KINDS},
+                "requests_confidence": round(1 - math.exp(-self.depth), 6),
+                "evicted_keys": dict(self.evicted),
+                "evicted_max_first_parties": {kind: round(n, 1) for kind, n in self.evicted_max.items()}}
+
+    def todict(self) -> Dict:
+        return {"precision": self.precision, "width": self.width, "depth": self.depth, "keys": self.keys,
+                "evicted": self.evicted, "evicted_max": self.evicted_max,
+                "first_parties": self.first_parties.todict(),
+                "parties": {kind: {key: s.todict() for key, s in keys.items()} for kind, keys in self.parties.items()},
+                "requests": {kind: s.todict() for kind, s in self.requests.items()}}
+
+    @classmethod
+    def fromdict(cls, data: Dict) -> "PrevalenceSketch":
+        # sketches of earlier versions have no key limit and evicted nothing
+        sketch = cls(data["precision"], data["width"], data["depth"], data.get("keys", 5000))
+        sketch.evicted.update(data.get("evicted", {}))
+        sketch.evicted_max.update(data.get("evicted_max", {}))
+        sketch.first_parties = HyperLogLog.fromdict(data["first_parties"], sketch.precision)
+        for kind in cls.KINDS:
+            sketch.parties[kind] = {key: HyperLogLog.fromdict(s, sketch.precision)
+                                    for key, s in data["parties"][kind].items()}
+            sketch.requests[kind] = CountMinSketch.fromdict(data["requests"][kind], sketch.width, sketch.depth)
+        sketch._evict()
+        return sketch
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.todict(), f)
+
+    @classmethod
+    def load(cls, path) -> "PrevalenceSketch":
+        with open(path) as f:
+            return cls.fromdict(json.load(f))
+
+
+def write_rankings(sketch: PrevalenceSketch, path, limit=None):
+    rows = sketch.rankings(limit)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["kind", "key", "first_parties", "prevalence", "requests"])
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the prevalence sketches of several crawls or partitions")
+    parser.add_argument("sketches", nargs="+", help="sketch files written by the preprocessing")
+    parser.add_argument("--output", default="prevalence.csv")
+    parser.add_argument("--sketch", default=None, help="also save the merged sketch")
+    parser.add_argument("--limit", type=int, default=None, help="top keys per kind")
+    args = parser.parse_args()
+
+    merged = PrevalenceSketch.load(args.sketches[0])
+    for path in args.sketches[1:]:
+        merged.merge(PrevalenceSketch.load(path))
+    if args.sketch:
+        merged.save(args.sketch)
+    n = write_rankings(merged, Path(args.output), args.limit)
+    print(f"{n} keys at {args.output}, {round(merged.first_parties.count())} first parties, error {merged.error()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+from utils.utility import create_folder
+
+# upper bounds of the duration histograms in seconds
+BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process (Linux only)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, None if unknown"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def outcome_code(error: Exception = None) -> str:
+    if error is None:
+        return "ok"
+    if "timeout" in type(error).__name__.lower():
+        return "timeout"
+    return "error"
+
+
+class PhaseTimer:
+    """Records duration and outcome of the phases of a crawl or preprocessing run"""
+
+    def __init__(self) -> None:
+        self.phases: List[Dict] = []
+
+    @contextmanager
+    def phase(self, name, study=None):
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.add(name, time.perf_counter() - start, study, error)
+
+    def add(self, name, duration, study=None, error: Exception = None):
+        record = {"phase": name, "study": study, "duration": round(duration, 6),
+                  "outcome": outcome_code(error)}
+        if error is not None:
+            record["error_class"] = type(error).__name__
+        self.phases.append(record)
+
+    def total(self, name):
+        return sum(p["duration"] for p in self.phases if p["phase"] == name)
+
+
+class Histogram:
+
+    def __init__(self) -> None:
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+def labels(**kwargs):
+    return ",".join(f'{k}="{v}"' for k, v in kwargs.items())
+
+
+class MetricsWriter:
+    """Writes one JSON line per record and aggregates them into a Prometheus text file"""
+
+    def __init__(self, jsonl_path, prom_path, prefix="crawl") -> None:
+        self.jsonl_path = Path(jsonl_path)
+        self.prom_path = Path(prom_path)
+        self.prefix = prefix
+        self.run = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        create_folder(self.jsonl_path.parent)
+        self.jsonl = open(self.jsonl_path, "a")
+
+        self.phases = defaultdict(Histogram)
+        self.phase_outcomes = defaultdict(int)
+        self.totals = Histogram()
+        self.outcomes = defaultdict(int)
+        self.slowest = []
+
+    @classmethod
+    def from_config(cls, config, name="crawl"):
+        directory = Path(config["logging"].get("directory", "logs"))
+        stamp = datetime.today().strftime("%Y-%m-%d-%H%M%S")
+        return cls(directory / f"{name}-metrics-{stamp}.jsonl",
+                   directory / f"{name}-metrics.prom", prefix=name)
+
+    def record(self, record: Dict):
+        """Account a record with 'phases', its overall 'duration' and an 'error' if it failed"""
+        record = dict(record, run=self.run)
+        self.jsonl.write(json.dumps(record, default=str) + "\n")
+        self.jsonl.flush()
+
+        for phase in record.get("phases", []):
+            self.phases[phase["phase"]].observe(phase["duration"])
+            self.phase_outcomes[(phase["phase"], phase["outcome"])] += 1
+
+        self.outcomes["error" if record.get("error") else "ok"] += 1
+        if "duration" in record:
+            self.totals.observe(record["duration"])
+            self.slowest = sorted(self.slowest + [record],
+                                  key=lambda r: r["duration"], reverse=True)[:10]
+
+    def write_prometheus(self):
+        p = self.prefix
+        lines = [f"# HELP {p}_phase_seconds Duration of the phases",
+                 f"# TYPE {p}_phase_seconds histogram"]
+        for phase, histogram in sorted(self.phases.items()):
+            lines.extend(self._histogram(f"{p}_phase_seconds", histogram, phase=phase))
+
+        lines.extend([f"# HELP {p}_phase_outcomes_total Outcome of the phases",
+                      f"# TYPE {p}_phase_outcomes_total counter"])
+        for (phase, outcome), count in sorted(self.phase_outcomes.items()):
+            lines.append(f"{p}_phase_outcomes_total{{{labels(phase=phase, outcome=outcome)}}} {count}")
+
+        lines.extend([f"# HELP {p}_total Finished records by outcome",
+                      f"# TYPE {p}_total counter"])
+        for outcome, count in sorted(self.outcomes.items()):
+            lines.append(f"{p}_total{{{labels(outcome=outcome)}}} {count}")
+
+        lines.extend([f"# HELP {p}_seconds Overall duration per record",
+                      f"# TYPE {p}_seconds histogram"])
+        lines.extend(self._histogram(f"{p}_seconds", self.totals))
+
+        create_folder(self.prom_path.parent)
+        with open(self.prom_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def _histogram(self, name, histogram, **kwargs):
+        label = labels(**kwargs)
+        sep = "," if label else ""
+        lines = [f'{name}_bucket{{{label}{sep}le="{bound}"}} {count}'
+                 for bound, count in zip(BUCKETS, histogram.buckets)]
+        lines.append(f'{name}_bucket{{{label}{sep}le="+Inf"}} {histogram.count}')
+        lines.append(f"{name}_sum{{{label}}} {histogram.sum:.6f}" if label else f"{name}_sum {histogram.sum:.6f}")
+        lines.append(f"{name}_count{{{label}}} {histogram.count}" if label else f"{name}_count {histogram.count}")
+        return lines
+
+    def summary(self, **extra) -> Dict:
+        """Totals per phase, sorted by the time spent, and the slowest records"""
+        phases = {phase: {"count": h.count, "total": round(h.sum, 3), "mean": round(h.sum / h.count, 6)}
+                  for phase, h in sorted(self.phases.items(), key=lambda item: item[1].sum, reverse=True)}
+        return dict({"run": self.run, "records": dict(self.outcomes), "phases": phases,
+                     "slowest": [{k: v for k, v in r.items() if k != "phases"} for r in self.slowest]}, **extra)
+
+    def close(self):
+        self.jsonl.close()
+        self.write_prometheus()
@@ -0,0 +1,222 @@
+import argparse
+import ast
+import hashlib
+import joblib
+import json
+import logging
+import time
+import config
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from pathlib import Path
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import GridSearchCV, StratifiedGroupKFold
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.tree import DecisionTreeClassifier
+from typing import Dict, List
+from utils.utility import create_folder, init_logger, write_json
+
+conf = config.load_config()
+logs = logging.getLogger("Training")
+
+# bump when the features change, cached matrices of older versions are not reused
+FEATURES_VERSION = 1
+LIST_COLUMNS = ["packets", "sizes", "ip_src", "rel_time", "incoming", "incoming_sizes", "outgoing", "outgoing_sizes"]
+META_COLUMNS = ["study_name", "website_call", "ip", "first_party", "url", "is_tp", "is_tracker"]
+STATS = ("sum", "mean", "rsd", "min", "max", "span")
+
+# grids of the sweep, the estimator parameters are prefixed with the pipeline step
+MODELS = {
+    "dt": {"min_samples_leaf": [1, 5, 10, 15], "max_depth": [None, 20, 15, 12, 10, 8]},
+    "lr": {"C": [10 ** -4, 10 ** -3, 10 ** -2, 10 ** -1, 1]},
+}
+
+
+def file_digest(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_resources(path) -> pd.DataFrame:
+    """Resources written by the preprocessing with the lists parsed and times relative to the first resource"""
+    df = pd.read_csv(path)
+    for column in LIST_COLUMNS:
+        df[column] = [ast.literal_eval(value) for value in df[column]]
+    first = df.groupby(["study_name", "website_call"])["start_time"].transform("min")
+    df["rel_time"] = [[round(t - start, 5) for t in times] for times, start in zip(df["rel_time"], first)]
+    return df
+
+
+def descriptive(values, level, name) -> Dict:
+    """Statistics of a list as in the notebooks, nan for empty lists"""
+    a = np.asarray(values, dtype=float)
+    if not len(a):
+        return {f"{level}:{f}({name})": np.nan for f in STATS}
+    mean = a.mean()
+    low, high = a.min(), a.max()
+    return {f"{level}:sum({name})": round(a.sum(), 3), f"{level}:mean({name})": round(mean, 3),
+            f"{level}:rsd({name})": round(a.std() / mean, 3) if mean else np.nan,
+            f"{level}:min({name})": round(low, 3), f"{level}:max({name})": round(high, 3),
+            f"{level}:span({name})": round(high - low, 3)}
+
+
+def resource_features(r) -> Dict:
+    features = {"R:count(packets)": len(r.packets), "R:count(in packets)": len(r.incoming),
+                "R:count(out packets)": len(r.outgoing)}
+    for column, name in (("sizes", "packet sizes"), ("incoming_sizes", "in packet sizes"),
+                         ("outgoing_sizes", "out packet sizes"), ("rel_time", "rel time")):
+        features.update(descriptive(getattr(r, column), "R", name))
+    features["R:delta resource time"] = r.delta_time
+    return features
+
+
+def unique_packets(packets_lists, *value_lists):
+    """Values of the packets of a communication, a packet multiplexed into several resources counts once"""
+    seen = set()
+    values = [[] for _ in value_lists]
+    for i, packets in enumerate(packets_lists):
+        for j, packet in enumerate(packets):
+            if packet in seen:
+                continue
+            seen.add(packet)
+            for k, value_list in enumerate(value_lists):
+                values[k].append(value_list[i][j])
+    return len(seen), values
+
+
+def communication_features(group) -> Dict:
+    n_packets, (sizes, rel_time) = unique_packets(group["packets"].tolist(), group["sizes"].tolist(),
+                                                  group["rel_time"].tolist())
+    n_in, (in_sizes,) = unique_packets(group["incoming"].tolist(), group["incoming_sizes"].tolist())
+    n_out, (out_sizes,) = unique_packets(group["outgoing"].tolist(), group["outgoing_sizes"].tolist())
+    features = {"C:count(packets)": n_packets, "C:count(in packets)": n_in, "C:count(out packets)": n_out}
+    for values, name in ((sizes, "packet sizes"), (in_sizes, "in packet sizes"),
+                         (out_sizes, "out packet sizes"), (rel_time, "rel time")):
+        features.update(descriptive(values, "C", name))
+    return features
+
+
+def extract_features(df) -> pd.DataFrame:
+    """Communication (study, website, ip) and resource features of every resource, -1 if undefined"""
+    resources = pd.DataFrame([resource_features(r) for r in df.itertuples()], index=df.index)
+    keys = ["study_name", "website_call", "ip"]
+    communications = pd.DataFrame({key: communication_features(group) for key, group in df.groupby(keys)}).T
+    communications.index.names = keys
+    communications = df[keys].join(communications, on=keys).drop(columns=keys)
+    return pd.concat([communications, resources], axis=1).fillna(-1)
+
+
+def cached_features(path, cache_dir) -> pd.DataFrame:
+    """Features and meta columns of a resources file, cached by the content of the file and the feature version"""
+    key = hashlib.sha256(f"{file_digest(path)}-{FEATURES_VERSION}".encode()).hexdigest()[:24]
+    cache = Path(cache_dir) / f"{key}.pkl"
+    if cache.is_file():
+        logs.info(f"Features from cache {cache}")
+        return pd.read_pickle(cache)
+
+    start = time.perf_counter()
+    df = load_resources(path)
+    features = pd.concat([df[META_COLUMNS], extract_features(df)], axis=1)
+    create_folder(cache.parent)
+    features.to_pickle(cache)
+    logs.info(f"Extracted {features.shape[1] - len(META_COLUMNS)} features of {len(features)} resources "
+          f"in {time.perf_counter() - start:.1f} s, cached at {cache}")
+    return features
+
+
+class IpPrevalence(BaseEstimator, TransformerMixin):
+    """Adds C:prevalence(ip), the first parties of an ip in the training data, and drops the non-numeric columns.
+
+    Fitted per fold, so the prevalence of a test fold isn't learned from itself.
+    """
+
+    def fit(self, X, y=None):
+        self.prevalence_ = X.groupby("ip")["first_party"].nunique()
+        return self
+
+    def transform(self, X):
+        X = X.drop(columns=["ip", "first_party"]).assign(
+            **{"C:prevalence(ip)": X["ip"].map(self.prevalence_).fillna(-1)})
+        return X.to_numpy(dtype=float)
+
+
+def create_pipeline(model, prevalence=True):
+    steps = [("prevalence", IpPrevalence())] if prevalence else []
+    if model == "dt":
+        steps.append(("model", DecisionTreeClassifier(min_samples_leaf=5, class_weight="balanced")))
+    else:
+        steps += [("scale", StandardScaler()),
+                  ("model", LogisticRegression(solver="liblinear", penalty="l1", C=10 ** -4, class_weight="balanced"))]
+    return Pipeline(steps)
+
+
+def feature_columns(features, subset="all") -> List[str]:
+    columns = [c for c in features.columns if c not in META_COLUMNS]
+    if subset == "resource":
+        return [c for c in columns if c.startswith("R:")]
+    if subset == "communication":
+        columns = [c for c in columns if c.startswith("C:")]
+    # ip and first party for the prevalence of the ip
+    return columns + ["ip", "first_party"]
+
+
+def sweep(features, model, grid, subset="all", folds=5, jobs=-1, seed=0):
+    """Grid search with folds grouped by website, every website is either in the training or the test data"""
+    X = features[feature_columns(features, subset)]
+    y = features["is_tracker"].astype(bool)
+    search = GridSearchCV(create_pipeline(model, subset != "resource"), {f"model__{k}": v for k, v in grid.items()},
+                          cv=StratifiedGroupKFold(folds, shuffle=True, random_state=seed),
+                          scoring=["f1", "precision", "recall", "accuracy"], refit="f1", n_jobs=jobs)
+    search.fit(X, y, groups=features["website_call"])
+    return search
+
+
+def save_run(search, model, out_dir, **info) -> Path:
+    """Persist the refitted best model and the metrics of every parameter combination"""
+    run = Path(out_dir) / f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}-{model}"
+    create_folder(run)
+    joblib.dump(search.best_estimator_, run / "model.joblib")
+    results = pd.DataFrame(search.cv_results_)
+    results["params"] = results["params"].apply(json.dumps)
+    results.to_csv(run / "cv_results.csv", index=False)
+    write_json(dict(info, model=model, best_params=search.best_params_, best_f1=search.best_score_,
+                    scores={metric: results.loc[search.best_index_, f"mean_test_{metric}"]
+                            for metric in ("f1", "precision", "recall", "accuracy")}), run / "metrics.json")
+    return run
+
+
+def main():
+    data_path = Path(conf["output"].get("data_path", "data"))
+    parser = argparse.ArgumentParser(description="Train the tracker classifiers with folds grouped by website")
+    parser.add_argument("--resources", default=str(data_path / "preprocessed" / "resources.csv"))
+    parser.add_argument("--models", default="dt,lr", help="comma separated, dt and/or lr")
+    parser.add_argument("--features", default="all", choices=["all", "communication", "resource"])
+    parser.add_argument("--grid", default=None, help="json of parameter lists, replaces the default grid")
+    parser.add_argument("--folds", type=int, default=conf["training"].getint("folds", 5))
+    parser.add_argument("--jobs", type=int, default=conf["training"].getint("jobs", -1),
+                        help="parallel fits, -1 for all cores")
+    parser.add_argument("--seed", type=int, default=conf["training"].getint("seed", 0))
+    args = parser.parse_args()
+    init_logger("Training", conf)
+
+    cache_dir = data_path / conf["training"].get("features", "features")
+    features = cached_features(args.resources, cache_dir)
+    for model in args.models.split(","):
+        grid = json.loads(args.grid) if args.grid else MODELS[model]
+        start = time.perf_counter()
+        search = sweep(features, model, grid, args.features, args.folds, args.jobs, args.seed)
+        run = save_run(search, model, data_path / conf["training"].get("models", "models"),
+                       resources=args.resources, resources_sha256=file_digest(args.resources),
+                       features_version=FEATURES_VERSION, features=args.features, folds=args.folds, seed=args.seed,
+                       seconds=round(time.perf_counter() - start, 3))
+        logs.info(f"{model}: f1 {search.best_score_:.3f} with {search.best_params_}, saved at {run}")
+
+
+if __name__ == "__main__":
+    main()
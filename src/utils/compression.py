@@ -0,0 +1,57 @@
+import gzip
+import shutil
+from pathlib import Path
+from typing import IO
+
+# file suffix of each compression method
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def compression_of(path) -> str:
+    """Compression method of a file according to its suffix, None if uncompressed"""
+    suffix = Path(path).suffix
+    return next((method for method, s in SUFFIXES.items() if s == suffix), None)
+
+
+def compress_file(path, method="zstd", level=3, remove=True, threads=0) -> Path:
+    """Compress a file next to the original, e.g. tcpdump.pcap -> tcpdump.pcap.zst
+
+    threads are the zstd workers besides the calling thread, 0 compresses in the calling thread only.
+    """
+    path = Path(path)
+    target = path.with_name(path.name + SUFFIXES[method])
+
+    with open(path, "rb") as src, open(target, "wb") as dst:
+        if method == "zstd":
+            import zstandard
+            compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+            compressor.copy_stream(src, dst)
+        else:
+            with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=level) as gz:
+                shutil.copyfileobj(src, gz, 1 << 20)
+
+    if remove:
+        path.unlink()
+    return target
+
+
+class _GzipReader(gzip.GzipFile):
+    """GzipFile which closes the wrapped file object, as the zstd stream reader does"""
+
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+
+def open_decompressed(f: IO[bytes], method) -> IO[bytes]:
+    """Wrap a binary file object to read it decompressed, closing the wrapper closes the file"""
+    if method is None:
+        return f
+    if method == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    return _GzipReader(fileobj=f, mode="rb")
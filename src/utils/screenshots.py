@@ -0,0 +1,83 @@
+import hashlib
+import io
+import json
+import threading
+from pathlib import Path
+from typing import Dict
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# suffix of each image format, png is kept as captured if Pillow isn't installed
+FORMATS = {"webp": ".webp", "jpeg": ".jpg", "png": ".png"}
+
+
+def dhash(image, size=8) -> int:
+    """Difference hash, neighbouring pixels of a grayscale thumbnail compared as bits"""
+    pixels = list(image.convert("L").resize((size + 1, size)).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            bits = bits << 1 | (left > pixels[row * (size + 1) + col + 1])
+    return bits
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class ScreenshotStore:
+    """Screenshots of the studies of one website, stored downscaled and only once if they look alike.
+
+    The screenshot of a study is written as screenshot.<format> with a
+    screenshot.json of its hash, a near-identical screenshot of a later study
+    only gets the json naming the study (same_as) which holds the image.
+    """
+
+    def __init__(self, width=960, image_format="webp", quality=80, max_distance=6) -> None:
+        self.width = width
+        self.format = image_format if Image is not None else "png"
+        self.quality = quality
+        self.max_distance = max_distance
+        self.studies = {}
+        self.lock = threading.Lock()
+
+    def _encode(self, png: bytes):
+        if Image is None:
+            # no perceptual hash without Pillow, only identical screenshots are deduplicated
+            return png, int.from_bytes(hashlib.sha256(png).digest()[:8], "big"), None
+        with Image.open(io.BytesIO(png)) as image:
+            image = image.convert("RGB")
+            if self.width and image.width > self.width:
+                image = image.resize((self.width, round(image.height * self.width / image.width)), Image.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, format=self.format.upper(), quality=self.quality)
+            return out.getvalue(), dhash(image), image.size
+
+    def save(self, png: bytes, volume, study) -> Dict:
+        """Encode and store the raw screenshot of a study, returns the written metadata"""
+        volume = Path(volume)
+        data, digest, size = self._encode(png)
+        info = {"study": study, "hash": f"{digest:016x}", "size": size, "raw_bytes": len(png)}
+
+        with self.lock:
+            same = None
+            if self.max_distance >= 0:
+                # without Pillow the hash is a digest, only equal digests match
+                limit = self.max_distance if Image is not None else 0
+                same = next((name for name, (other, _) in self.studies.items()
+                             if distance(digest, other) <= limit), None)
+            if same is not None:
+                info.update(same_as=same, file=self.studies[same][1], distance=distance(digest, self.studies[same][0]))
+            else:
+                path = volume / f"screenshot{FORMATS[self.format]}"
+                path.write_bytes(data)
+                info.update(file=path.name, stored_bytes=len(data))
+                self.studies[study] = (digest, path.name)
+
+        with open(volume / "screenshot.json", "w") as f:
+            json.dump(info, f)
+        return info
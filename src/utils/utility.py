@@ -2,7 +2,11 @@ import json
 import os
 import hashlib
 import shutil
+import atexit
 import logging
+import multiprocessing
+import multiprocessing.util
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from datetime import datetime
 from difflib import SequenceMatcher
@@ -89,8 +93,104 @@ def list_dir(path, hidden=False):
         return [os.path.join(path, p) for p in os.listdir(path) if os.path.isdir(os.path.join(path, p)) and not p.startswith('.')]
 
 
+class RateLimitFilter(logging.Filter):
+    """Lets burst warnings per call site and interval pass, the suppressed ones are counted.
+
+    The next record of a call site after its interval carries the count, so
+    repetitive per-frame messages end up as one line per interval. Counts
+    still pending when the logger stops are written by flush. Errors and
+    critical records always pass, they are the record of failed sites.
+    """
+
+    def __init__(self, burst=10, interval=60.) -> None:
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.sites = {}
+
+    def filter(self, record):
+        if self.burst <= 0 or record.levelno != logging.WARNING:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        start, passed, suppressed, _ = self.sites.get(key, (record.created, 0, 0, None))
+        if record.created - start >= self.interval:
+            start, passed = record.created, 0
+        if passed >= self.burst:
+            # the last suppressed record reports the count if no further one arrives
+            self.sites[key] = (start, passed, suppressed + 1, record)
+            return False
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        self.sites[key] = (start, passed + 1, 0, None)
+        return True
+
+    def flush(self, handler):
+        """Emit the last suppressed record of every call site with its count"""
+        for key, (start, passed, suppressed, last) in self.sites.items():
+            if suppressed:
+                last.msg = f"{last.getMessage()} ({suppressed} similar messages suppressed)"
+                last.args = None
+                handler.emit(last)
+                self.sites[key] = (start, passed, 0, None)
+
+
+# one queue and listener per logger, the listener in the main process writes every record
+_log_queues = {}
+_listeners = {}
+
+
+def log_queues():
+    return dict(_log_queues)
+
+
+def _queue_handler(queue, config):
+    handler = QueueHandler(queue)
+    handler.addFilter(RateLimitFilter(config['logging'].getint('burst', 10),
+                                      config['logging'].getfloat('burst_interval', 60)))
+    return handler
+
+
+def _flush_suppressed(handler):
+    for f in handler.filters:
+        if isinstance(f, RateLimitFilter):
+            f.flush(handler)
+
+
+def use_log_queues(queues, config):
+    """Pool initializer, the worker enqueues its records for the listener of the main process"""
+    for name, queue in queues.items():
+        logs = logging.getLogger(name)
+        listener = _listeners.pop(name, None)
+        if listener and listener[1] == os.getpid():
+            listener[0].stop()
+        handler = _queue_handler(queue, config)
+        logs.handlers = [handler]
+        _log_queues[name] = queue
+        # workers skip atexit, the finalizer runs before the one of the queue (priority 10) closes its feeder
+        multiprocessing.util.Finalize(None, _flush_suppressed, args=(handler,), exitpriority=20)
+
+
+def stop_logger(name):
+    """Write the pending suppressed counts and every queued record, then stop the listener of a logger"""
+    for handler in logging.getLogger(name).handlers:
+        _flush_suppressed(handler)
+    listener, pid = _listeners.get(name, (None, None))
+    # forked workers inherit the listener, only its process stops it
+    if listener and pid == os.getpid():
+        listener.stop()
+        del _listeners[name]
+
+
 def init_logger(name, config, verbose=False):
+    """Set up a logger in the main process, called by the entry point before its pools fork.
+
+    Starts the listener thread which writes the records, workers get its queue through use_log_queues.
+    """
     logs = logging.getLogger(name)
+    if logs.handlers:
+        # already set up in this process
+        return logs
     log_level = logging.getLevelName(config['logging']['level'])
     logs.setLevel(log_level)
     formatter = logging.Formatter(
@@ -99,16 +199,26 @@ def init_logger(name, config, verbose=False):
     filename = Path(config['logging'].get('directory', 'logs')) / \
         f"{name}-{datetime.today().strftime('%Y-%m-%d')}.log"
     create_folder(filename.parent)
+    handlers = []
     file_stream = logging.FileHandler(filename)
     file_stream.setLevel(log_level)
     file_stream.setFormatter(formatter)
-    logs.addHandler(file_stream)
+    handlers.append(file_stream)
 
     if not verbose:
         console_stream = logging.StreamHandler()
         console_stream.setLevel(log_level)
         console_stream.setFormatter(formatter)
-        logs.addHandler(console_stream)
+        handlers.append(console_stream)
+
+    # records are written by a listener thread, logging never waits for the file
+    queue = multiprocessing.Queue(-1)
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners[name] = (listener, os.getpid())
+    _log_queues[name] = queue
+    atexit.register(stop_logger, name)
+    logs.addHandler(_queue_handler(queue, config))
 
     return logs
 